@@ -0,0 +1,98 @@
+"""
+Fits the cost model of model/estimate.py: the seconds per tick as a constant plus a cost
+per element of the arrays the phases of a tick go over (consumer rows * C * F, consumer
+rows * C * F * D, the data held on them T * rows * C * F * D, and F * C * F * C * D), by
+least squares over the runs of a grid of configurations. Prints the COST_MODEL to paste
+into model/estimate.py.
+
+usage: python benchmarks/cost_model.py [-i model_parameters.yaml]
+"""
+
+import copy
+import itertools
+import os
+import sys
+import time
+
+import click
+import numpy as np
+import yaml
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from model.simulation import Simulation  # noqa: E402
+from model.estimate import dimensions, estimate, available_memory  # noqa: E402
+
+# the grid: ticks, number of consumers, of categories and of datatypes, births per tick
+GRID = {
+    "general_dict.n_ticks": [6, 12],
+    "general_dict.n_consumers": [100, 400, 1600, 3200],
+    "category_dict.n_total_categories": [10, 50],
+    "data_dict.n_data_types_total": [5, 20],
+    "general_dict.birth_lambda": [0.2, 1.0],
+}
+FEATURES = [
+    "tick",
+    "consumer_products",
+    "consumer_data",
+    "consumer_history",
+    "firm_pairs",
+]
+
+
+def features(config):
+    dims = dimensions(**config)
+    T, N, C, F, D = [dims[x] for x in "TNCFD"]
+    return [1, N * C * F, N * C * F * D, T * N * C * F * D, F * C * F * C * D]
+
+
+def seconds_per_tick(config):
+    sim = Simulation(**config)
+    start = time.time()
+    sim.run_until()
+    return (time.time() - start) / sim.n_ticks
+
+
+@click.command()
+@click.option(
+    "--input_yaml",
+    "-i",
+    default=os.path.join(REPO, "model_parameters.yaml"),
+    help="Base parameters",
+)
+def cost_model_benchmark(input_yaml):
+    with open(input_yaml) as f:
+        base = yaml.safe_load(f)
+    # no privacy shock, and compile the numba kernels before timing
+    base["scenario_dict"] = {}
+    seconds_per_tick(base)
+    X, y = [], []
+    for values in itertools.product(*GRID.values()):
+        config = copy.deepcopy(base)
+        for key, value in zip(GRID, values):
+            section, name = key.split(".")
+            config[section][name] = value
+        label = ", ".join(
+            "{}={}".format(k.split(".")[1], v) for k, v in zip(GRID, values)
+        )
+        if estimate(**config)["peak"] > available_memory():
+            print(label, "skipped, doesn't fit in memory")
+            continue
+        X.append(features(config))
+        y.append(seconds_per_tick(config))
+        print(label, "{:.3f}s per tick".format(y[-1]), flush=True)
+    X, y = np.array(X, dtype=float), np.array(y)
+    # relative errors count the same for small and large runs
+    coef = np.linalg.lstsq(X / y[:, None], np.ones(len(y)), rcond=None)[0]
+    coef = np.maximum(coef, 0)
+    error = np.abs(X @ coef / y - 1)
+    print("median error {:.0%}, largest {:.0%}".format(np.median(error), error.max()))
+    print("COST_MODEL = {")
+    for name, value in zip(FEATURES, coef):
+        print('    "{}": {:.3g},'.format(name, value))
+    print("}")
+
+
+if __name__ == "__main__":
+    cost_model_benchmark()
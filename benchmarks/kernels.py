@@ -0,0 +1,440 @@
+"""
+Micro-benchmarks of the kernels of the model: the numba functions of data_handling, the
+consumer choice in utility and utils, innovation, the deletion of data in the scenario
+and drawing the needs. Every kernel runs on synthetic state at the sizes in SIZES, with
+fresh inputs for every repeat (the kernels change their inputs in place), and gets the
+fastest time of the repeats and the peak memory of a call on top of its inputs, after a
+first call that compiles it.
+
+The peak memory is the largest of the tracemalloc peak (numpy arrays) and the growth of
+the peak resident set size during the call, which also sees the memory numba allocates:
+the peak is reset before the call through /proc/self/clear_refs (linux), and large
+blocks are mapped on their own so that they show in it. Elsewhere it is the tracemalloc
+peak only.
+
+The results are compared against a baseline (a json written with --save_baseline on the
+same machine): a kernel that is slower than its baseline by more than --threshold, or
+takes more memory by more than --memory_threshold, fails the benchmark (exit status 1).
+
+usage: python benchmarks/kernels.py [-k port,multinomial] [-s small] [--save_baseline]
+"""
+
+import copy
+import ctypes
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import click
+import numpy as np
+import yaml
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from model import data_handling  # noqa: E402
+from model import innovation  # noqa: E402
+from model.needs import draw_from_one_need_distribution  # noqa: E402
+from model.privacy_scenario import delete_data  # noqa: E402
+from model.utility import utility_for_consumers, choose_firms  # noqa: E402
+from model.utils import multinomial  # noqa: E402
+from rss import status, reset_peak_rss  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(REPO, "benchmarks", "kernels_baseline.json")
+# mallopt parameter of glibc
+M_MMAP_THRESHOLD = -3
+
+# consumers, categories, firms, datatypes and ticks of the synthetic state
+SIZES = {
+    "small": {"N": 100, "C": 10, "F": 12, "D": 5, "T": 12},
+    "medium": {"N": 500, "C": 20, "F": 25, "D": 8, "T": 12},
+    "large": {"N": 1000, "C": 30, "F": 25, "D": 8, "T": 12},
+}
+
+
+class State(object):
+    """
+    synthetic state of a simulation of size dims, arrays made when first used
+    """
+
+    def __init__(self, dims, params, seed=0):
+        self.dims = dims
+        self.params = params
+        self.rng = np.random.RandomState(seed)
+        self._arrays = {}
+
+    def __getattr__(self, name):
+        if name.startswith("_") or not hasattr(type(self), "make_" + name):
+            raise AttributeError(name)
+        if name not in self._arrays:
+            self._arrays[name] = getattr(self, "make_" + name)()
+        return self._arrays[name]
+
+    def make_quality(self):
+        F, C = self.dims["F"], self.dims["C"]
+        products = self.rng.uniform(size=(F, C)) < 0.3
+        products[np.arange(F), np.arange(F) % C] = True
+        return products * self.rng.uniform(1, 3, size=(F, C))
+
+    def make_category_datatype(self):
+        C, D = self.dims["C"], self.dims["D"]
+        category_datatype = np.zeros((C, D), dtype=np.int8)
+        for c in range(C):
+            n = self.rng.randint(1, 4)
+            category_datatype[c, self.rng.choice(D, size=n, replace=False)] = 1
+        return category_datatype
+
+    def make_requestable(self):
+        F, C = self.dims["F"], self.dims["C"]
+        requestable = np.ones((F, C, F, C, self.dims["D"]), dtype=np.int8)
+        requestable[np.arange(F), :, np.arange(F)] = 0
+        requestable *= self.category_datatype[None, :, None, None, :]
+        requestable *= self.category_datatype[None, None, None, :, :]
+        return requestable
+
+    def make_usage(self):
+        N, C, F = self.dims["N"], self.dims["C"], self.dims["F"]
+        prob = np.ones((N, C, F)) * (self.quality > 0).T[None]
+        prob /= prob.sum(axis=-1, keepdims=True)
+        used = self.rng.uniform(size=(N, C, 1)) < 0.3
+        return multinomial(prob, self.rng) * used
+
+    def make_usage_counter(self):
+        return self.usage * self.rng.uniform(0, 5, size=self.usage.shape)
+
+    def make_data_held(self):
+        N, C, F, D, T = [self.dims[x] for x in "NCFDT"]
+        held = self.rng.uniform(size=(T, N, C, F, 1)) < 0.1
+        return held * self.category_datatype[None, None, :, None, :].astype(float)
+
+    def make_data_value(self):
+        return self.data_held.sum(axis=0)
+
+    def make_concern(self):
+        return self.rng.uniform(size=self.dims["N"])
+
+    def make_privacy_score(self):
+        return self.rng.uniform(size=self.dims["F"])
+
+    def make_category_total_usage(self):
+        return self.usage.sum(axis=(0, 2)) * self.dims["T"]
+
+    def make_category_ticks_alive(self):
+        return (self.quality.sum(axis=0) > 0) * self.dims["T"]
+
+
+def bench_port(state):
+    N, C, F, D, T = [state.dims[x] for x in "NCFDT"]
+    n = max(N // 20, 1)
+    cons_ = state.rng.choice(N, size=n, replace=False)
+    cat_ = state.rng.randint(0, C, size=n)
+    firm_ = state.rng.randint(0, F, size=n)
+    PM = (state.rng.uniform(size=(n, C, F, D)) < 0.2).astype(float)
+    return data_handling.port, lambda: (
+        cons_,
+        cat_,
+        firm_,
+        state.data_held.copy(),
+        state.data_value.copy(),
+        T - 1,
+        PM,
+    )
+
+
+def bench_avail_now(state):
+    A_where_0, A_where_1 = np.where(state.quality > 0)
+    args = (state.requestable, A_where_0, A_where_1)
+    return data_handling.numba_calc_avail_now, lambda: args
+
+
+def bench_update_data(state):
+    usage_cons, usage_cat, usage_firm = np.where(state.usage)
+    T, D = state.dims["T"], state.dims["D"]
+    return data_handling.update_data_stuff, lambda: (
+        state.data_held.copy(),
+        state.data_value.copy(),
+        usage_cons,
+        usage_cat,
+        usage_firm,
+        state.category_datatype,
+        T - 1,
+        D,
+    )
+
+
+def bench_mask_requests(state):
+    C, F, D = state.dims["C"], state.dims["F"], state.dims["D"]
+    # a request per firm and datatype
+    n = F * D
+    args = (
+        np.repeat(np.arange(F), D),
+        state.rng.randint(0, C, size=n),
+        state.rng.randint(0, F, size=n),
+        state.rng.randint(0, C, size=n),
+        np.tile(np.arange(D), F),
+        state.requestable,
+    )
+    return data_handling.numba_mask_impossible_requests, lambda: args
+
+
+def bench_utility(state):
+    args = (
+        state.quality,
+        state.usage,
+        state.usage_counter,
+        state.concern,
+        state.privacy_score,
+        state.params["util_weight_dict"],
+    )
+    return utility_for_consumers, lambda: args
+
+
+def bench_choose_firms(state):
+    U = utility_for_consumers(
+        state.quality,
+        state.usage,
+        state.usage_counter,
+        state.concern,
+        state.privacy_score,
+        state.params["util_weight_dict"],
+    )
+    privacy_mask = np.ones((state.dims["N"], state.dims["F"]))
+    w_logit = state.params["util_weight_dict"]["w_logit"]
+    return choose_firms, lambda: (U, state.quality, w_logit, privacy_mask, state.rng)
+
+
+def bench_multinomial(state):
+    N, C, F = state.dims["N"], state.dims["C"], state.dims["F"]
+    M = state.rng.uniform(size=(N, C, F))
+    M /= M.sum(axis=-1, keepdims=True)
+    return multinomial, lambda: (M, state.rng)
+
+
+def bench_enter_new_category(state):
+    F = state.dims["F"]
+    preference = np.zeros((F, 2), dtype=int)
+    preference[np.arange(F), state.rng.randint(0, 2, size=F)] = 1
+    innovation_dict = state.params["innovation_dict"]
+    return innovation.enter_new_category, lambda: (
+        state.quality,
+        state.category_datatype,
+        preference,
+        state.category_total_usage,
+        state.category_ticks_alive,
+        innovation_dict,
+        innovation_dict["qual_diff_param"],
+        state.rng,
+    )
+
+
+def bench_invest_existing(state):
+    args = (
+        state.quality,
+        state.category_total_usage,
+        state.dims["T"] - 1,
+        state.params["innovation_dict"],
+    )
+    return innovation.invest_utility_existing, lambda: args
+
+
+def bench_delete_data(state):
+    N, F, T = state.dims["N"], state.dims["F"], state.dims["T"]
+    deleters = np.zeros((N, F))
+    deleters[:, state.rng.choice(F, size=3, replace=False)] = (
+        state.rng.uniform(size=(N, 3)) < 0.3
+    )
+    alpha = state.params["data_dict"]["data_worth_exp"]
+    return delete_data, lambda: (
+        deleters,
+        state.data_held.copy(),
+        state.data_value.copy(),
+        T - 1,
+        alpha,
+    )
+
+
+def bench_need_matrix(state):
+    N, C = state.dims["N"], state.dims["C"]
+    modes = [state.rng.uniform(0, 1, size=2) for _ in range(C)]
+    vars = [state.rng.uniform(0.001, 0.01, size=2) for _ in range(C)]
+
+    def need_matrix(rng):
+        # a column per category, as world.make_world draws them
+        return np.stack(
+            [
+                draw_from_one_need_distribution(m, v, N, rng)
+                for m, v in zip(modes, vars)
+            ],
+            axis=1,
+        )
+
+    return need_matrix, lambda: (state.rng,)
+
+
+# name: function of a State, returning the kernel and a function making its arguments
+KERNELS = {
+    "port": bench_port,
+    "numba_calc_avail_now": bench_avail_now,
+    "update_data_stuff": bench_update_data,
+    "numba_mask_impossible_requests": bench_mask_requests,
+    "utility_for_consumers": bench_utility,
+    "choose_firms": bench_choose_firms,
+    "multinomial": bench_multinomial,
+    "enter_new_category": bench_enter_new_category,
+    "invest_utility_existing": bench_invest_existing,
+    "delete_data": bench_delete_data,
+    "need_matrix": bench_need_matrix,
+}
+
+
+def _map_large_blocks():
+    """
+    makes glibc give every block of 128kB or more its own mapping, returned to the
+    system when freed, instead of reusing freed memory of the heap, which the resident
+    set size doesn't see grow
+    """
+    try:
+        ctypes.CDLL("libc.so.6").mallopt(M_MMAP_THRESHOLD, 128 * 1024)
+    except (OSError, AttributeError):
+        pass
+
+
+def peak_memory(kernel, args):
+    """
+    the bytes kernel(*args) takes on top of what is in use before the call: the largest
+    of the tracemalloc peak and the growth of the peak resident set size
+    """
+    rss = reset_peak_rss()
+    if rss:
+        before = status("VmRSS")
+    tracemalloc.start()
+    kernel(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    if rss:
+        peak = max(peak, status("VmHWM") - before)
+    return peak
+
+
+def measure(name, size, params, repeats):
+    state = State(SIZES[size], params)
+    kernel, make_args = KERNELS[name](state)
+    # compiles the numba kernels and makes the one-off allocations of the first call
+    kernel(*make_args())
+    args = make_args()
+    peak = peak_memory(kernel, args)
+    del args
+    times = []
+    for _ in range(repeats):
+        args = make_args()
+        start = time.perf_counter()
+        kernel(*args)
+        times.append(time.perf_counter() - start)
+    return {
+        "seconds": min(times),
+        "median_seconds": float(np.median(times)),
+        "peak": peak,
+    }
+
+
+@click.command()
+@click.option(
+    "--kernels", "-k", default=None, help="Comma separated kernels (default: all)"
+)
+@click.option(
+    "--sizes", "-s", default=None, help="Comma separated sizes (default: all)"
+)
+@click.option("--repeats", "-n", default=5, help="Number of timed calls per kernel")
+@click.option("--baseline", default=DEFAULT_BASELINE, help="Path of the baseline json")
+@click.option(
+    "--save_baseline", is_flag=True, help="Write the results as the new baseline"
+)
+@click.option(
+    "--threshold",
+    default=0.25,
+    help="Fail if a kernel is slower than its baseline by more than this fraction",
+)
+@click.option(
+    "--memory_threshold",
+    default=0.25,
+    help="Fail if a kernel takes more memory than its baseline by more than this "
+    "fraction",
+)
+@click.option(
+    "--input_yaml",
+    "-i",
+    default=os.path.join(REPO, "model_parameters.yaml"),
+    help="Parameters for the weights of the kernels",
+)
+def kernel_benchmark(
+    kernels,
+    sizes,
+    repeats,
+    baseline,
+    save_baseline,
+    threshold,
+    memory_threshold,
+    input_yaml,
+):
+    with open(input_yaml) as f:
+        params = yaml.safe_load(f)
+    kernels = kernels.split(",") if kernels else list(KERNELS)
+    sizes = sizes.split(",") if sizes else list(SIZES)
+    unknown = [x for x in kernels if x not in KERNELS] + [
+        x for x in sizes if x not in SIZES
+    ]
+    assert not unknown, "unknown kernels or sizes: " + ", ".join(unknown)
+    reference = {}
+    if os.path.exists(baseline) and not save_baseline:
+        with open(baseline) as f:
+            reference = json.load(f)
+
+    results = {}
+    failed = []
+    print(
+        "{:<40}{:>12}{:>12}{:>12}{:>10}{:>10}".format(
+            "kernel", "min", "median", "peak", "time", "memory"
+        )
+    )
+    _map_large_blocks()
+    for name in kernels:
+        for size in sizes:
+            key = "{}[{}]".format(name, size)
+            result = measure(name, size, copy.deepcopy(params), repeats)
+            results[key] = result
+            line = "{:<40}{:>11.2f}ms{:>10.2f}ms{:>10.1f}MB".format(
+                key,
+                1e3 * result["seconds"],
+                1e3 * result["median_seconds"],
+                result["peak"] / 1e6,
+            )
+            if key in reference:
+                # 1MB of slack, so that kernels next to no memory don't fail on noise
+                ratios = [
+                    result["seconds"] / reference[key]["seconds"],
+                    (result["peak"] + 1e6) / (reference[key]["peak"] + 1e6),
+                ]
+                line += "{:>9.2f}x{:>9.2f}x".format(*ratios)
+                if ratios[0] > 1 + threshold or ratios[1] > 1 + memory_threshold:
+                    failed.append(key)
+                    line += "  REGRESSION"
+            print(line, flush=True)
+
+    if save_baseline:
+        if os.path.exists(baseline):
+            with open(baseline) as f:
+                results = dict(json.load(f), **results)
+        with open(baseline, "w") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print("baseline written to " + baseline)
+    elif not reference:
+        print("no baseline to compare with, write one with --save_baseline")
+    if failed:
+        print("{} regressions: {}".format(len(failed), ", ".join(failed)))
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    kernel_benchmark()
@@ -0,0 +1,26 @@
+"""
+The resident set size of the benchmark process, from /proc (linux), shared by the
+benchmarks that measure the peak memory of what they run.
+"""
+
+import re
+
+
+def status(field):
+    """
+    bytes: the field (e.g. VmRSS, VmHWM) of /proc/self/status
+    """
+    with open("/proc/self/status") as f:
+        return 1024 * int(re.search(field + r":\s+(\d+)", f.read()).group(1))
+
+
+def reset_peak_rss():
+    """
+    resets the peak resident set size of this process, False if that isn't possible
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
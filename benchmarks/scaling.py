@@ -0,0 +1,367 @@
+"""
+End-to-end scaling of full runs: starting from a base configuration (BASE on top of the
+parameter yaml), every parameter in SWEEPS is varied on its own over its values, and
+every run records the seconds of setup, of every phase of a tick (added up over the
+ticks, from the profile of the run, see model/profiling.py) and of gathering the
+outputs, the distribution of the seconds per tick, and the peak resident set size of the
+process that ran it. The setup includes drawing the world of the run (the runs don't
+use the store of world.py), so the exponents of ticks_seconds (the ticks only) are the
+steadier ones.
+
+The scaling exponent of a measure against a parameter is the slope of a least squares
+line through log(measure) against log(size), where the size is the dimension of the
+state arrays the parameter drives (see estimate.dimensions): N for n_consumers, C for
+n_total_categories, D for n_data_types_total, F for birth_lambda and T for n_ticks.
+deaths, request_selection and granting go over the (firm, category, firm, category,
+datatype) arrays, so their share of a tick (firm_pair_share) shows where the F^2 C^2
+terms dominate.
+
+A run is affordable if it takes at most --budget seconds and fits in --memory_limit;
+runs predicted (by estimate.py) not to are skipped. Every run is made in a fresh
+process forked after the numba kernels are compiled, so that its peak memory is its
+own. The report in --output_dir has
+    runs.csv: a row per run
+    ticks.csv: the seconds of every tick of every run
+    exponents.csv: the scaling exponents, and per sweep where the firm pair phases
+        dominate and the largest affordable value
+    index.html: plots of the seconds per phase, the seconds per tick and the peak
+        memory against the size, per sweep
+
+usage: python benchmarks/scaling.py [-p general_dict.n_consumers] [--budget 60]
+"""
+
+import copy
+import os
+import resource
+import sys
+import time
+from multiprocessing import Pool
+
+import click
+import numpy as np
+import pandas as pd
+import yaml
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from model.estimate import dimensions, estimate, available_memory  # noqa: E402
+from model.profiling import PHASES  # noqa: E402
+from model.server import WARM_UP, merge  # noqa: E402
+from model.simulation import create_simulation  # noqa: E402
+from rss import status, reset_peak_rss  # noqa: E402
+
+# the base configuration: small enough for the sweeps to go well above it. With a
+# growth factor of 1 new categories soon use all datatypes, so that D follows
+# n_data_types_total
+BASE = {
+    "general_dict.n_ticks": 12,
+    "general_dict.n_consumers": 250,
+    "general_dict.birth_lambda": 0.5,
+    "category_dict.n_total_categories": 20,
+    "data_dict.n_data_types_total": 8,
+    "data_dict.growth_factor": 1,
+}
+# parameter: (the dimension it drives, values)
+SWEEPS = {
+    "general_dict.n_consumers": ("N", [125, 250, 500, 1000, 2000, 4000]),
+    "category_dict.n_total_categories": ("C", [10, 20, 40, 80, 160]),
+    "data_dict.n_data_types_total": ("D", [5, 8, 16, 32]),
+    "general_dict.birth_lambda": ("F", [0.25, 0.5, 1, 2, 4, 8]),
+    "general_dict.n_ticks": ("T", [6, 12, 24, 48, 96]),
+}
+# the phases that go over the (firm, category, firm, category, datatype) arrays
+FIRM_PAIR_PHASES = ["deaths", "request_selection", "granting"]
+MEASURES = ["run_seconds", "ticks_seconds", "setup_seconds", "tick_p50", "peak_rss"] + [
+    x + "_seconds" for x in PHASES
+]
+
+
+def configure(base, values):
+    """
+    a copy of base with values ({section.name: value}) set
+    """
+    config = copy.deepcopy(base)
+    for key, value in values.items():
+        section, name = key.split(".")
+        config[section][name] = value
+    return config
+
+
+def peak_rss(reset):
+    """
+    bytes: the peak resident set size of this process, since it was reset if it could be
+    """
+    if reset:
+        return status("VmHWM")
+    # kilobytes on linux, bytes on mac
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def measure_run(config):
+    """
+    runs config, returning the seconds of setup, of every phase (over all ticks), of
+    every tick and of the outputs, and the peak resident set size
+    """
+    reset = reset_peak_rss()
+    config = configure(config, {"general_dict.profile": "time"})
+    start = time.perf_counter()
+    sim = create_simulation(**config)
+    setup_seconds = time.perf_counter() - start
+    sim.run_until()
+    start = time.perf_counter()
+    out = sim.results()
+    for name in out:
+        out[name]
+    results_seconds = time.perf_counter() - start
+    profile = out["profile"]
+    seconds = profile.groupby("phase")["seconds"].sum()
+    return {
+        "setup_seconds": setup_seconds,
+        "phase_seconds": {x: seconds.get(x, 0.0) for x in PHASES},
+        "tick_seconds": profile.loc[profile.phase == "tick", "seconds"].tolist(),
+        "results_seconds": results_seconds,
+        "peak_rss": peak_rss(reset),
+    }
+
+
+def fit_exponent(sizes, values):
+    """
+    the slope of log(values) against log(sizes), NaN with fewer than two distinct sizes
+    or values that aren't positive
+    """
+    sizes, values = np.asarray(sizes, dtype=float), np.asarray(values, dtype=float)
+    keep = (sizes > 0) & (values > 0) & np.isfinite(values)
+    if len(np.unique(sizes[keep])) < 2:
+        return np.nan
+    return np.polyfit(np.log(sizes[keep]), np.log(values[keep]), 1)[0]
+
+
+def summarise(runs, budget):
+    """
+    a row per sweep: the scaling exponents of every measure, the first size at which
+    the firm pair phases take most of a tick, and the largest affordable value
+    """
+    rows = []
+    for parameter, (dim, _) in SWEEPS.items():
+        done = runs[(runs.parameter == parameter) & (runs.status == "done")]
+        if done.empty:
+            continue
+        row = {"parameter": parameter, "dimension": dim}
+        for measure in MEASURES:
+            row[measure] = fit_exponent(done[dim], done[measure])
+        dominant = done[done.firm_pair_share > 0.5]
+        row["firm_pairs_dominate_from"] = dominant[dim].min()
+        affordable = runs[(runs.parameter == parameter) & runs.affordable]
+        row["largest_affordable"] = affordable.value.max()
+        # where the fitted run time reaches the budget
+        last = done.sort_values(dim).iloc[-1]
+        k = row["run_seconds"]
+        row["size_at_budget"] = (
+            last[dim] * (budget / last.run_seconds) ** (1 / k) if k > 0 else np.nan
+        )
+        rows.append(row)
+    columns = ["parameter", "dimension"] + MEASURES
+    columns += ["firm_pairs_dominate_from", "largest_affordable", "size_at_budget"]
+    return pd.DataFrame(rows, columns=columns).set_index("parameter")
+
+
+def plot_sweep(runs, ticks, parameter, dim):
+    """
+    the figures of a sweep: seconds per phase, seconds per tick and peak memory
+    against the size
+    """
+    import plotly.graph_objs as go
+
+    done = runs[(runs.parameter == parameter) & (runs.status == "done")]
+    done = done.sort_values(dim)
+    axes = {
+        "xaxis": {"title": dim + " (" + parameter + ")", "type": "log"},
+        "yaxis": {"type": "log"},
+    }
+    phases = [
+        go.Scatter(x=done[dim], y=done[x + "_seconds"], mode="lines+markers", name=x)
+        for x in ["setup"] + PHASES + ["results"]
+        if done[x + "_seconds"].sum() > 0
+    ]
+    phases.append(
+        go.Scatter(
+            x=done[dim],
+            y=done.run_seconds,
+            mode="lines+markers",
+            name="total",
+            line={"dash": "dash", "color": "black"},
+        )
+    )
+    axes_s = dict(axes, yaxis={"type": "log", "title": "seconds"})
+    sweep_ticks = ticks[ticks.parameter == parameter]
+    boxes = [
+        go.Box(y=sweep_ticks[sweep_ticks.value == value].seconds, name=str(size))
+        for value, size in zip(done.value, done[dim])
+    ]
+    memory = [go.Scatter(x=done[dim], y=done.peak_rss / 1e9, mode="lines+markers")]
+    return {
+        "phases": go.Figure(
+            data=phases, layout=dict(axes_s, title="Seconds per phase, whole run")
+        ),
+        "ticks": go.Figure(
+            data=boxes,
+            layout={
+                "title": "Seconds per tick",
+                "xaxis": {"title": dim + " (" + parameter + ")"},
+                "yaxis": {"title": "seconds", "type": "log"},
+                "showlegend": False,
+            },
+        ),
+        "memory": go.Figure(
+            data=memory,
+            layout=dict(
+                axes, yaxis={"type": "log", "title": "GB"}, title="Peak memory"
+            ),
+        ),
+    }
+
+
+def write_plots(runs, ticks, output_dir):
+    import plotly.offline as py
+    from model.report import write_plotlyjs, write_index
+
+    write_plotlyjs(output_dir)
+    names = []
+    for parameter, (dim, _) in SWEEPS.items():
+        if not ((runs.parameter == parameter) & (runs.status == "done")).any():
+            continue
+        for kind, fig in plot_sweep(runs, ticks, parameter, dim).items():
+            name = "{}_{}".format(parameter.split(".")[1], kind)
+            filename = os.path.join(output_dir, name + ".html")
+            py.plot(
+                fig, filename=filename, auto_open=False, include_plotlyjs="directory"
+            )
+            names.append(name)
+    write_index(output_dir, names)
+
+
+@click.command()
+@click.option(
+    "--input_yaml",
+    "-i",
+    default=os.path.join(REPO, "model_parameters.yaml"),
+    help="Parameters the base configuration is made from",
+)
+@click.option(
+    "--output_dir", "-o", default="./scaling", help="Directory to write the report to"
+)
+@click.option(
+    "--parameters",
+    "-p",
+    default=None,
+    help="Comma separated parameters to sweep (default: all of SWEEPS)",
+)
+@click.option("--budget", default=60.0, help="Seconds a run may take to be affordable")
+@click.option(
+    "--memory_limit",
+    "-m",
+    default=None,
+    type=float,
+    help="GB a run may use to be affordable (default: the available memory)",
+)
+def scaling_benchmark(input_yaml, output_dir, parameters, budget, memory_limit):
+    with open(input_yaml) as f:
+        base = configure(yaml.safe_load(f), BASE)
+    parameters = parameters.split(",") if parameters else list(SWEEPS)
+    unknown = [x for x in parameters if x not in SWEEPS]
+    assert not unknown, "unknown parameters: " + ", ".join(unknown)
+    limit = memory_limit * 1e9 if memory_limit else available_memory()
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    # compile the numba kernels once, in the process the runs are forked from
+    measure_run(merge(base, WARM_UP))
+
+    rows, tick_rows = [], []
+    for parameter in parameters:
+        dim, values = SWEEPS[parameter]
+        for value in values:
+            config = configure(base, {parameter: value})
+            dims = dimensions(**config)
+            predicted = estimate(**config)
+            row = {"parameter": parameter, "value": value}
+            row.update({x: dims[x] for x in "TNCFD"})
+            row["predicted_seconds"] = predicted["run_seconds"]
+            row["predicted_peak"] = predicted["peak"]
+            label = "{}={} ({}={})".format(parameter, value, dim, dims[dim])
+            if predicted["peak"] > limit or predicted["run_seconds"] > budget:
+                row["status"] = "skipped"
+                row["affordable"] = False
+                print(label, "skipped, predicted over budget", flush=True)
+                rows.append(row)
+                continue
+            # a fresh process for every run
+            with Pool(1, maxtasksperchild=1) as pool:
+                result = pool.apply(measure_run, (config,))
+            phase_seconds = result["phase_seconds"]
+            tick_seconds = np.array(result["tick_seconds"])
+            row["status"] = "done"
+            row["setup_seconds"] = result["setup_seconds"]
+            for name in PHASES:
+                row[name + "_seconds"] = phase_seconds[name]
+            row["results_seconds"] = result["results_seconds"]
+            row["ticks_seconds"] = tick_seconds.sum()
+            row["run_seconds"] = (
+                result["setup_seconds"] + tick_seconds.sum() + result["results_seconds"]
+            )
+            for q in [50, 90, 99]:
+                row["tick_p{}".format(q)] = np.percentile(tick_seconds, q)
+            row["tick_max"] = tick_seconds.max()
+            row["firm_pair_share"] = (
+                sum(phase_seconds[x] for x in FIRM_PAIR_PHASES) / tick_seconds.sum()
+            )
+            row["peak_rss"] = result["peak_rss"]
+            row["affordable"] = (
+                row["run_seconds"] <= budget and row["peak_rss"] <= limit
+            )
+            rows.append(row)
+            tick_rows += [
+                {"parameter": parameter, "value": value, "tick": t, "seconds": s}
+                for t, s in enumerate(tick_seconds)
+            ]
+            print(
+                label,
+                "{:.2f}s, {:.2f}s per tick, {:.0%} firm pairs, {:.2f}GB".format(
+                    row["run_seconds"],
+                    row["tick_p50"],
+                    row["firm_pair_share"],
+                    row["peak_rss"] / 1e9,
+                ),
+                flush=True,
+            )
+
+    runs = pd.DataFrame(rows)
+    ticks = pd.DataFrame(tick_rows, columns=["parameter", "value", "tick", "seconds"])
+    runs.to_csv(os.path.join(output_dir, "runs.csv"), index=False)
+    ticks.to_csv(os.path.join(output_dir, "ticks.csv"), index=False)
+    exponents = summarise(runs, budget)
+    exponents.to_csv(os.path.join(output_dir, "exponents.csv"))
+    write_plots(runs, ticks, output_dir)
+    if exponents.empty:
+        print("no runs within the budget")
+        return
+    with pd.option_context("display.width", 120, "display.max_columns", None):
+        print(
+            exponents[
+                [
+                    "dimension",
+                    "run_seconds",
+                    "ticks_seconds",
+                    "peak_rss",
+                    "firm_pairs_dominate_from",
+                    "largest_affordable",
+                    "size_at_budget",
+                ]
+            ].round(2)
+        )
+    print("report written to " + output_dir)
+
+
+if __name__ == "__main__":
+    scaling_benchmark()
@@ -0,0 +1,93 @@
+"""
+Start-up time benchmark: how long does a fresh python process take to import the model and
+to finish a small simulation, with and without the on-disk cache of compiled numba kernels.
+
+Every measurement is made in a new process, as start-up cost is what we are after.
+usage: python benchmarks/startup.py [-n repeats]
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+import numpy as np
+import yaml
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# a configuration small enough for the simulation itself to take next to no time
+SMALL_CONFIG = {
+    "general_dict": {"n_ticks": 4, "n_consumers": 20},
+    "category_dict": {"n_init_categories": 4, "n_total_categories": 6},
+}
+
+IMPORT_ONLY = "import model.simulation"
+SMALL_RUN = """
+import yaml
+from model.simulation import run
+with open({config!r}) as f:
+    run(**yaml.safe_load(f))
+"""
+
+
+def small_config(base_yaml):
+    with open(base_yaml) as f:
+        config = yaml.safe_load(f)
+    for section, values in SMALL_CONFIG.items():
+        config[section].update(values)
+    return config
+
+
+def time_process(code, env):
+    start = time.time()
+    subprocess.run([sys.executable, "-c", code], cwd=REPO, env=env, check=True)
+    return time.time() - start
+
+
+@click.command()
+@click.option("--repeats", "-n", default=5, help="Number of processes per measurement")
+@click.option(
+    "--input_yaml",
+    "-i",
+    default=os.path.join(REPO, "model_parameters.yaml"),
+    help="Base parameters, shrunk to a small configuration",
+)
+def startup_benchmark(repeats, input_yaml):
+    with tempfile.TemporaryDirectory() as tmp:
+        config_path = os.path.join(tmp, "small.yaml")
+        with open(config_path, "w") as f:
+            yaml.safe_dump(small_config(input_yaml), f)
+        run_code = SMALL_RUN.format(config=config_path)
+
+        def env_with_cache(cache_dir):
+            env = dict(os.environ, NUMBA_CACHE_DIR=cache_dir)
+            env["PYTHONWARNINGS"] = "ignore"
+            return env
+
+        timings = {"import model.simulation": [], "small run, cold cache": []}
+        for i in range(repeats):
+            cache_dir = os.path.join(tmp, "numba_cache_{}".format(i))
+            timings["import model.simulation"].append(
+                time_process(IMPORT_ONLY, env_with_cache(cache_dir))
+            )
+            timings["small run, cold cache"].append(
+                time_process(run_code, env_with_cache(cache_dir))
+            )
+        warm_dir = os.path.join(tmp, "numba_cache_0")
+        timings["small run, warm cache"] = [
+            time_process(run_code, env_with_cache(warm_dir)) for _ in range(repeats)
+        ]
+
+    for name, times in timings.items():
+        print(
+            "{:<26} median {:.2f}s  min {:.2f}s  max {:.2f}s".format(
+                name, np.median(times), np.min(times), np.max(times)
+            )
+        )
+
+
+if __name__ == "__main__":
+    startup_benchmark()
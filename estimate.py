@@ -0,0 +1,76 @@
+from model.estimate import estimate, report, memory_limit, choose_out_of_core
+from model.estimate import format_bytes
+
+import click
+import yaml
+
+
+def read_yaml(filename):
+    with open(filename, "r") as stream:
+        return yaml.safe_load(stream)
+
+
+@click.command()
+@click.option(
+    "--input_yaml",
+    "-i",
+    help="Path to yaml with parameters",
+    default="model_parameters.yaml",
+)
+@click.option(
+    "--memory_limit",
+    "-m",
+    "limit",
+    type=float,
+    default=None,
+    help="GB of memory the run may use (default: memory_limit in general_dict, or the "
+    "memory available now)",
+)
+@click.option(
+    "--output_yaml",
+    "-o",
+    help="Write the parameters with the out_of_core arrays the run needs to fit",
+    default=None,
+)
+def estimate_resources(input_yaml, limit, output_yaml):
+    """
+    the shape, dtype and size of every state array of a run, the tracker, the predicted
+    peak memory of every phase and the time per tick, without allocating anything
+    """
+    config = read_yaml(input_yaml)
+    result = estimate(**config)
+    print(report(result))
+    if limit is None:
+        limit = memory_limit(config["general_dict"])
+    else:
+        limit *= 1e9
+    if limit is None:
+        return
+    print("\nmemory limit: " + format_bytes(limit))
+    out_of_core, fitted = choose_out_of_core(config, limit)
+    if result["peak"] <= limit:
+        print("the run fits in memory")
+    elif fitted["peak"] <= limit:
+        print(
+            "the run doesn't fit in memory; with out_of_core: {} its peak is {}, "
+            "with {} on disk".format(
+                out_of_core,
+                format_bytes(fitted["peak"]),
+                format_bytes(fitted["on_disk"]),
+            )
+        )
+    else:
+        print(
+            "the run doesn't fit in memory, not even with all arrays out of core "
+            "(peak {}): use the cohort mode (cohort_dict.n_archetypes), or fewer "
+            "consumers, ticks or categories".format(format_bytes(fitted["peak"]))
+        )
+    if output_yaml is not None:
+        config["general_dict"]["out_of_core"] = out_of_core
+        with open(output_yaml, "w") as f:
+            yaml.safe_dump(config, f)
+        print("written to " + output_yaml)
+
+
+if __name__ == "__main__":
+    estimate_resources()
@@ -0,0 +1,584 @@
+"""
+Batched version of simulation.run: R replicates of the same configuration, differing only in
+seed_dict["overall_seed"], are simulated at once. Every state array gains a leading replicate
+axis and the phases of a tick work on all replicates together; every replicate draws from its
+own random number generator, in the same order as simulation.run does.
+
+Replicate r therefore gives exactly the same outputs as simulation.run with
+seed_dict["overall_seed"] = overall_seeds[r].
+
+What is shared between replicates (need profiles, datatypes of categories, privacy scores and
+concerns, data skills) is only computed and stored once.
+"""
+
+import numpy as np
+
+from .tracking import SimTracker
+from .setup_sim import setup_simulation
+from .simulation import early_stopping_enabled
+import model.innovation as inno
+import model.data_handling as data
+
+
+def _uniform(rngs, size):
+    """
+    (replicate, *size): draws of every replicate's rng
+    """
+    return np.stack([rng.uniform(size=size) for rng in rngs])
+
+
+def _uniform_rows(rngs, rows_per_replicate):
+    """
+    one draw per row, for rows that are grouped by replicate
+    """
+    return np.concatenate(
+        [rng.uniform(size=n) for rng, n in zip(rngs, rows_per_replicate)]
+    )
+
+
+def _choice(M, rands):
+    # see utils.multinomial
+    cumulative = np.cumsum(M, axis=-1)
+    smaller = (np.expand_dims(rands, axis=-1) < cumulative).astype(int)
+    return smaller.cumsum(axis=-1) == 1
+
+
+def _multinomial(M, rngs):
+    """
+    utils.multinomial for M with a leading replicate axis
+    """
+    return _choice(M, _uniform(rngs, M.shape[1:-1]))
+
+
+def _multinomial_rows(M, rngs, rows_per_replicate):
+    """
+    utils.multinomial for a 2d M with rows grouped by replicate
+    """
+    return _choice(M, _uniform_rows(rngs, rows_per_replicate))
+
+
+def _normalise_rows(M):
+    return np.nan_to_num(M / M.sum(axis=-1, keepdims=True))
+
+
+def _apply_data_skill(invest_data_value_base, data_combination_skill):
+    # see innovation.apply_data_skill
+    applicable = ((invest_data_value_base > 0).astype(int).sum(axis=-1) > 1).astype(int)
+    dcs = data_combination_skill[None, :] * applicable
+    return invest_data_value_base.sum(axis=-1) * (1 + dcs)
+
+
+def run_batched(
+    n_replicates=None,
+    overall_seeds=None,
+    general_dict={},
+    seed_dict={},
+    util_weight_dict={},
+    innovation_dict={},
+    capital_dict={},
+    needs_dict={},
+    data_dict={},
+    category_dict={},
+    usage_dict={},
+    port_dict={},
+    privacy_dict={},
+    scenario_dict={},
+    openness_dict={},
+    output_dict={},
+    stopping_dict={},
+    cohort_dict={},
+):
+    """
+    Runs the simulation for several seeds at once, takes the same parameters as simulation.run
+    overall_seeds: the overall_seed of every replicate. By default, n_replicates seeds counting
+    up from seed_dict["overall_seed"]
+    returns a list with the outputs of every replicate
+    """
+    assert not early_stopping_enabled(
+        stopping_dict
+    ), "early stopping is not supported in batched runs, all replicates run every tick"
+    assert (
+        seed_dict.get("rng_mode", "legacy") == "legacy"
+    ), "batched runs only support the legacy rng_mode"
+    assert not (
+        cohort_dict and cohort_dict.get("n_archetypes")
+    ), "batched runs don't support the cohort mode"
+    assert not general_dict.get(
+        "out_of_core"
+    ), "batched runs keep all arrays in memory, out_of_core is not supported"
+    assert not general_dict.get(
+        "profile"
+    ), "batched runs are not profiled, run the replicates one by one to profile them"
+    if overall_seeds is None:
+        overall_seeds = [
+            (seed_dict["overall_seed"] + r) % 2**32 for r in range(n_replicates)
+        ]
+    n_reps = len(overall_seeds)
+    rngs = [np.random.RandomState(seed=seed) for seed in overall_seeds]
+
+    # unpacking some general parameters
+    n_ticks = general_dict["n_ticks"]
+    n_consumers = general_dict["n_consumers"]
+    n_init_firms = general_dict["n_init_firms"]
+    w_logit = util_weight_dict["w_logit"]
+    alpha_usage_decay = usage_dict["alpha_usage_decay"]
+    data_worth_exp = data_dict["data_worth_exp"]
+    qual_diff_param = innovation_dict["qual_diff_param"]
+    inno_low = innovation_dict["success_invest_low"]
+    inno_high = innovation_dict["success_invest_high"]
+    inno_new_prod_alpha = innovation_dict["new_product_scaler_alpha"]
+    new_firm_new_category_prob = innovation_dict["new_firm_new_category_prob"]
+
+    # setting the scene: only the consumer wealth depends on the overall seed, all the
+    # rest is the same for every replicate
+    setup_dict = setup_simulation(
+        general_dict,
+        seed_dict,
+        rngs[0],
+        capital_dict,
+        needs_dict,
+        data_dict,
+        category_dict,
+        privacy_dict,
+        openness_dict,
+        innovation_dict,
+    )
+
+    def per_replicate(x):
+        if not x.any():
+            # allocating zeros is much cheaper than copying them
+            return np.zeros((n_reps,) + x.shape, dtype=x.dtype)
+        return np.stack([x] * n_reps)
+
+    consumer_wealth = np.stack(
+        [setup_dict["consumer_wealth"]]
+        + [1 + rng.uniform(size=n_consumers) * 9 for rng in rngs[1:]]
+    )
+    # shared between replicates
+    need_matrix = setup_dict["need_matrix"]
+    category_datatype = setup_dict["category_datatype"]
+    n_datatypes = category_datatype.shape[1]
+    data_combination_skill = setup_dict["data_combination_skill"]
+    consumer_privacy_concern = setup_dict["consumer_privacy_concern"]
+    # (replicate, ...)
+    capital = per_replicate(setup_dict["capital"])
+    ticks_no_capital = per_replicate(setup_dict["ticks_no_capital"])
+    ticks_no_usage = per_replicate(setup_dict["ticks_no_usage"])
+    quality = per_replicate(setup_dict["quality"])
+    firm_privacy_score = per_replicate(setup_dict["firm_privacy_score"])
+    F_alive = per_replicate(setup_dict["F_alive"])
+    firm_investment_profile = per_replicate(setup_dict["firm_investment_profile"])
+    usage_counter = per_replicate(setup_dict["usage_counter"])
+    requestable = per_replicate(setup_dict["requestable"])
+    portability_matrix = per_replicate(setup_dict["portability_matrix"])
+    data_value = per_replicate(setup_dict["data_value"])
+    data_held = per_replicate(setup_dict["data_held"])
+    privacy_mask = per_replicate(setup_dict["privacy_mask"])
+    uninterrupted_usage = np.zeros_like(usage_counter)
+    del setup_dict
+
+    n_total_firms = capital.shape[1]
+    n_total_categories = category_dict["n_total_categories"]
+    reps = np.arange(n_reps)
+    i_alive = np.ones(n_reps, dtype=int) * n_init_firms
+    cat_ever_alive = (quality.sum(axis=1) > 0).astype(int)
+    category_total_usage = np.zeros((n_reps, n_total_categories))
+    category_ticks_alive = (quality.sum(axis=1) > 0).astype(int)
+
+    # setting up the trackers
+    trackers = []
+    for r in reps:
+        tracker = SimTracker(
+            n_ticks,
+            n_total_firms,
+            n_total_categories,
+            n_consumers,
+            quality[r],
+            capital_dict["small"],
+        )
+        tracker.add_needs(need_matrix)
+        trackers.append(tracker)
+
+    scen_tick = -1
+    if scenario_dict:
+        scen_tick = scenario_dict["scen_tick"]
+
+    for tick in np.arange(0, n_ticks):
+
+        # SCENARIO
+        if tick == scen_tick:
+            # the scenario rng is the same for every replicate
+            scen_rng = np.random.RandomState(seed_dict["scenario_seed"])
+            firm_list = np.argsort(capital, axis=1)[
+                :, -scenario_dict["scen_number_of_firms"] :
+            ]
+            firm_privacy_score[reps[:, None], firm_list] = np.maximum(
+                firm_privacy_score[reps[:, None], firm_list]
+                - scenario_dict["firm_hit"],
+                0.05,
+            )
+            consumer_privacy_concern += scen_rng.normal(
+                scenario_dict["consumer_hit_mean"],
+                scenario_dict["consumer_hit_var"],
+                size=n_consumers,
+            )
+            # (replicate, consumer, firm)
+            data_deleters = np.zeros((n_reps, n_consumers, n_total_firms))
+            data_deleters[
+                reps[:, None, None],
+                np.arange(n_consumers)[None, :, None],
+                firm_list[:, None, :],
+            ] = (
+                scen_rng.uniform(size=(n_consumers, firm_list.shape[1]))
+                < consumer_privacy_concern[:, None]
+            ).astype(
+                int
+            )[
+                None, :, :
+            ]
+            # see privacy_scenario.delete_data
+            data_to_be_del = data_held * data_deleters[:, None, :, None, :, None]
+            data_held -= data_to_be_del
+            data_value_lost = (
+                data_to_be_del[:, :tick]
+                * np.power(np.exp(-data_worth_exp), np.arange(tick)[::-1])[
+                    None, :, None, None, None, None
+                ]
+            )
+            data_value -= data_value_lost.sum(axis=1)
+            del data_to_be_del, data_value_lost
+            privacy_mask *= 1 - data_deleters
+
+        if tick > 0:
+            # BIRTH OF NEW FIRMS
+            # firm-level and cheap, so done for one replicate at a time
+            num_new_firms_ = np.zeros(n_reps, dtype=int)
+            for r in reps:
+                rng = rngs[r]
+                num_new_firms = rng.poisson(general_dict["birth_lambda"])
+                n_new = np.minimum(num_new_firms, n_total_firms - i_alive[r])
+                num_new_firms_[r] = n_new
+                if n_new > 0:
+                    first = i_alive[r]
+                    F_alive[r, first : (first + n_new)] = 1
+                    capital[r, first : (first + n_new)] = capital_dict["small"]
+                    remaining_categories = (cat_ever_alive[r] == 0).astype(int).sum()
+                    new_category_count = np.minimum(
+                        np.sum(rng.uniform(size=n_new) < new_firm_new_category_prob),
+                        remaining_categories,
+                    )
+                    quality[
+                        r,
+                        first + np.arange(new_category_count),
+                        np.where(cat_ever_alive[r] == 0)[0][:new_category_count],
+                    ] = 1
+                    existing_category_count = n_new - new_category_count
+                    if existing_category_count > 0:
+                        quality[
+                            r,
+                            first
+                            + new_category_count
+                            + np.arange(existing_category_count),
+                        ] += inno.enter_new_category(
+                            quality[r],
+                            category_datatype,
+                            None,
+                            category_total_usage[r],
+                            category_ticks_alive[r],
+                            innovation_dict,
+                            qual_diff_param,
+                            rng,
+                            n=existing_category_count,
+                        )
+                    ticks_no_usage[r, first : (first + n_new)] = 0
+                    ticks_no_capital[r, first : (first + n_new)] = 0
+                    i_alive[r] += n_new
+                    cat_ever_alive[r] = (
+                        (cat_ever_alive[r] + quality[r].sum(axis=0)) > 0
+                    ).astype(int)
+
+            # DEATH OF FIRMS
+            death_mask = (
+                (ticks_no_usage > general_dict["no_usage_ticks_before_death"])
+                | (ticks_no_capital > general_dict["no_money_ticks_before_death"])
+            ) & F_alive.astype(bool)
+            num_dead_firms = death_mask.astype(int).sum(axis=1)
+            F_alive[death_mask] = 0
+            quality[death_mask] = 0
+            dead_rep, dead_firm = np.where(death_mask)
+            portability_matrix[dead_rep, dead_firm] = 0
+            portability_matrix[dead_rep, :, :, dead_firm] = 0
+            requestable[dead_rep, dead_firm] = 0
+            requestable[dead_rep, :, :, dead_firm] = 0
+
+            # REQUESTING DATA RIGHTS
+            A = (quality > 0).astype(int)
+            requestable_now = np.zeros_like(requestable, dtype=np.int8)
+            for r in reps:
+                A_where_0, A_where_1 = np.where(A[r])
+                requestable_now[r] = data.numba_calc_avail_now(
+                    requestable[r], A_where_0, A_where_1
+                )
+            # (replicate, firm requesting, datatype)
+            firm_dt_avail_for_request = (
+                requestable_now.sum(axis=(2, 3, 4)) > 0
+            ).astype(int)
+            firm_datatype = (
+                A[:, :, :, None] * category_datatype[None, None, :, :]
+            ).sum(axis=2)
+            firm_datatype *= firm_dt_avail_for_request
+            firm_dt_choice = _multinomial(_normalise_rows(firm_datatype), rngs)
+            firm_dt_choice[firm_dt_choice.sum(axis=-1) == 0, 0] = 1
+            # from here on every row is a (replicate, requesting firm) with one choice
+            rep_dt, r_dt, c_dt = np.where(firm_dt_choice)
+            rows_per_rep = np.bincount(rep_dt, minlength=n_reps)
+            firm_firm_avail = (
+                requestable_now[rep_dt, r_dt, :, :, :, c_dt].sum(axis=(1, 3)) > 0
+            ).astype(int)
+            firm_firm_choice = _multinomial_rows(
+                _normalise_rows(firm_firm_avail), rngs, rows_per_rep
+            )
+            firm_firm_choice[firm_firm_choice.sum(axis=-1) == 0, 0] = 1
+            c_f = np.where(firm_firm_choice)[1]
+            firm_cat_from_avail = (
+                requestable_now[rep_dt, r_dt, :, c_f, :, c_dt].sum(axis=1) > 0
+            ).astype(int)
+            firm_cat_from_choice = _multinomial_rows(
+                _normalise_rows(firm_cat_from_avail), rngs, rows_per_rep
+            )
+            firm_cat_from_choice[firm_cat_from_choice.sum(axis=-1) == 0, 0] = 1
+            c_cf = np.where(firm_cat_from_choice)[1]
+            firm_cat_to_avail = requestable_now[rep_dt, r_dt, :, c_f, c_cf, c_dt]
+            firm_cat_to_choice = _multinomial_rows(
+                _normalise_rows(firm_cat_to_avail), rngs, rows_per_rep
+            )
+            firm_cat_to_choice[firm_cat_to_choice.sum(axis=-1) == 0, 0] = 1
+            c_ct = np.where(firm_cat_to_choice)[1]
+            # drop the requests that were made up for firms that can't request anything
+            request_mask = requestable_now[rep_dt, r_dt, c_ct, c_f, c_cf, c_dt] == 1
+            rep_r, r_ct, c_ct, c_f, c_cf, c_dt = [
+                x[request_mask] for x in [rep_dt, r_dt, c_ct, c_f, c_cf, c_dt]
+            ]
+            del requestable_now
+
+            # GRANTING/DENYING DATA RIGHTS
+            # see data.calculate_granting_probs
+            frac_overlap = np.nan_to_num(
+                (A[rep_r, r_ct] * A[rep_r, c_f]).sum(axis=-1)
+                / A[rep_r, c_f].sum(axis=1)
+            )
+            granting_probs = (
+                openness_dict["openness_lower"]
+                + (openness_dict["openness_upper"] - openness_dict["openness_lower"])
+                * frac_overlap
+            )
+            granted_mask = (
+                _uniform_rows(rngs, np.bincount(rep_r, minlength=n_reps))
+                < granting_probs
+            )
+            rep_g, r_ct_g, c_ct_g, c_f_g, c_cf_g, c_dt_g = [
+                x[granted_mask] for x in [rep_r, r_ct, c_ct, c_f, c_cf, c_dt]
+            ]
+            requestable[rep_r, r_ct, c_ct, c_f, c_cf, c_dt] = 0
+            portability_matrix[rep_g, r_ct_g, c_ct_g, c_f_g, c_cf_g, c_dt_g] = 1
+
+            # INNOVATION IN EXISTING FIRMS
+            capital_to_invest = np.maximum(
+                np.minimum(capital, innovation_dict["invest_cap"]), 0
+            )
+            capital = capital - capital_to_invest
+            # (the profile is adjusted in place, as in simulation.run)
+            firm_investment_profile_ = firm_investment_profile
+            # quality[:, cat_ever_alive] for every replicate
+            quality_cat_ever_alive = quality[
+                reps[:, None, None],
+                np.arange(n_total_firms)[None, :, None],
+                cat_ever_alive[:, None, :],
+            ]
+            all_categories = (quality_cat_ever_alive == 0).sum(axis=-1) == 0
+            firm_investment_profile_[all_categories, 1] = 0
+            firm_investment_profile_[all_categories, 2] = (
+                1 - firm_investment_profile_[all_categories, 0]
+            )
+            firm_investment_profile_[:, :, -1] *= (
+                1
+                - (cat_ever_alive.sum(axis=1) == n_total_categories).astype(int)[
+                    :, None
+                ]
+            )
+            firm_investment_profile_ = (
+                firm_investment_profile_
+                / firm_investment_profile_.sum(axis=-1, keepdims=True)
+            )
+            investment_choice = (
+                _multinomial(firm_investment_profile_, rngs) * F_alive[:, :, None]
+            )
+
+            # Existing product that investment will be in
+            invest_prob = np.stack(
+                [
+                    inno.invest_utility_existing(
+                        quality[r], category_total_usage[r], tick, innovation_dict
+                    )
+                    for r in reps
+                ]
+            )
+            invest_product = (
+                _multinomial(invest_prob, rngs) * investment_choice[:, :, 0][:, :, None]
+            )
+            # (replicate, firm, datatypes): the investment only involves datatypes that
+            # are relevant, so the data value can be summed over consumers and categories
+            # once for both types of investment
+            data_value_firm = data_value.sum(axis=(1, 2))
+            rel_datatypes = invest_product.dot(category_datatype)
+            invest_data_value = _apply_data_skill(
+                rel_datatypes * data_value_firm, data_combination_skill
+            )
+            investment = inno.investment_scaler(
+                capital_to_invest * invest_data_value, 0, 1, inno_new_prod_alpha
+            )
+            alpha_f = innovation_dict["alpha_f"]
+            extra_quality = (
+                inno.F(
+                    inno.F_inverse(quality, alpha_f) + investment[:, :, None], alpha_f
+                )
+                - quality
+            )
+            quality += extra_quality * invest_product
+
+            # Firms going into a category they haven't developed before
+            potential_added_quality = np.stack(
+                [
+                    inno.enter_new_category(
+                        quality[r],
+                        category_datatype,
+                        investment_choice[r][:, 1:],
+                        category_total_usage[r],
+                        category_ticks_alive[r],
+                        innovation_dict,
+                        qual_diff_param,
+                        rngs[r],
+                    )
+                    for r in reps
+                ]
+            )
+            assert (potential_added_quality * quality == 0).all()
+            rel_datatypes = (potential_added_quality > 0).dot(category_datatype)
+            invest_data_value = _apply_data_skill(
+                rel_datatypes * data_value_firm, data_combination_skill
+            )
+            investment = inno.investment_scaler(
+                capital_to_invest * invest_data_value,
+                inno_low,
+                inno_high,
+                inno_new_prod_alpha,
+            )
+            success = (
+                (_uniform(rngs, n_total_firms) < investment).astype(int)
+                * investment_choice[:, :, 1:].sum(axis=-1)
+                * F_alive
+            )
+            quality += potential_added_quality * success[:, :, None]
+            cat_ever_alive = ((cat_ever_alive + quality.sum(axis=1)) > 0).astype(int)
+
+        # CONSUMERS USING A PRODUCT
+        # (replicate, consumer, category)
+        usage_product_mask = (
+            need_matrix[None, :, :] > _uniform(rngs, need_matrix.shape)
+        ).astype(int) * (quality.sum(axis=1) > 0).astype(int)[:, None, :]
+        # utility (replicate, consumer, category, firm), see utility.utility_for_consumers
+        utility_ = (
+            util_weight_dict["w_qual"] * np.transpose(quality, (0, 2, 1))[:, None, :, :]
+            + util_weight_dict["w_loyal_category"] * usage_counter
+            + util_weight_dict["w_loyal_firm"]
+            * usage_counter.sum(axis=2)[:, :, None, :]
+            - util_weight_dict["w_priv"]
+            * consumer_privacy_concern[None, :, None, None]
+            * (1 - firm_privacy_score)[:, None, None, :]
+        )
+        # choosing a firm, see utility.choose_firms
+        market_matrix = np.transpose((quality > 0).astype(int), (0, 2, 1))
+        U_exp = (
+            np.exp(w_logit * utility_)
+            * market_matrix[:, None, :, :]
+            * privacy_mask[:, :, None, :]
+        )
+        prob = np.nan_to_num(U_exp / np.nansum(U_exp, axis=-1, keepdims=True))
+        usage_firm = _multinomial(prob, rngs)
+        del utility_, U_exp, prob
+        usage = usage_firm * usage_product_mask[:, :, :, None].astype(int)
+
+        # BOOKKEEPING: CUSTOMER DATA + PAYMENT
+        prod_per_consumer = np.maximum(usage.sum(axis=(2, 3)), 1)
+        capital += (
+            np.nan_to_num(consumer_wealth / prod_per_consumer)[:, :, None]
+            * usage.sum(axis=2)
+        ).sum(axis=1)
+        data_value *= np.exp(-data_worth_exp)
+        for r in reps:
+            usage_cons, usage_cat, usage_firm = np.where(usage[r])
+            data.update_data_stuff(
+                data_held[r],
+                data_value[r],
+                usage_cons,
+                usage_cat,
+                usage_firm,
+                category_datatype,
+                tick,
+                n_datatypes,
+            )
+        has_used_mask = (usage.sum(axis=3, keepdims=True) > 0) * np.ones(
+            n_total_firms
+        ).astype(bool)[None, None, None, :]
+        uninterrupted_usage[has_used_mask] *= usage[has_used_mask]
+        uninterrupted_usage[has_used_mask] += usage[has_used_mask]
+        usage_counter *= np.exp(-alpha_usage_decay)
+        usage_counter += usage
+        category_total_usage += usage.sum(axis=(1, 3))
+        category_ticks_alive[quality.sum(axis=1) > 0] += 1
+
+        # PORTING
+        rep_, cons_, cat_, firm_ = np.where(uninterrupted_usage == port_dict["n_port"])
+        for r in np.unique(rep_):
+            is_r = rep_ == r
+            PM = np.swapaxes(portability_matrix[r][firm_[is_r], cat_[is_r]], 1, 2) * (
+                data_value[r][cons_[is_r]] > 0
+            ).astype(int)
+            if PM.sum() > 0:
+                data.port(
+                    cons_[is_r],
+                    cat_[is_r],
+                    firm_[is_r],
+                    data_held[r],
+                    data_value[r],
+                    tick,
+                    PM,
+                )
+
+        # update no usage/no capital trackers
+        firm_usage = usage.sum(axis=(1, 2))
+        ticks_no_usage[firm_usage == 0] += 1
+        ticks_no_usage[firm_usage > 0] = 0
+        ticks_no_capital[capital < capital_dict["capital_cutoff"]] += 1
+        ticks_no_capital[capital >= capital_dict["capital_cutoff"]] = 0
+
+        for r in reps:
+            trackers[r].update(
+                tick,
+                (
+                    quality[r],
+                    capital[r],
+                    usage[r],
+                    0 if tick == 0 else num_new_firms_[r],
+                    0 if tick == 0 else num_dead_firms[r],
+                    F_alive[r],
+                    0 if tick == 0 else investment_choice[r],
+                    0 if tick == 0 else success[r],
+                    consumer_privacy_concern,
+                    firm_privacy_score[r],
+                    0 if tick == 0 else r_ct_g[rep_g == r],
+                    0 if tick == 0 else capital_to_invest[r] * invest_data_value[r],
+                ),
+            )
+    outputs = output_dict.get("outputs")
+    return [tracker.gather_output(outputs) for tracker in trackers]
@@ -3,8 +3,6 @@ Helpful stuff re beta distributions
 characterized by mode and variance
 """
 
-from scipy import optimize
-
 
 def sd_fun(var, m):
     """
@@ -27,6 +25,8 @@ def get_beta_params(m, var):
     m = mode
     var = variance
     """
+    from scipy import optimize
+
     a = optimize.brenth(sd_fun(var, m), 1, 1000)
     b = a * (1 - m) / m - 1 / m + 2
     return a, b
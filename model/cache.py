@@ -0,0 +1,254 @@
+"""
+A content-addressed cache of the outputs of simulation runs on local disk, so that a run
+with the same parameters as an earlier one (in a notebook, a rerun of run_simulation.py
+or an overlapping sweep) returns the stored outputs instead of simulating again.
+
+A run is keyed by a hash of its parameters, the dicts passed to simulation.run in a
+canonical form, and of a fingerprint of the model code: the source of the model package
+and the versions of numpy and numba, as the random draws depend on them. Any change to
+the code gives new keys. Left out of the key are the settings that only change how a
+run is executed, not its outputs (EXECUTION_KEYS), and output_dict: an entry serves any
+request for outputs it has. Profiled runs (general_dict["profile"], see profiling.py) are
+never cached: their timings are measurements of the run, not outputs of its parameters.
+
+Every entry is a directory <cache_dir>/<key> with the outputs in the format of
+storage.py, and an entry.json with the parameters it was made with. It is written to a
+temporary directory and renamed into place, so concurrent runs (e.g. the workers of a
+sweep) never see half an entry. A hit marks the entry as used, and when the entries
+are larger than max_gb together the least recently used ones are evicted.
+"""
+
+import copy
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .storage import save_results, load_results, has_results, stored_outputs
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "DATA_SHARING_ABM_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "data-sharing-abm"),
+)
+DEFAULT_MAX_GB = 5
+
+# parameters that don't change the outputs of a run
+EXECUTION_KEYS = {
+    "general_dict": [
+        "n_threads",
+        "n_shards",
+        "out_of_core",
+        "scratch_dir",
+        "preflight",
+        "memory_limit",
+    ],
+}
+ENTRY = "entry.json"
+
+_code_version = None
+
+
+def _plain(x):
+    """
+    numpy scalars to python types, for json
+    """
+    return x.item() if isinstance(x, np.generic) else x
+
+
+def code_version():
+    """
+    fingerprint of the model code: a hash of the source of the model package, and the
+    numpy and numba versions
+    """
+    global _code_version
+    if _code_version is None:
+        import numba
+
+        digest = hashlib.sha256()
+        digest.update(
+            "numpy {} numba {}".format(np.__version__, numba.__version__).encode()
+        )
+        package = os.path.dirname(os.path.abspath(__file__))
+        for path in sorted(glob.glob(os.path.join(package, "*.py"))):
+            digest.update(os.path.basename(path).encode())
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        _code_version = digest.hexdigest()[:16]
+    return _code_version
+
+
+def canonical_params(params):
+    """
+    the parameters of a run that determine its outputs
+    """
+    params = {k: v for k, v in params.items() if k != "output_dict"}
+    for section, keys in EXECUTION_KEYS.items():
+        if section in params:
+            params[section] = {
+                k: v for k, v in params[section].items() if k not in keys
+            }
+    return params
+
+
+def run_key(params):
+    """
+    the key of a run of params in the cache
+    """
+    canonical = json.dumps(
+        {"params": canonical_params(params), "code": code_version()},
+        sort_keys=True,
+        default=_plain,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+
+def cacheable(params):
+    """
+    whether the outputs of a run of params may be cached: not if it is profiled
+    """
+    return not (params.get("general_dict") or {}).get("profile", False)
+
+
+def _requested(params):
+    outputs = (params.get("output_dict") or {}).get("outputs")
+    return None if outputs in (None, "all") else list(outputs)
+
+
+class ResultCache(object):
+    """
+    the outputs of runs, stored in cache_dir under the key of their parameters; see the
+    top of this module
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_gb=DEFAULT_MAX_GB):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_gb * 1e9
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path(self, params):
+        return os.path.join(self.cache_dir, run_key(params))
+
+    def get(self, params):
+        """
+        the stored outputs of a run of params (memory-mapped), or None if they are not
+        in the cache. A hit needs all the outputs asked for in output_dict
+        """
+        if not cacheable(params):
+            return None
+        path = self.path(params)
+        if not has_results(path):
+            return None
+        try:
+            with open(os.path.join(path, ENTRY)) as f:
+                stored_all = json.load(f)["outputs"] is None
+            outputs = _requested(params)
+            if outputs is None and not stored_all:
+                return None
+            if outputs is not None and not set(outputs) <= set(stored_outputs(path)):
+                return None
+            # the time of the last use, for the eviction
+            os.utime(os.path.join(path, ENTRY))
+            return load_results(path, outputs=outputs)
+        except (OSError, ValueError):
+            # evicted or replaced by another process meanwhile
+            return None
+
+    def put(self, params, results):
+        """
+        stores the outputs results of a run of params, replacing an older entry, and
+        evicts the least recently used entries if the cache is too large. Runs that
+        aren't cacheable are not stored
+        """
+        if not cacheable(params):
+            return
+        path = self.path(params)
+        tmp = None
+        try:
+            tmp = tempfile.mkdtemp(prefix=".tmp_", dir=self.cache_dir)
+            save_results(results, tmp)
+            with open(os.path.join(tmp, ENTRY), "w") as f:
+                json.dump(
+                    {
+                        "params": canonical_params(params),
+                        "outputs": _requested(params),
+                        "code": code_version(),
+                    },
+                    f,
+                    default=_plain,
+                )
+            shutil.rmtree(path, ignore_errors=True)
+            os.rename(tmp, path)
+        except OSError:
+            # another process stored it at the same time, or the cache isn't writable
+            pass
+        finally:
+            if tmp is not None:
+                shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def invalidate(self, params):
+        """
+        removes the entry of a run of params
+        """
+        shutil.rmtree(self.path(params), ignore_errors=True)
+
+    def clear(self):
+        """
+        removes all entries
+        """
+        for key, _, _ in self.entries():
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+
+    def entries(self):
+        """
+        (key, bytes, time of last use) of every entry, the least recently used first
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, key)
+            if key.startswith(".") or not has_results(path):
+                continue
+            try:
+                size = sum(
+                    os.path.getsize(os.path.join(path, x)) for x in os.listdir(path)
+                )
+                entries.append((key, size, os.path.getmtime(os.path.join(path, ENTRY))))
+            except OSError:
+                continue
+        return sorted(entries, key=lambda x: x[2])
+
+    def evict(self):
+        """
+        removes the least recently used entries until the cache fits in max_gb
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            total -= size
+
+
+def cached_run(cache=None, refresh=False, **params):
+    """
+    simulation.run(**params), with the outputs from cache (a ResultCache, by default in
+    DEFAULT_CACHE_DIR) if a run of params is in it. Otherwise, or with refresh, the run is
+    simulated and stored in the cache
+    """
+    from .simulation import run
+
+    if cache is None:
+        cache = ResultCache()
+    if not refresh:
+        results = cache.get(params)
+        if results is not None:
+            return results
+    results = run(**copy.deepcopy(params))
+    cache.put(params, results)
+    return results
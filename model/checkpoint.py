@@ -0,0 +1,211 @@
+"""
+Checkpoints of a simulation run, and scenario branches forked from a shared checkpoint.
+
+A checkpoint is the complete state of a Simulation before a tick is run: all arrays, the
+random number generator and the tracker. Resuming from it gives exactly the same outputs
+as running from the start. All variants of the privacy scenario share the history before
+the shock, so fork_scenarios runs that part once and only runs the ticks from the shock
+onwards for every branch.
+"""
+
+import copy
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+
+from .cache import run_key
+from .simulation import create_simulation, early_stopping_enabled
+from .storage import save_results, has_results
+from .utils import set_parameter
+
+FORMAT_VERSION = 1
+
+
+def assert_checkpointable(general_dict):
+    """
+    checks that runs with general_dict can be checkpointed, before they start: the
+    consumers of a sharded run are in other processes, and a checkpoint would hold the
+    out_of_core arrays in memory, and load them into it
+    """
+    assert (
+        general_dict.get("n_shards", 1) <= 1
+    ), "sharded runs can't be checkpointed, set n_shards to 1"
+    assert not general_dict.get(
+        "out_of_core"
+    ), "runs with out_of_core arrays can't be checkpointed"
+
+
+def save_checkpoint(sim, path):
+    """
+    writes the state of the simulation sim to path
+    """
+    # also out of core if preflight moved arrays there
+    assert not sim.arrays.out_of_core, (
+        "runs with out_of_core arrays can't be checkpointed: "
+        + ", ".join(sim.arrays.out_of_core)
+    )
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    # write to a temporary file first, so an interrupted write doesn't leave a checkpoint
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(
+            {"format_version": FORMAT_VERSION, "tick": sim.tick, "simulation": sim},
+            f,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    os.replace(path + ".tmp", path)
+
+
+def load_checkpoint(path):
+    """
+    reads a Simulation from a checkpoint, ready to run its next tick
+    """
+    with open(path, "rb") as f:
+        checkpoint = pickle.load(f)
+    assert (
+        checkpoint["format_version"] == FORMAT_VERSION
+    ), "unsupported checkpoint format " + str(checkpoint["format_version"])
+    return checkpoint["simulation"]
+
+
+def checkpoint_path(directory, tick):
+    return os.path.join(directory, "tick_{}.pkl".format(tick))
+
+
+def run_with_checkpoints(sim, checkpoint_ticks, directory):
+    """
+    runs sim to the end, writing a checkpoint to <directory>/tick_<t>.pkl before every
+    tick t in checkpoint_ticks (n_ticks for the state after the last tick)
+    """
+    checkpoint_ticks = set(checkpoint_ticks)
+    while True:
+        if sim.tick in checkpoint_ticks:
+            save_checkpoint(sim, checkpoint_path(directory, sim.tick))
+        if sim.tick >= sim.n_ticks or sim.stop_reason is not None:
+            break
+        sim.step()
+    return sim.results(sim.output_dict.get("outputs"))
+
+
+def branch_config(base_config, overrides):
+    """
+    the parameters of a scenario branch: only the scenario and its seed can differ from
+    the base parameters, as the branches share everything before the scenario
+    """
+    config = copy.deepcopy(base_config)
+    for key, value in overrides.items():
+        assert key.startswith("scenario_dict.") or key == "seed_dict.scenario_seed", (
+            "a scenario branch can only change scenario_dict and "
+            "seed_dict.scenario_seed, not " + key
+        )
+        set_parameter(config, key, value)
+    return config
+
+
+def prefix_config(base_config, fork_tick):
+    """
+    the parameters of the shared history of scenario branches forking at fork_tick:
+    without a scenario, and with stopping rules that don't stop it before the fork, as
+    the runs of the branches don't stop before their scenario
+    """
+    config = dict(base_config, scenario_dict={})
+    stopping_dict = dict(base_config.get("stopping_dict") or {})
+    if early_stopping_enabled(stopping_dict):
+        min_ticks = stopping_dict.get("min_ticks", 0)
+        stopping_dict["min_ticks"] = max(min_ticks, fork_tick + 1)
+        config["stopping_dict"] = stopping_dict
+    return config
+
+
+def run_branch(checkpoint, run_dir, config):
+    """
+    continues the simulation in checkpoint (or runs it from the start if checkpoint is
+    None) with the scenario and stopping rules of config, and stores the outputs in
+    <run_dir>/results
+    """
+    if checkpoint is None:
+        sim = create_simulation(**copy.deepcopy(config))
+    else:
+        sim = load_checkpoint(checkpoint)
+        sim.set_scenario(config["scenario_dict"], config["seed_dict"]["scenario_seed"])
+        sim.stopping_dict = config.get("stopping_dict", {})
+    sim.run_until()
+    save_results(
+        sim.results(config.get("output_dict", {}).get("outputs")),
+        os.path.join(run_dir, "results"),
+    )
+    return run_dir
+
+
+def fork_scenarios(base_config, branches, output_dir, n_workers=None, verbose=True):
+    """
+    Runs every scenario branch in branches ({name: {dotted key: value}}, see
+    branch_config) of the base parameters. The ticks before the earliest scenario are
+    run once, and checkpointed to <output_dir>/checkpoints/<key of their parameters>
+    (see cache.py), so a change of the base parameters starts a new history; every
+    branch continues from
+    that checkpoint and stores its outputs in <output_dir>/<name>/results. With early
+    stopping, a branch without a scenario could stop before the fork, so it is run
+    from the start. Branches with stored outputs are skipped.
+    """
+    assert_checkpointable(base_config["general_dict"])
+    configs = {
+        name: branch_config(base_config, overrides)
+        for name, overrides in branches.items()
+    }
+    scen_ticks = [
+        config["scenario_dict"]["scen_tick"]
+        for config in configs.values()
+        if config["scenario_dict"]
+    ]
+    fork_tick = min(scen_ticks + [base_config["general_dict"]["n_ticks"]])
+
+    todo = []
+    for name, config in configs.items():
+        run_dir = os.path.join(output_dir, name)
+        if has_results(os.path.join(run_dir, "results")):
+            continue
+        if not os.path.exists(run_dir):
+            os.makedirs(run_dir)
+        with open(os.path.join(run_dir, "params.yaml"), "w") as f:
+            yaml.safe_dump(config, f)
+        todo.append((run_dir, config))
+    if verbose:
+        print(
+            "{} branches, {} already done, forking at tick {}".format(
+                len(configs), len(configs) - len(todo), fork_tick
+            )
+        )
+    if not todo:
+        return
+
+    prefix = prefix_config(base_config, fork_tick)
+    checkpoint = checkpoint_path(
+        os.path.join(output_dir, "checkpoints", run_key(prefix)), fork_tick
+    )
+    stopping = early_stopping_enabled(base_config.get("stopping_dict") or {})
+    checkpoints = [
+        None if stopping and not config["scenario_dict"] else checkpoint
+        for _, config in todo
+    ]
+    if checkpoint in checkpoints and not os.path.exists(checkpoint):
+        # the shared history: no scenario happens before fork_tick
+        sim = create_simulation(**prefix)
+        sim.run_until(fork_tick)
+        save_checkpoint(sim, checkpoint)
+
+    n_workers = n_workers or os.cpu_count() or 1
+    args = checkpoints, [d for d, _ in todo], [c for _, c in todo]
+    if n_workers <= 1:
+        finished = map(run_branch, *args)
+        for run_dir in finished:
+            if verbose:
+                print("done:", os.path.relpath(run_dir, output_dir))
+        return
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        for run_dir in pool.map(run_branch, *args):
+            if verbose:
+                print("done:", os.path.relpath(run_dir, output_dir))
@@ -0,0 +1,316 @@
+"""
+Cohort mode: a population of general_dict["n_consumers"] consumers simulated as weighted
+cohorts of identical consumers instead of individual agents.
+
+Consumers only differ in their needs, privacy concern, wealth and usage history. The
+population is split evenly over n_archetypes consumers drawn as in the individual mode.
+A cohort is a group of consumers of one archetype that share their usage history. Every
+tick, the number of members of a cohort that use each product is drawn as multinomial
+counts, and the members whose choices differ from the majority split off into a new
+cohort, which starts as a copy of its parent. Payments, data and usage totals of the
+firms are weighted by the number of members of the cohorts.
+
+The accuracy/cost knob:
+- max_cohorts: the number of cohorts that can be simulated. Time and memory grow with
+  max_cohorts, like with n_consumers in the individual mode, but do not depend on the
+  size of the population.
+- min_split: the number of members that must make the same other choice before they
+  split off. Smaller groups stay in the cohort, which then records the share of its
+  members using each product. Usage streaks (and so porting) follow the majority of a
+  cohort. In the privacy scenario, any members deleting their data split off while
+  there is room.
+With max_cohorts of at least n_consumers and min_split 1 every cohort is a single
+consumer, and the cohort mode samples the same model as the individual mode. Outputs on
+the level of consumers (concern_evo, and the consumer counts of firm_usage_df) are per
+archetype.
+"""
+
+import numpy as np
+
+from .simulation import Simulation
+from .tracking import SimTracker
+from .utility import utility_for_consumers, choice_probabilities
+from .privacy_scenario import delete_data
+
+# the arrays with a row per cohort, copied from the parent when a cohort splits
+# (data_held has the cohorts on its second axis)
+COHORT_STATE = [
+    "need_matrix",
+    "consumer_privacy_concern",
+    "consumer_wealth",
+    "usage",
+    "usage_counter",
+    "usage_counter_raw",
+    "uninterrupted_usage",
+    "data_value",
+    "privacy_mask",
+]
+
+
+class CohortSimulation(Simulation):
+    """
+    A Simulation of weighted cohorts of consumers, see the top of this module. The
+    consumer arrays have max_cohorts rows, of which the first n_cohorts are in use.
+    """
+
+    def __init__(self, general_dict={}, cohort_dict={}, **params):
+        self.population = general_dict["n_consumers"]
+        self.n_archetypes = cohort_dict["n_archetypes"]
+        self.max_cohorts = cohort_dict.get("max_cohorts") or 4 * self.n_archetypes
+        self.min_split = max(cohort_dict.get("min_split", 1), 1)
+        assert (
+            self.n_archetypes <= self.max_cohorts
+        ), "max_cohorts must be at least n_archetypes"
+        assert (
+            self.n_archetypes <= self.population
+        ), "n_archetypes can't be larger than n_consumers"
+        assert (
+            general_dict.get("n_threads", 1) == 1
+        ), "the cohort mode runs on a single thread"
+        # the consumers set up are the rows of the cohorts
+        super().__init__(
+            general_dict=dict(general_dict, n_consumers=self.max_cohorts),
+            cohort_dict=cohort_dict,
+            **params
+        )
+        # the needs of new cohorts are written to the rows of the shared needs
+        self.need_matrix = np.array(self.need_matrix)
+        # the population is divided evenly over the archetypes
+        self.counts = np.zeros(self.max_cohorts, dtype=np.int64)
+        self.counts[: self.n_archetypes] = self.population // self.n_archetypes
+        self.counts[: self.population % self.n_archetypes] += 1
+        self.archetype = np.arange(self.max_cohorts)
+        self.n_cohorts = self.n_archetypes
+
+    def make_tracker(self):
+        tracker = SimTracker(
+            self.n_ticks,
+            self.n_total_firms,
+            self.n_total_categories,
+            self.n_archetypes,
+            self.quality,
+            self.capital_dict["small"],
+        )
+        tracker.add_needs(self.need_matrix[: self.n_archetypes])
+        return tracker
+
+    def add_cohorts(self, parents):
+        """
+        new cohorts, copies of the cohorts parents; returns their rows. The caller sets
+        the number of members
+        """
+        rows = np.arange(self.n_cohorts, self.n_cohorts + len(parents))
+        for name in COHORT_STATE:
+            state = getattr(self, name)
+            state[rows] = state[parents]
+        self.data_held[:, rows] = self.data_held[:, parents]
+        self.archetype[rows] = self.archetype[parents]
+        self.n_cohorts += len(parents)
+        return rows
+
+    def split(self, x, room, min_split=None):
+        """
+        x: (group, outcome) members of every group with every outcome. Outcomes other
+        than the majority of a group with at least min_split (default self.min_split)
+        members split off into new groups, the largest first, up to room new groups.
+        Returns x with the new groups appended, and the group every new group split off
+        from
+        """
+        candidate = x >= (min_split or self.min_split)
+        candidate[np.arange(len(x)), x.argmax(axis=1)] = False
+        group, outcome = np.where(candidate)
+        if len(group) > room:
+            keep = np.sort(np.argsort(-x[group, outcome], kind="stable")[:room])
+            group, outcome = group[keep], outcome[keep]
+        new = np.zeros((len(group), x.shape[1]), dtype=x.dtype)
+        new[np.arange(len(group)), outcome] = x[group, outcome]
+        x[group, outcome] = 0
+        return np.concatenate([x, new]), group
+
+    def consumer_phases(self):
+        with self.profiler.phase("consumer_choice"):
+            self.consumers()
+        with self.profiler.phase("bookkeeping"):
+            self.bookkeeping()
+        with self.profiler.phase("porting"):
+            self.porting()
+
+    def consumers(self):
+        """
+        the share of the members of every cohort using each product in this tick. Per
+        category, the members using each firm are drawn as multinomial counts, and the
+        members choosing differently from the majority split off into new cohorts
+        """
+        rng = self.phase_rng("choice")
+        n = self.n_cohorts
+        exists = self.quality.sum(axis=0) > 0
+        need_prob = self.need_matrix[:n] * exists[None, :]
+        utility_ = utility_for_consumers(
+            self.quality,
+            self.usage[:n],
+            self.usage_counter[:n],
+            self.consumer_privacy_concern[:n],
+            self.firm_privacy_score,
+            self.util_weight_dict,
+        )
+        # (cohort, category, firm)
+        choice_prob = choice_probabilities(
+            utility_, self.quality, self.w_logit, self.privacy_mask[:n]
+        )
+        # the groups of members with the same choices so far, and their cohorts
+        parents = np.arange(n)
+        counts = self.counts[:n].copy()
+        usage = np.zeros((n,) + self.usage.shape[1:])
+        for cat in np.where(exists)[0]:
+            firms = np.where(self.quality[:, cat] > 0)[0]
+            # outcomes: every firm of the category, and not using the category
+            prob = np.zeros((len(parents), len(firms) + 1))
+            prob[:, :-1] = (
+                need_prob[parents, cat][:, None] * choice_prob[parents, cat][:, firms]
+            )
+            prob[:, -1] = np.maximum(1 - prob[:, :-1].sum(axis=1), 0)
+            x = multinomial_counts(counts, prob, rng)
+            x, group = self.split(x, self.max_cohorts - len(parents))
+            parents = np.concatenate([parents, parents[group]])
+            usage = np.concatenate([usage, usage[group]])
+            counts = x.sum(axis=1)
+            usage[:, cat, firms] = x[:, :-1] / np.maximum(counts, 1)[:, None]
+        self.add_cohorts(parents[n:])
+        self.counts[: self.n_cohorts] = counts
+        self.usage = np.zeros_like(self.usage)
+        self.usage[: self.n_cohorts] = usage
+
+    def bookkeeping(self):
+        """
+        payments, data collected from the cohorts and usage counters, weighted by the
+        number of members
+        """
+        tick = self.tick
+        n = self.n_cohorts
+        usage = self.usage[:n]
+        counts = self.counts[:n]
+        # agents uniformly distribute money over products consumers in tick
+        prod_per_consumer = np.maximum(usage.sum(axis=(1, 2)), 1)
+        revenue = (
+            (counts * self.consumer_wealth[:n] / prod_per_consumer)[:, None]
+            * usage.sum(axis=1)
+        ).sum(axis=0)
+        # data of the members that used a product, per member of the cohort
+        collected = usage[:, :, :, None] * self.category_datatype[None, :, None, :]
+        data_value = self.data_value[:n]
+        data_value *= np.exp(-self.data_worth_exp)
+        data_value += collected
+        self.data_held[tick, :n] = collected
+        # usage streaks follow the firm used by most members in a category
+        has_used = usage.sum(axis=2) >= 0.5
+        majority = np.zeros_like(usage)
+        cohort, cat = np.where(has_used)
+        majority[cohort, cat, usage[cohort, cat].argmax(axis=-1)] = 1
+        has_used_mask = has_used[:, :, None] * np.ones(self.n_total_firms).astype(bool)
+        uninterrupted_usage = self.uninterrupted_usage[:n]
+        uninterrupted_usage[has_used_mask] *= majority[has_used_mask]
+        uninterrupted_usage[has_used_mask] += majority[has_used_mask]
+        self.usage_counter_raw[:n] += usage
+        usage_counter = self.usage_counter[:n]
+        usage_counter *= np.exp(-self.alpha_usage_decay)
+        usage_counter += usage
+        member_usage = counts[:, None, None] * usage
+        self.firm_bookkeeping(
+            revenue, member_usage.sum(axis=(0, 2)), member_usage.sum(axis=(0, 1))
+        )
+
+    def porting(self):
+        self.port_data(slice(0, self.n_cohorts))
+
+    def data_value_per_firm(self):
+        n = self.n_cohorts
+        return np.tensordot(self.counts[:n], self.data_value[:n], axes=1).sum(axis=0)
+
+    def scenario(self):
+        """
+        the privacy shock: every cohort gets its own shock to its privacy concern, and
+        the members deleting their data at a shocked firm split off from the others
+        """
+        tick = self.tick
+        scen_rng = np.random.RandomState(self.seed_dict["scenario_seed"])
+        firm_list = np.argsort(self.capital)[
+            -self.scenario_dict["scen_number_of_firms"] :
+        ]
+        self.firm_privacy_score[firm_list] = np.maximum(
+            self.firm_privacy_score[firm_list] - self.scenario_dict["firm_hit"],
+            0.05,
+        )
+        n = self.n_cohorts
+        self.consumer_privacy_concern[:n] += scen_rng.normal(
+            self.scenario_dict["consumer_hit_mean"],
+            self.scenario_dict["consumer_hit_var"],
+            size=n,
+        )
+        # (cohort, firm): the share of the members that delete their data
+        data_deleters = np.zeros((self.max_cohorts, self.n_total_firms))
+        for firm in firm_list:
+            n = self.n_cohorts
+            counts = self.counts[:n]
+            deleting = scen_rng.binomial(
+                counts, np.clip(self.consumer_privacy_concern[:n], 0, 1)
+            )
+            # deleting for good is a lasting difference, so any minority splits off
+            x, group = self.split(
+                np.stack([deleting, counts - deleting], axis=1), self.max_cohorts - n, 1
+            )
+            rows = self.add_cohorts(group)
+            data_deleters[rows] = data_deleters[group]
+            data_deleters[rows, firm] = x[n:, 0] > 0
+            self.counts[rows] = x[n:].sum(axis=1)
+            self.counts[group] -= self.counts[rows]
+            data_deleters[:n, firm] = x[:n, 0] / np.maximum(x[:n].sum(axis=1), 1)
+        self.data_held, self.data_value = delete_data(
+            data_deleters,
+            self.data_held,
+            self.data_value,
+            tick,
+            self.data_worth_exp,
+        )
+        # the members deleting their data never use the firm again; where not all of
+        # them could split off, the cohort follows its majority
+        self.privacy_mask *= 1 - (data_deleters > 0.5)
+
+    def tracked_consumers(self):
+        """
+        the usage of all members and the mean privacy concern, per archetype
+        """
+        n = self.n_cohorts
+        archetype = self.archetype[:n]
+        counts = self.counts[:n]
+        usage = np.zeros((self.n_archetypes,) + self.usage.shape[1:])
+        np.add.at(usage, archetype, counts[:, None, None] * self.usage[:n])
+        members = np.bincount(archetype, weights=counts, minlength=self.n_archetypes)
+        concern = (
+            np.bincount(
+                archetype,
+                weights=counts * self.consumer_privacy_concern[:n],
+                minlength=self.n_archetypes,
+            )
+            / members
+        )
+        return usage, concern
+
+
+def multinomial_counts(n, prob, rng):
+    """
+    (group, outcome): n[group] draws of the outcomes with the probabilities prob, as a
+    chain of binomial draws. The last outcome gets the remaining draws
+    """
+    x = np.zeros(prob.shape, dtype=np.int64)
+    left = n.copy()
+    mass = np.ones(len(n))
+    for j in range(prob.shape[1] - 1):
+        share = np.divide(
+            prob[:, j], mass, out=np.zeros(len(n)), where=mass > prob[:, j]
+        )
+        share[mass <= prob[:, j]] = 1
+        x[:, j] = rng.binomial(left, np.clip(share, 0, 1))
+        left -= x[:, j]
+        mass -= prob[:, j]
+    x[:, -1] = left
+    return x
@@ -2,7 +2,7 @@ from numba import jit
 import numpy as np
 
 
-@jit(nopython=True)
+@jit(nopython=True, nogil=True, cache=True)
 def port(cons_, cat_, firm_, data_held, data_value, tick, PM):
     """
     cons_, cat_, firm_: whichi consumers are porting to which categories in which firms
@@ -32,14 +32,46 @@ def port(cons_, cat_, firm_, data_held, data_value, tick, PM):
     return data_held, data_value
 
 
-@jit(nopython=True)
+@jit(nopython=True, nogil=True, cache=True)
+def port_tick_major(cons_, cat_, firm_, data_held, data_value, tick, PM):
+    """
+    port, with the ticks as the outer loop: every tick of data_held is read and written
+    in one pass over the ports, for a data_held in a memory-mapped file. Gives the same
+    results as port for data_held of zeros and ones
+    """
+    _, n_categories, n_firms, n_datatypes = data_value.shape
+    for i_t in np.arange(tick):
+        for i in np.arange(len(cons_)):
+            cons, cat_to, firm_to = cons_[i], cat_[i], firm_[i]
+            for i_firm in np.arange(n_firms):
+                for i_cat in np.arange(n_categories):
+                    for i_dt in np.arange(n_datatypes):
+                        if (
+                            PM[i, i_cat, i_firm, i_dt] == 1
+                            and data_held[i_t, cons, cat_to, firm_to, i_dt] == 0
+                        ):
+                            held = data_held[i_t, cons, i_cat, i_firm, i_dt]
+                            data_held[i_t, cons, cat_to, firm_to, i_dt] = held
+                            data_value[cons, cat_to, firm_to, i_dt] += held
+    return data_held, data_value
+
+
+@jit(nopython=True, cache=True)
 def numba_calc_avail_now(requestable, A_where_0, A_where_1):
     """
     caluclates: requestable_now = requestable * A[:, :, None, None, None] * A[None, None, :, :, None]
     """
+    out = np.zeros_like(requestable, dtype=np.int8)
+    return numba_fill_avail_now(requestable, A_where_0, A_where_1, out)
+
+
+@jit(nopython=True, cache=True)
+def numba_fill_avail_now(requestable, A_where_0, A_where_1, out):
+    """
+    numba_calc_avail_now, writing to out (all zeros, e.g. a memory-mapped file)
+    """
     s0, s1, s2, s3, s4 = requestable.shape
     k = len(A_where_0)
-    out = np.zeros_like(requestable, dtype=np.int8)
     for i in np.arange(k):
         for j in np.arange(k):
             for i_dt in np.arange(s4):
@@ -55,7 +87,7 @@ def numba_calc_avail_now(requestable, A_where_0, A_where_1):
     return out
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def numba_mask_impossible_requests(r_ct, c_ct, c_f, c_cf, c_dt, requestable_now):
     """
     creates a mask of requests that are legitamate according to requestable_now.
@@ -76,7 +108,7 @@ def calculate_granting_probs(r_ct, c_f, A, low, hi):
     return low + (hi - low) * frac_overlap
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def numba_update_requestable(requestable, r_ct, c_ct, c_f, c_cf, c_dt):
     """
     calculates: requestable *= (1 - request)
@@ -86,7 +118,7 @@ def numba_update_requestable(requestable, r_ct, c_ct, c_f, c_cf, c_dt):
     return requestable
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def numba_update_portability_matrix(
     portability_matrix, r_ct_g, c_ct_g, c_f_g, c_cf_g, c_dt_g
 ):
@@ -98,7 +130,7 @@ def numba_update_portability_matrix(
     return portability_matrix
 
 
-@jit(nopython=True)
+@jit(nopython=True, nogil=True, cache=True)
 def update_data_stuff(
     data_held,
     data_value,
@@ -0,0 +1,298 @@
+"""
+Ensembles: statistics of the outputs of many runs of a configuration (different seeds),
+folded in one run at a time, so that memory doesn't grow with the number of runs.
+
+Every output in ENSEMBLE_OUTPUTS is turned into an array per run: a timeline (tick, or
+tick and category/column) or a value per category. For every element the ensemble keeps
+the running mean and variance (Welford's algorithm, RunningStats) and a quantile sketch
+(QuantileSketch): a uniform sample of at most sketch_size runs, which gives the exact
+quantiles up to sketch_size runs. The outputs of the runs are aligned on their labels
+(ticks, categories, ...), as runs may have different ones (e.g. a run stopped early has
+fewer ticks, a run only has columns for the categories it used); missing and NaN
+elements are left out of the statistics of the element.
+
+    ensemble = Ensemble()
+    for seed in seeds:
+        ensemble.add(run(...))
+    ensemble.summary("active_firms")
+
+The figures of an ensemble are in report.ENSEMBLE_FIGURES.
+"""
+
+import copy
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from .storage import load_results
+
+# the quantiles in a summary
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+# z-score of the confidence interval of the mean in a summary
+Z_CONFIDENCE = 1.96
+
+
+def _market_share(out):
+    df = out["market_share_timeline_df"]
+    return df.pivot(index="tick", columns="category", values="consumer")
+
+
+def _positive_mean(df):
+    return df.where(df > 0).mean(axis=1)
+
+
+# name: (function of the outputs of a run: a Series or DataFrame, description)
+ENSEMBLE_OUTPUTS = {
+    "market_share": (
+        _market_share,
+        "share (%) of the top three firms in every category, per tick",
+    ),
+    "market_concentration": (
+        lambda out: out["market_share_df"].set_index("category")["consumer"],
+        "share (%) of the top three firms in every category over the last year",
+    ),
+    "quality": (
+        lambda out: out["welfare_df"].set_index("category")["quality"],
+        "highest quality in every category at the end",
+    ),
+    "firms_per_category": (
+        lambda out: out["welfare_df"].set_index("category")["num_firms"],
+        "number of firms in every category at the end",
+    ),
+    "active_firms": (
+        lambda out: (out["firm_usage_df"] > 0).sum(axis=1),
+        "number of firms with products in use, per tick",
+    ),
+    "products_used": (
+        lambda out: out["firm_usage_df"].sum(axis=1),
+        "number of products in use, per tick",
+    ),
+    "capital": (
+        lambda out: _positive_mean(out["capital"]),
+        "mean capital of the firms with capital, per tick",
+    ),
+    "concern": (
+        lambda out: out["concern_evo"].mean(axis=1),
+        "mean privacy concern of the consumers, per tick",
+    ),
+    "privacy_score": (
+        lambda out: out["ps_score_evo"].mean(axis=1),
+        "mean privacy score of the firms, per tick",
+    ),
+    "new_products_new_cat": (
+        lambda out: out["new_products_new_cat"].cumsum(),
+        "cumulative number of products released in new categories",
+    ),
+    "new_products_existing_cat": (
+        lambda out: out["new_products_existing_cat"].cumsum(),
+        "cumulative number of products released in existing categories",
+    ),
+    "investment": (
+        lambda out: out["invest_df"],
+        "investment choices of the firms, per tick",
+    ),
+}
+
+
+def _grow(array, shape, fill):
+    """
+    array padded with fill to at least shape on its last axes
+    """
+    lead = array.ndim - len(shape)
+    target = array.shape[:lead] + tuple(
+        max(a, b) for a, b in zip(array.shape[lead:], shape)
+    )
+    if target == array.shape:
+        return array
+    grown = np.full(target, fill, dtype=array.dtype)
+    grown[tuple(slice(0, n) for n in array.shape)] = array
+    return grown
+
+
+class RunningStats(object):
+    """
+    the elementwise count, mean and variance of the arrays added, by Welford's
+    algorithm. NaN elements are skipped
+    """
+
+    def __init__(self):
+        self.count = None
+
+    def add(self, x):
+        x = np.asarray(x, dtype=float)
+        if self.count is None:
+            self.count = np.zeros(x.shape, dtype=np.int64)
+            self.mean = np.zeros(x.shape)
+            self.m2 = np.zeros(x.shape)
+        self.count = _grow(self.count, x.shape, 0)
+        self.mean = _grow(self.mean, x.shape, 0.0)
+        self.m2 = _grow(self.m2, x.shape, 0.0)
+        x = _grow(x, self.count.shape, np.nan)
+        valid = ~np.isnan(x)
+        self.count += valid
+        delta = np.where(valid, x - self.mean, 0)
+        self.mean += delta / np.maximum(self.count, 1)
+        self.m2 += delta * np.where(valid, x - self.mean, 0)
+
+    def get_mean(self):
+        return np.where(self.count > 0, self.mean, np.nan)
+
+    def get_var(self):
+        """
+        the sample variance
+        """
+        return np.where(self.count > 1, self.m2 / np.maximum(self.count - 1, 1), np.nan)
+
+
+class QuantileSketch(object):
+    """
+    the elementwise quantiles of the arrays added, from a uniform sample (reservoir) of
+    at most size of them per element, so exact up to size arrays. NaN elements are
+    skipped
+    """
+
+    def __init__(self, size=200, seed=0):
+        self.size = size
+        self.rng = np.random.RandomState(seed)
+        self.count = None
+
+    def add(self, x):
+        x = np.asarray(x, dtype=float)
+        if self.count is None:
+            self.count = np.zeros(x.shape, dtype=np.int64)
+            self.sample = np.full((self.size,) + x.shape, np.nan)
+        self.count = _grow(self.count, x.shape, 0)
+        self.sample = _grow(self.sample, x.shape, np.nan)
+        x = _grow(x, self.count.shape, np.nan)
+        valid = ~np.isnan(x)
+        # the i-th value of an element takes a random slot of the first i + 1, if that
+        # is in the sample
+        slot = np.where(
+            self.count < self.size,
+            self.count,
+            (self.rng.random_sample(x.shape) * (self.count + 1)).astype(np.int64),
+        )
+        keep = valid & (slot < self.size)
+        self.sample[(slot[keep],) + np.nonzero(keep)] = x[keep]
+        self.count += valid
+
+    def quantiles(self, qs):
+        """
+        (quantile, ...) the quantiles qs (between 0 and 1) of every element
+        """
+        with warnings.catch_warnings():
+            # elements without any values
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return np.nanquantile(self.sample, qs, axis=0)
+
+
+class Ensemble(object):
+    """
+    running statistics of the outputs (ENSEMBLE_OUTPUTS) of the runs added, see the
+    top of this module. outputs: the names of the outputs to keep (default all)
+    """
+
+    def __init__(self, outputs=None, sketch_size=200, seed=0):
+        self.outputs = list(ENSEMBLE_OUTPUTS) if outputs is None else list(outputs)
+        unknown = [x for x in self.outputs if x not in ENSEMBLE_OUTPUTS]
+        assert not unknown, "unknown ensemble outputs: " + ", ".join(unknown)
+        self.n_runs = 0
+        self.stats = {name: RunningStats() for name in self.outputs}
+        self.sketches = {
+            name: QuantileSketch(sketch_size, seed + i)
+            for i, name in enumerate(self.outputs)
+        }
+        # the labels of the index and columns seen, in the order of the elements of the
+        # statistics: labels new to a run are added at the end
+        self.labels = {}
+
+    def add(self, out):
+        """
+        folds in the outputs of a run (a SimResults or a dict); only the outputs the
+        ensemble needs are accessed. Outputs the run doesn't have are skipped
+        """
+        for name in self.outputs:
+            try:
+                value = ENSEMBLE_OUTPUTS[name][0](out)
+            except KeyError:
+                continue
+            labels = [value.index]
+            if isinstance(value, pd.DataFrame):
+                labels.append(value.columns)
+            if name in self.labels:
+                labels = [
+                    old.append(new[~new.isin(old)])
+                    for old, new in zip(self.labels[name], labels)
+                ]
+            self.labels[name] = labels
+            if isinstance(value, pd.DataFrame):
+                value = value.reindex(index=labels[0], columns=labels[1])
+            else:
+                value = value.reindex(labels[0])
+            self.stats[name].add(value.values)
+            self.sketches[name].add(value.values)
+        self.n_runs += 1
+
+    def summary(self, name):
+        """
+        a DataFrame with the number of runs (n), mean, standard deviation, confidence
+        interval of the mean and QUANTILES of output name, per element of the output:
+        indexed like the output, or by (index, column) if the output is a DataFrame
+        """
+        stats = self.stats[name]
+        assert stats.count is not None, "no runs with output " + name
+        mean, std = stats.get_mean(), np.sqrt(stats.get_var())
+        half_width = Z_CONFIDENCE * std / np.sqrt(np.maximum(stats.count, 1))
+        columns = {
+            "n": stats.count,
+            "mean": mean,
+            "std": std,
+            "ci_low": mean - half_width,
+            "ci_high": mean + half_width,
+        }
+        quantiles = self.sketches[name].quantiles(QUANTILES)
+        for q, values in zip(QUANTILES, quantiles):
+            columns["q{:02.0f}".format(100 * q)] = values
+        labels = self.labels[name]
+        if len(labels) == 1:
+            index = labels[0]
+        else:
+            index = pd.MultiIndex.from_product(labels)
+        summary = pd.DataFrame({k: v.ravel() for k, v in columns.items()}, index=index)
+        return summary.sort_index()
+
+    def summaries(self):
+        """
+        the summary of every output, by name
+        """
+        return {
+            name: self.summary(name) for name in self.outputs if self.labels.get(name)
+        }
+
+
+def ensemble_of_runs(directories, outputs=None, sketch_size=200):
+    """
+    the Ensemble of the stored outputs in directories (see storage.py), read one run at
+    a time
+    """
+    ensemble = Ensemble(outputs, sketch_size)
+    for directory in directories:
+        ensemble.add(load_results(directory))
+    return ensemble
+
+
+def run_ensemble(n_runs, seed_key="overall_seed", outputs=None, **params):
+    """
+    the Ensemble of n_runs runs of params, with seed_dict[seed_key] increased by one
+    for every run
+    """
+    from .simulation import run
+
+    ensemble = Ensemble(outputs)
+    for i in range(n_runs):
+        config = copy.deepcopy(params)
+        seed = config["seed_dict"][seed_key]
+        config["seed_dict"][seed_key] = (seed + i) % 2**32
+        ensemble.add(run(**config))
+    return ensemble
@@ -0,0 +1,412 @@
+"""
+Pre-flight estimates of what a run needs, made from its parameters before anything is
+allocated: the shape, dtype and size of every state array and of the tracker, the peak
+memory of every phase of a tick, and a rough time per tick.
+
+The sizes follow setup_simulation: the firm axis has n_init_firms plus an upper bound on
+the births (max_firm_births), and the datatype axis the datatypes used by a category,
+drawn as in the run. The largest arrays are
+    requestable, requestable_now, portability_matrix: F * C * F * C * D
+    data_held: T * N * C * F * D, data_value: N * C * F * D
+The temporaries of every phase are estimated from the largest arrays the phase makes,
+so the peaks are approximate (the largest within 10% of the measured one in our tests).
+The time per tick is the cost model COST_MODEL, fitted with benchmarks/cost_model.py.
+
+With preflight: warn in general_dict (the default), a run whose predicted peak does not
+fit in the available memory (or memory_limit, in GB) gets a warning before its arrays are
+allocated; with preflight: auto, the largest arrays are moved out of core (see
+out_of_core.py) until it fits.
+"""
+
+import os
+import shutil
+import tempfile
+import warnings
+
+import numpy as np
+
+from .world import max_firm_births, draw_category_datatype
+from .out_of_core import OUT_OF_CORE_ARRAYS
+
+# memory of a python process with the model imported and its numba kernels loaded
+BASE_MEMORY = 220e6
+
+# seconds per tick: a constant, and per element of the arrays that the phases of a
+# tick go over (consumer rows * C * F, consumer rows * C * F * D, the data held on them
+# T * rows * C * F * D, and F * C * F * C * D); fitted on one core, median error 6%,
+# largest 32%
+COST_MODEL = {
+    "tick": 0.00186,
+    "consumer_products": 1.17e-07,
+    "consumer_data": 1.25e-08,
+    "consumer_history": 2.14e-11,
+    "firm_pairs": 2.59e-09,
+}
+
+PREFLIGHT_MODES = ["off", "warn", "auto"]
+
+# the state arrays with a row per consumer, which sharded runs split over the shards
+CONSUMER_ARRAYS = [
+    "data_held",
+    "data_value",
+    "usage",
+    "usage_counter",
+    "usage_counter_raw",
+    "uninterrupted_usage",
+    "privacy_mask",
+]
+# the firm state sharded runs copy to shared memory
+SHARED_ARRAYS = ["quality", "portability_matrix"]
+# the phases run by every shard at once
+CONSUMER_PHASES = ["consumers", "porting", "scenario"]
+
+
+def dimensions(
+    general_dict={},
+    seed_dict={},
+    data_dict={},
+    category_dict={},
+    cohort_dict={},
+    **params
+):
+    """
+    the sizes of the axes of the state arrays, before anything is allocated:
+    T (ticks), N (consumer rows, per shard), C (categories), F (firms), D (datatypes),
+    plus the consumers set up, in the population and recorded by the tracker, and the
+    rows the consumer phases work on at once
+    """
+    n_consumers = general_dict["n_consumers"]
+    n_total_categories = category_dict["n_total_categories"]
+    data_rng = np.random.RandomState(seed=seed_dict["data_seed"])
+    category_datatype = draw_category_datatype(
+        data_dict,
+        category_dict["n_init_categories"],
+        n_total_categories,
+        data_rng,
+    )
+    rows = n_consumers
+    tracked = n_consumers
+    if cohort_dict and cohort_dict.get("n_archetypes"):
+        # the consumers set up are the rows of the cohorts
+        rows = cohort_dict.get("max_cohorts") or 4 * cohort_dict["n_archetypes"]
+        n_consumers = rows
+        tracked = cohort_dict["n_archetypes"]
+    n_shards = general_dict.get("n_shards", 1)
+    chunk_size = seed_dict.get("chunk_size", 250)
+    if n_shards > 1:
+        # whole chunks per shard
+        n_chunks = -(-n_consumers // chunk_size)
+        rows = min(n_consumers, -(-n_chunks // n_shards) * chunk_size)
+    if seed_dict.get("rng_mode", "legacy") == "legacy":
+        rows_at_once = rows
+    else:
+        rows_at_once = min(rows, chunk_size * general_dict.get("n_threads", 1))
+    return {
+        "T": general_dict["n_ticks"],
+        "N": rows,
+        "C": n_total_categories,
+        "F": general_dict["n_init_firms"] + int(max_firm_births(general_dict)),
+        "D": category_datatype.shape[1],
+        "consumers": n_consumers,
+        "population": general_dict["n_consumers"],
+        "tracked": tracked,
+        "rows_at_once": rows_at_once,
+        "shards": n_shards,
+    }
+
+
+def state_arrays(dims):
+    """
+    (name, shape, dtype) of every state array of a simulation (of one shard, for a
+    sharded run); requestable_now is made again every tick
+    """
+    T, N, C, F, D = [dims[x] for x in "TNCFD"]
+    return [
+        ("data_held", (T, N, C, F, D), np.float64),
+        ("data_value", (N, C, F, D), np.float64),
+        ("requestable", (F, C, F, C, D), np.int8),
+        ("requestable_now", (F, C, F, C, D), np.int8),
+        ("portability_matrix", (F, C, F, C, D), np.float64),
+        ("usage", (N, C, F), np.int64),
+        ("usage_counter", (N, C, F), np.float64),
+        ("usage_counter_raw", (N, C, F), np.float64),
+        ("uninterrupted_usage", (N, C, F), np.float64),
+        ("privacy_mask", (N, F), np.float64),
+        ("need_matrix", (dims["consumers"], C), np.float64),
+        ("consumer_privacy_concern", (dims["consumers"],), np.float64),
+        ("consumer_wealth", (dims["consumers"],), np.float64),
+        ("quality", (F, C), np.float64),
+        ("category_datatype", (C, D), np.int8),
+        ("firm_investment_profile", (F, 3), np.float64),
+    ]
+
+
+def tracker_arrays(dims):
+    """
+    (name, shape, dtype) of the arrays of the tracker
+    """
+    T, C, F, n = dims["T"], dims["C"], dims["F"], dims["tracked"]
+    return [
+        ("_quality", (T, F, C), np.float64),
+        ("_usage", (T, F, C), np.float64),
+        ("_usage_consumer", (T, n, F), np.float64),
+        ("_concern", (T, n), np.float64),
+        ("_needs", (n, C), np.float64),
+        ("_capital", (T, F), np.float64),
+        ("_live_firms", (T, F), np.float64),
+        ("_investment_choices", (T, F, 3), np.float64),
+        ("_investment_success", (T, F), np.float64),
+        ("_privacy_score", (T, F), np.float64),
+        ("_success_prob", (T, F, 2), np.float64),
+    ]
+
+
+def nbytes(shape, dtype):
+    return int(np.prod(shape, dtype=np.float64)) * np.dtype(dtype).itemsize
+
+
+def phase_temporaries(dims, out_of_core=(), scen_tick=None):
+    """
+    bytes of the largest temporaries of every phase of a tick (of one shard, for a
+    sharded run), on top of the state arrays and the tracker. Those of out_of_core
+    arrays are on disk
+    """
+    T, N, C, F, D = [dims[x] for x in "TNCFD"]
+    n = dims["rows_at_once"]
+    firm_pairs = F * C * F * C * D
+    slab = N * C * F * D * 8
+    phases = {
+        # the needs are drawn from 500 bins for all consumers at once
+        "setup": 4 * dims["consumers"] * 500 * 8,
+        "data_requests": firm_pairs * (0 if "requestable_now" in out_of_core else 1)
+        + F * C * F * C,
+        # utilities, probabilities and the choices (consumer, category, firm), and
+        # the new usage of all consumers
+        "consumers": 6 * n * C * F * 8 + N * C * F * 8,
+        # about one port per consumer: (port, category, firm, datatype)
+        "porting": 3 * n * C * F * D * 8,
+    }
+    if scen_tick is not None and scen_tick < T:
+        if "data_held" in out_of_core:
+            # a tick of data_held at a time, and the value lost
+            lost = 0 if "data_value" in out_of_core else slab
+            phases["scenario"] = 2 * slab + lost
+        else:
+            # the data to delete and its value lost
+            phases["scenario"] = (T + scen_tick) * slab + slab
+    return phases
+
+
+def estimate(**params):
+    """
+    the pre-flight estimate of a run of params: its dimensions, arrays (name, shape,
+    dtype, bytes, out of core), the bytes in memory, on disk and of the tracker, the
+    peak memory of every phase, the largest peak, and the seconds per tick and per
+    run. The memory of a sharded run is that of all its processes together
+    """
+    general_dict = params["general_dict"]
+    out_of_core = general_dict.get("out_of_core") or []
+    dims = dimensions(**params)
+    shards = dims["shards"]
+    arrays = [
+        (name, shape, dtype, nbytes(shape, dtype), name in out_of_core)
+        for name, shape, dtype in state_arrays(dims)
+    ]
+    tracker = sum(nbytes(shape, dtype) for _, shape, dtype in tracker_arrays(dims))
+    # the arrays with a row per consumer are in every shard
+    copies = [shards if name in CONSUMER_ARRAYS else 1 for name, *_ in arrays]
+    in_memory = sum(c * x[3] for c, x in zip(copies, arrays) if not x[4])
+    on_disk = sum(c * x[3] for c, x in zip(copies, arrays) if x[4])
+    processes = 1
+    if shards > 1:
+        processes += shards
+        # the firm state in shared memory
+        in_memory += sum(x[3] for x in arrays if x[0] in SHARED_ARRAYS)
+    scen_tick = (params.get("scenario_dict") or {}).get("scen_tick")
+    temporaries = phase_temporaries(dims, out_of_core, scen_tick)
+    peaks = {}
+    for phase, extra in temporaries.items():
+        if phase in CONSUMER_PHASES:
+            extra *= shards
+        peaks[phase] = processes * BASE_MEMORY + in_memory + tracker + extra
+
+    T, N, C, F, D = [dims[x] for x in "TNCFD"]
+    parallel = max(shards, general_dict.get("n_threads", 1))
+    tick_seconds = (
+        COST_MODEL["tick"]
+        + COST_MODEL["consumer_products"] * shards * N * C * F / parallel
+        + COST_MODEL["consumer_data"] * shards * N * C * F * D / parallel
+        + COST_MODEL["consumer_history"] * shards * T * N * C * F * D / parallel
+        + COST_MODEL["firm_pairs"] * F * C * F * C * D
+    )
+    return {
+        "dimensions": dims,
+        "arrays": arrays,
+        "tracker": tracker,
+        "in_memory": in_memory,
+        "on_disk": on_disk,
+        "peaks": peaks,
+        "peak": max(peaks.values()),
+        "tick_seconds": tick_seconds,
+        "run_seconds": tick_seconds * T,
+    }
+
+
+def available_memory():
+    """
+    bytes of memory available to a new run, or None if unknown
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def memory_limit(general_dict):
+    """
+    bytes a run may use: memory_limit (GB) in general_dict, or the available memory
+    """
+    if general_dict.get("memory_limit"):
+        return general_dict["memory_limit"] * 1e9
+    return available_memory()
+
+
+def choose_out_of_core(params, limit):
+    """
+    the out_of_core arrays for params to fit in limit bytes: the ones of general_dict,
+    plus the largest other arrays until the predicted peak fits (all of them if it
+    doesn't fit anyway). Returns the arrays, and their estimate
+    """
+    out_of_core = list(params["general_dict"].get("out_of_core") or [])
+    result = estimate(**params)
+    by_size = sorted(
+        (x for x in result["arrays"] if x[0] in OUT_OF_CORE_ARRAYS and not x[4]),
+        key=lambda x: -x[3],
+    )
+    for name, *_ in by_size:
+        if result["peak"] <= limit:
+            break
+        out_of_core.append(name)
+        general_dict = dict(params["general_dict"], out_of_core=out_of_core)
+        result = estimate(**dict(params, general_dict=general_dict))
+    return out_of_core, result
+
+
+def preflight(**params):
+    """
+    checks the predicted peak memory of a run of params before it allocates anything,
+    following general_dict["preflight"]: off, warn (the default) or auto (move the
+    largest arrays out of core until the run fits). Returns the params to run with
+    """
+    general_dict = params["general_dict"]
+    mode = general_dict.get("preflight", "warn")
+    assert mode in PREFLIGHT_MODES, "unknown preflight mode: " + str(mode)
+    limit = memory_limit(general_dict)
+    if mode == "off" or limit is None:
+        return params
+    result = estimate(**params)
+    if result["peak"] <= limit:
+        return params
+    message = "the run is predicted to need {} of memory, {} is available".format(
+        format_bytes(result["peak"]), format_bytes(limit)
+    )
+    out_of_core, fitted = choose_out_of_core(params, limit)
+    if mode == "auto":
+        general_dict = dict(general_dict, out_of_core=out_of_core)
+        params = dict(params, general_dict=general_dict)
+        message += "; out_of_core: {} brings it to {}".format(
+            out_of_core, format_bytes(fitted["peak"])
+        )
+    elif fitted["peak"] <= limit:
+        message += "; set out_of_core: {} (or preflight: auto) to fit".format(
+            out_of_core
+        )
+    if fitted["peak"] > limit:
+        message += (
+            "; it doesn't fit with arrays out of core either: use the cohort mode"
+            " (cohort_dict.n_archetypes), or fewer consumers, ticks or categories"
+        )
+    if fitted["on_disk"] > free_disk(general_dict.get("scratch_dir")):
+        message += "; the out-of-core arrays need {} of disk, more than is free".format(
+            format_bytes(fitted["on_disk"])
+        )
+    warnings.warn(message)
+    return params
+
+
+def free_disk(scratch_dir=None):
+    """
+    bytes free in the directory of the out-of-core arrays
+    """
+    directory = scratch_dir if scratch_dir else tempfile.gettempdir()
+    while not os.path.exists(directory):
+        directory = os.path.dirname(os.path.abspath(directory))
+    return shutil.disk_usage(directory).free
+
+
+def format_bytes(n):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(n) < 1000:
+            return "{:.1f}{}".format(n, unit)
+        n /= 1000
+    return "{:.1f}TB".format(n)
+
+
+def format_seconds(s):
+    if s < 120:
+        return "{:.2g}s".format(s)
+    if s < 7200:
+        return "{:.1f}min".format(s / 60)
+    return "{:.1f}h".format(s / 3600)
+
+
+def report(result):
+    """
+    a text report of the estimate result
+    """
+    dims = result["dimensions"]
+    lines = [
+        "dimensions: "
+        + ", ".join("{}={}".format(x, dims[x]) for x in "TNCFD")
+        + " ({} consumers{})".format(
+            dims["population"],
+            ", {} shards".format(dims["shards"]) if dims["shards"] > 1 else "",
+        ),
+        "",
+        "{:<26} {:<28} {:<8} {:>10}".format("array", "shape", "dtype", "size"),
+    ]
+    for name, shape, dtype, size, on_disk in result["arrays"]:
+        lines.append(
+            "{:<26} {:<28} {:<8} {:>10}{}".format(
+                name,
+                str(shape),
+                np.dtype(dtype).name,
+                format_bytes(size),
+                " (out of core)" if on_disk else "",
+            )
+        )
+    lines += [
+        "",
+        "state arrays in memory: " + format_bytes(result["in_memory"]),
+        "state arrays on disk:   " + format_bytes(result["on_disk"]),
+        "tracker:                " + format_bytes(result["tracker"]),
+        "",
+        "predicted peak memory per phase:",
+    ]
+    for phase, peak in result["peaks"].items():
+        lines.append("    {:<14} {:>10}".format(phase, format_bytes(peak)))
+    lines += [
+        "",
+        "predicted time: {} per tick, {} per run".format(
+            format_seconds(result["tick_seconds"]),
+            format_seconds(result["run_seconds"]),
+        ),
+    ]
+    return "\n".join(lines)
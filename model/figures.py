@@ -1,22 +1,106 @@
 import plotly.graph_objs as go
 import numpy as np
+import pandas as pd
 
 from .beta_distr import get_beta_params
-from scipy.stats import beta
 
+# get some nice colours: matplotlib's tab10
+tab10 = [
+    "rgb(31.0, 119.0, 180.0)",
+    "rgb(255.0, 127.0, 14.0)",
+    "rgb(44.0, 160.0, 44.0)",
+    "rgb(214.0, 39.0, 40.0)",
+    "rgb(148.0, 103.0, 189.0)",
+    "rgb(140.0, 86.0, 75.0)",
+    "rgb(227.0, 119.0, 194.0)",
+    "rgb(127.0, 127.0, 127.0)",
+    "rgb(188.0, 189.0, 34.0)",
+    "rgb(23.0, 190.0, 207.0)",
+]
 
-import matplotlib.pyplot as plt
 
-# get some nice colours
-tab10 = plt.get_cmap("tab10").colors
-tab10 = list(tuple(x * 255 for x in tab10[i]) for i in range(len(tab10)))
-tab10 = ["rgb" + str(x) for x in tab10]
+def thin_rows(df, max_points=500):
+    """
+    downsample the (time) index of df to at most max_points rows, keeping the last row
+    """
+    n = df.shape[0]
+    if max_points is None or n <= max_points:
+        return df
+    step = int(np.ceil(n / max_points))
+    rows = np.arange(0, n, step)
+    if rows[-1] != n - 1:
+        rows = np.append(rows, n - 1)
+    return df.iloc[rows]
+
+
+def quantile_band_traces(df, name, colour="rgb(31, 119, 180)"):
+    """
+    summarises a df with one column per entity by the median, interquartile range and
+    extremes over the entities at every index value
+    """
+    xs = df.index
+    q = np.nanpercentile(df.values.astype(float), [0, 25, 50, 75, 100], axis=1)
+    band = colour.replace("rgb", "rgba").replace(")", ", {})")
+
+    def edge(y, fill=None, alpha=0, label=None):
+        return go.Scattergl(
+            x=xs,
+            y=y,
+            mode="lines",
+            line={"width": 0, "color": colour},
+            fill=fill,
+            fillcolor=band.format(alpha),
+            showlegend=label is not None,
+            name=label,
+            hoverinfo="x+y",
+        )
+
+    return [
+        edge(q[0]),
+        edge(q[4], fill="tonexty", alpha=0.15, label=name + " min-max"),
+        edge(q[1]),
+        edge(q[3], fill="tonexty", alpha=0.35, label=name + " interquartile range"),
+        go.Scattergl(
+            x=xs, y=q[2], mode="lines", line={"color": colour}, name=name + " median"
+        ),
+    ]
+
+
+def entity_traces(df, label, group, mode="auto", max_traces=50, max_points=500):
+    """
+    traces for a df with one column per entity (consumer, firm) and time as index.
+    label gives the name of the trace of an entity, group the name of all entities
+    mode:
+     - full: one trace per entity
+     - sample: one (webgl) trace for each of at most max_traces entities, evenly spread
+     - bands: quantile bands over all entities, see quantile_band_traces
+     - auto: full if there are at most max_traces entities, else bands
+    the time axis is downsampled to at most max_points points
+    """
+    df = thin_rows(df, max_points)
+    if mode == "auto":
+        mode = "full" if df.shape[1] <= max_traces else "bands"
+    if mode == "full":
+        return [go.Scatter(x=df.index, y=df[c], name=label(c)) for c in df.columns]
+    if mode == "sample":
+        columns = df.columns[
+            np.unique(np.linspace(0, df.shape[1] - 1, max_traces).astype(int))
+        ]
+        return [
+            go.Scattergl(x=df.index, y=df[c], mode="lines", name=label(c))
+            for c in columns
+        ]
+    if mode == "bands":
+        return quantile_band_traces(df, group)
+    raise ValueError("unknown plot mode: " + str(mode))
 
 
 def plot_beta(m, var):
     """
     plot a single beta function with mode m and variance var
     """
+    from scipy.stats import beta
+
     a, b = get_beta_params(m, var)
     xs = np.linspace(0, 1, 1000)
     return go.Figure(data=[go.Scatter(x=xs, y=beta.pdf(xs, a, b), mode="line")])
@@ -49,14 +133,13 @@ def plot_quality_by_category(quality_df):
     return go.Figure(data=data, layout=layout)
 
 
-def plot_capital(capital_df):
+def plot_capital(capital_df, mode="auto", max_traces=50, max_points=500):
     """
     evolution of the capital of firms over time
     """
-    data = [
-        go.Scatter(x=capital_df.index, y=capital_df[c], name="firm " + str(c))
-        for c in capital_df.columns
-    ]
+    data = entity_traces(
+        capital_df, lambda c: "firm " + str(c), "firms", mode, max_traces, max_points
+    )
     layout = go.Layout(title="Capital over time")
     return go.Figure(data=data, layout=layout)
 
@@ -296,29 +379,30 @@ def plot_investment_success(df):
     return go.Figure(data=data, layout=layout)
 
 
-def plot_firm_engagement(df):
+def plot_firm_engagement(df, mode="auto", max_traces=50, max_points=500):
     """
     a plot of usage over time
     """
-    data = [go.Scatter(x=df.index, y=df[c], name=c) for c in df.columns]
+    data = entity_traces(df, lambda c: c, "firms", mode, max_traces, max_points)
     layout = go.Layout(title="Firm: number of products used over time")
     return go.Figure(data=data, layout=layout)
 
 
-def plot_concern(df):
+def plot_concern(df, mode="auto", max_traces=50, max_points=500):
     """
     a plot of the consumer privacy concern over time. Each trace is a consumer
+    (with many consumers, see entity_traces for the modes that summarise them)
     """
-    data = [go.Scatter(x=df.index, y=df[c], name=c) for c in df.columns]
+    data = entity_traces(df, lambda c: c, "consumers", mode, max_traces, max_points)
     layout = go.Layout(title="Privacy concern over time")
     return go.Figure(data=data, layout=layout)
 
 
-def plot_privacy_score(df):
+def plot_privacy_score(df, mode="auto", max_traces=50, max_points=500):
     """
     Each trace is the privacy score of a firm over time
     """
-    data = [go.Scatter(x=df.index, y=df[c], name=c) for c in df.columns]
+    data = entity_traces(df, lambda c: c, "firms", mode, max_traces, max_points)
     layout = go.Layout(title="Privacy score over time")
     return go.Figure(data=data, layout=layout)
 
@@ -346,3 +430,91 @@ def plot_data_requests(df):
         yaxis={"title": "Number of categories a new firm is active in after one year"},
     )
     return go.Figure(data=data, layout=layout)
+
+
+def ensemble_band_traces(summary, name, colour="rgb(31, 119, 180)"):
+    """
+    the mean of an ensemble summary (see ensemble.py) with bands for the 5-95%
+    quantiles of the runs and the confidence interval of the mean
+    """
+    xs = summary.index
+    band = colour.replace("rgb", "rgba").replace(")", ", {})")
+
+    def edge(y, fill=None, alpha=0, label=None):
+        return go.Scatter(
+            x=xs,
+            y=y,
+            mode="lines",
+            line={"width": 0, "color": colour},
+            fill=fill,
+            fillcolor=band.format(alpha),
+            showlegend=label is not None,
+            name=label,
+            hoverinfo="x+y",
+        )
+
+    return [
+        edge(summary.q05),
+        edge(summary.q95, fill="tonexty", alpha=0.15, label=name + " 5-95% of runs"),
+        edge(summary.ci_low),
+        edge(
+            summary.ci_high, fill="tonexty", alpha=0.4, label=name + " 95% CI of mean"
+        ),
+        go.Scatter(
+            x=xs, y=summary["mean"], mode="lines", line={"color": colour}, name=name
+        ),
+    ]
+
+
+def plot_ensemble_timeline(summary, title, yaxis="", max_lines=10):
+    """
+    the mean over the runs of an ensemble of an output over time, with bands (see
+    ensemble_band_traces). An output with a column per category (or other entity) gets
+    bands for each of its first max_lines columns
+    """
+    if isinstance(summary.index, pd.MultiIndex):
+        columns = summary.index.get_level_values(1).unique()[:max_lines]
+        data = []
+        for i, column in enumerate(columns):
+            data += ensemble_band_traces(
+                summary.xs(column, level=1), str(column), tab10[np.mod(i, 10)]
+            )
+    else:
+        data = ensemble_band_traces(summary, "mean")
+    n_runs = int(summary.n.max())
+    layout = go.Layout(
+        title="{} ({} runs)".format(title, n_runs),
+        xaxis={"title": "Month in simulation"},
+        yaxis={"title": yaxis},
+    )
+    return go.Figure(data=data, layout=layout)
+
+
+def plot_ensemble_by_category(summary, title, yaxis=""):
+    """
+    the mean over the runs of an ensemble of an output per category, with the
+    confidence interval of the mean as error bars and the 5% and 95% quantiles of the
+    runs as markers
+    """
+    xs = summary.index.values
+    data = [
+        go.Bar(
+            x=xs,
+            y=summary["mean"],
+            name="mean",
+            error_y={
+                "type": "data",
+                "symmetric": False,
+                "array": summary.ci_high - summary["mean"],
+                "arrayminus": summary["mean"] - summary.ci_low,
+            },
+        ),
+        go.Scatter(x=xs, y=summary.q05, mode="markers", name="5% of runs"),
+        go.Scatter(x=xs, y=summary.q95, mode="markers", name="95% of runs"),
+    ]
+    layout = go.Layout(
+        title="{} ({} runs)".format(title, int(summary.n.max())),
+        xaxis={"title": "Category"},
+        yaxis={"title": yaxis},
+    )
+    return go.Figure(data=data, layout=layout)
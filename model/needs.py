@@ -3,7 +3,6 @@ Things to do with the needs of consumers for products
 """
 
 import numpy as np
-from scipy.stats import beta
 
 from .beta_distr import get_beta_params
 from .utility import multinomial
@@ -14,13 +13,16 @@ def discretize_a_composite_beta(modes, vars, n_bins=500):
     Computes the weight of a composite beta function with given modes and variances
     on n_bins on the unit interval
     """
+    # imported here, as scipy is slow to import
+    from scipy.special import betainc
+
     xs = np.linspace(0, 1, n_bins + 1)
     cdf_vals = np.zeros(n_bins)
     # loop over all beta distributions to be included
     for m, v in zip(modes, vars):
         a, b = get_beta_params(m, v)
         # get cdf in all points
-        cdf = beta.cdf(xs, a, b)
+        cdf = betainc(a, b, xs)
         # diff cdf to get integral of pdf in that interval
         cdf_diff = cdf[1:] - cdf[:-1]
         cdf_vals += cdf_diff
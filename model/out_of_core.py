@@ -0,0 +1,64 @@
+"""
+Out-of-core state: the largest state arrays of a simulation can be backed by np.memmap
+files in a scratch directory, so runs larger than memory finish instead of failing when
+the arrays are allocated.
+
+The arrays named in general_dict["out_of_core"] (any of OUT_OF_CORE_ARRAYS) are created
+as memory-mapped files in general_dict["scratch_dir"] (the system's temporary directory
+by default). A file is removed from the directory as soon as it is mapped, so its disk
+space is freed when the array is, also if the run is interrupted. The phases working on
+these arrays switch to kernels that stream over them one tick at a time (see
+data_handling.port_tick_major and privacy_scenario.delete_data_tick_major).
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+# (tick, consumer, category, firm, datatype), (consumer, category, firm, datatype)
+# and (firm, category, firm, category, datatype); requestable_now is made every tick
+OUT_OF_CORE_ARRAYS = [
+    "data_held",
+    "data_value",
+    "requestable",
+    "requestable_now",
+    "portability_matrix",
+]
+
+
+class ArrayAllocator(object):
+    """
+    creates the state arrays of a simulation, in memory or, for the arrays named in
+    out_of_core, in memory-mapped files in scratch_dir
+    """
+
+    def __init__(self, out_of_core=(), scratch_dir=None):
+        unknown = [x for x in out_of_core if x not in OUT_OF_CORE_ARRAYS]
+        assert not unknown, "these arrays can't be out of core: " + ", ".join(unknown)
+        self.out_of_core = list(out_of_core)
+        self.scratch_dir = scratch_dir
+        if scratch_dir is not None and not os.path.exists(scratch_dir):
+            os.makedirs(scratch_dir)
+
+    def is_out_of_core(self, name):
+        return name in self.out_of_core
+
+    def zeros(self, name, shape, dtype=np.float64):
+        # an empty file can't be mapped: arrays without elements (the consumer arrays
+        # of the coordinator of a sharded run) stay in memory
+        if not self.is_out_of_core(name) or np.prod(shape) == 0:
+            return np.zeros(shape, dtype=dtype)
+        # a new file reads as zeros, without writing them
+        fd, path = tempfile.mkstemp(prefix=name + "_", dir=self.scratch_dir)
+        os.close(fd)
+        try:
+            array = np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+        finally:
+            os.remove(path)
+        return array
+
+    def ones(self, name, shape, dtype=np.float64):
+        array = self.zeros(name, shape, dtype=dtype)
+        array.fill(1)
+        return array
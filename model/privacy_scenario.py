@@ -14,3 +14,18 @@ def delete_data(data_deleters, data_held, data_value, tick, alpha):
     )
     data_value -= data_value_lost.sum(axis=0)
     return data_held, data_value
+
+
+def delete_data_tick_major(data_deleters, data_held, data_value, tick, alpha, lost):
+    """
+    delete_data one tick at a time, without temporaries the size of data_held, for a
+    data_held in a memory-mapped file. lost: zeros shaped like data_value, for the
+    value lost (summed in the same order as in delete_data)
+    """
+    for t in range(data_held.shape[0]):
+        data_to_be_del = data_held[t] * data_deleters[:, None, :, None]
+        data_held[t] -= data_to_be_del
+        if t < tick:
+            lost += data_to_be_del * np.power(np.exp(-alpha), tick - 1 - t)
+    data_value -= lost
+    return data_held, data_value
@@ -1,5 +1,45 @@
+"""
+Timers for the phases of a simulation. With profile set in general_dict, a Simulation
+times every phase of every tick (see PHASES) with LotsOfTimers, and the outputs of the
+run get a profile (seconds, calls and peak memory per tick and phase, see
+LotsOfTimers.report) and a profile_summary (per phase, see summarise_profile).
+
+profile: true also records the peak of the memory allocated in every call of a phase,
+with tracemalloc (which doesn't see the memory allocated inside numba kernels). Tracing
+slows runs down, so profile: time only times them. Without profile the phases are timed
+by NO_TIMERS, which does nothing.
+"""
+
+import contextlib
+import threading
 import time
+import tracemalloc
+
 import numpy as np
+import pandas as pd
+
+# the phases of a tick, in the order they run (see Simulation.step). With n_threads
+# above 1 the consumer phases of the chunks run at the same time, and are timed together
+# as consumer_threads; in a sharded run they run in the shards, and are timed together
+# as shards
+PHASES = [
+    "scenario",
+    "births",
+    "deaths",
+    "request_selection",
+    "granting",
+    "innovation_existing",
+    "innovation_new_category",
+    "consumer_choice",
+    "bookkeeping",
+    "porting",
+    "consumer_threads",
+    "shards",
+    "tracking",
+]
+
+# timers may record from several threads
+_lock = threading.Lock()
 
 
 class Timer(object):
@@ -11,6 +51,8 @@ class Timer(object):
         self._start_epoch = None
         self._stop_epoch = None
         self._elapsed_times = []
+        self._ticks = []
+        self._peaks = []
         self._summary = None
 
     def start(self):
@@ -23,10 +65,19 @@ class Timer(object):
 
     def stop(self):
         self._stop_epoch = time.time()
-        self._elapsed_times.append(self._stop_epoch - self._start_epoch)
+        self.record(self._stop_epoch - self._start_epoch)
         self._start_epoch = None
         self._stop_epoch = None
 
+    def record(self, seconds, tick=None, peak=np.nan):
+        """
+        adds a call that took seconds, in tick, with a peak of peak bytes allocated
+        """
+        with _lock:
+            self._elapsed_times.append(seconds)
+            self._ticks.append(tick)
+            self._peaks.append(peak)
+
     def summarize(self):
         self._summary = np.array(self._elapsed_times).mean()
 
@@ -45,15 +96,53 @@ class Timer(object):
             )
 
 
+def _reset_peak():
+    """
+    starts a new peak of the memory traced, returning the memory traced now
+    """
+    if hasattr(tracemalloc, "reset_peak"):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        return current
+    # before python 3.9: forget the blocks allocated so far, which resets the peak
+    tracemalloc.clear_traces()
+    return 0
+
+
+class _Phase(object):
+    """
+    times one call of a phase, see LotsOfTimers.phase
+    """
+    def __init__(self, timers, timer, memory):
+        self.timers = timers
+        self.timer = timer
+        self.memory = memory
+
+    def __enter__(self):
+        if self.memory:
+            self.base = _reset_peak()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        peak = np.nan
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1] - self.base
+        self.timer.record(seconds, self.timers.current_tick, peak)
+
+
 class LotsOfTimers(object):
     """
-    An class to bundle multiple timers
+    An class to bundle multiple timers. memory: also record the peak memory allocated in
+    the phases, see phase
     """
-    def __init__(self, names=None):
+    def __init__(self, names=None, memory=False):
         if names:
             self._timers = {n: Timer(n) for n in names}
         else:
             self._timers = {}
+        self.memory = memory
+        self.current_tick = None
 
     def add(self, name):
         self._timers[name] = Timer(name)
@@ -71,8 +160,127 @@ class LotsOfTimers(object):
         for timer in self._timers.values():
             timer.stop()
 
+    def phase(self, name, memory=True):
+        """
+        a context manager timing a call of phase name in the current tick (see tick),
+        and the peak memory it allocates if memory is set here and in the timers.
+        Phases don't nest, and are timed from one thread: the peak of a phase that runs
+        on several threads mixes up their allocations, so it is timed with memory False
+        """
+        if name not in self._timers:
+            self.add(name)
+        return _Phase(self, self._timers[name], self.memory and memory)
+
+    @contextlib.contextmanager
+    def tick(self, tick):
+        """
+        a context manager for the phases of tick, timing the whole tick as "tick". If
+        memory is set, tracemalloc traces the tick unless it was tracing already
+        """
+        self.current_tick = tick
+        tracing = self.memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        if "tick" not in self._timers:
+            self.add("tick")
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._timers["tick"].record(time.perf_counter() - start, tick)
+            if tracing:
+                tracemalloc.stop()
+            self.current_tick = None
+
+    def report(self):
+        """
+        a DataFrame with a row per tick and phase timed in it: the seconds of the calls
+        of the phase in the tick, the number of calls and the largest peak of memory
+        allocated in a call (bytes, NaN without memory)
+        """
+        rows = [
+            (tick, name, seconds, peak)
+            for name, timer in self._timers.items()
+            for seconds, tick, peak in zip(
+                timer._elapsed_times, timer._ticks, timer._peaks
+            )
+            if tick is not None
+        ]
+        df = pd.DataFrame(rows, columns=["tick", "phase", "seconds", "peak_bytes"])
+        grouped = df.groupby(["tick", "phase"], sort=False)
+        report = pd.DataFrame(
+            {
+                "seconds": grouped["seconds"].sum(),
+                "calls": grouped["seconds"].size(),
+                "peak_bytes": grouped["peak_bytes"].max(),
+            }
+        ).reset_index()
+        order = {name: i for i, name in enumerate(PHASES + ["tick"])}
+        report["order"] = report.phase.map(order)
+        report = report.sort_values(["tick", "order"]).drop(columns="order")
+        return report.reset_index(drop=True)
+
     def __str__(self):
         if len(self._timers) > 0:
             return "\n".join([str(x) for x in self._timers.values()])
         else:
             return "no timers"
+
+
+class _NoPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NoTimers(object):
+    """
+    the timers of a simulation that isn't profiled: phases and ticks are not timed
+    """
+    _no_phase = _NoPhase()
+
+    def phase(self, name, memory=True):
+        return self._no_phase
+
+    def tick(self, tick):
+        return self._no_phase
+
+
+NO_TIMERS = NoTimers()
+
+
+def make_timers(profile):
+    """
+    the timers for the profile setting of general_dict: false, true or time (see the
+    top of this module)
+    """
+    assert profile in (False, True, None, "time"), "unknown profile: " + str(profile)
+    if not profile:
+        return NO_TIMERS
+    return LotsOfTimers(memory=profile is True)
+
+
+def summarise_profile(report):
+    """
+    per phase of a profile (see LotsOfTimers.report): the ticks it ran in, its calls,
+    its seconds in total, per tick (mean, median and largest), its share of the time of
+    the ticks, and its largest peak of memory allocated (bytes)
+    """
+    grouped = report.groupby("phase", sort=False)
+    seconds = grouped["seconds"]
+    total = report.loc[report.phase == "tick", "seconds"].sum()
+    summary = pd.DataFrame(
+        {
+            "ticks": seconds.size(),
+            "calls": grouped["calls"].sum(),
+            "seconds": seconds.sum(),
+            "mean_seconds": seconds.mean(),
+            "median_seconds": seconds.median(),
+            "max_seconds": seconds.max(),
+            "share": seconds.sum() / total if total > 0 else np.nan,
+            "peak_bytes": grouped["peak_bytes"].max(),
+        }
+    )
+    return summary.reindex([x for x in PHASES + ["tick"] if x in summary.index])
@@ -0,0 +1,196 @@
+"""
+The report stage: renders the figures of model/figures.py to html files.
+
+All html files in a report share a single plotly.min.js written next to them, instead of
+each embedding its own copy. Figures are rendered in parallel in a process pool.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# name of the figure (and its html file): (plotting function, outputs used, keyword
+# arguments). A keyword argument set to None is filled in with the plot_mode
+FIGURES = {
+    "quality_by_category": ("plot_quality_by_category", ["quality"], {}),
+    "quality_by_firm": ("plot_quality_by_firm", ["quality"], {}),
+    "market_entry": ("plot_market_entry", ["cat_entry_and_exit_df"], {}),
+    "market_concentration": ("plot_market_concentration", ["market_share_df"], {}),
+    "firm_specialisation": (
+        "plot_firm_specialisation",
+        ["firm_specialisation_df"],
+        {},
+    ),
+    "complimentarity": ("plot_complimentarity", ["complimentarity_df"], {}),
+    "new_products": ("plot_new_products", ["new_products_new_cat"], {"new": True}),
+    "existing_products": ("plot_new_products", ["new_products_existing_cat"], {}),
+    "welfare": ("plot_welfare", ["welfare_df"], {}),
+    "market_share": ("plot_market_share_timeline", ["market_share_timeline_df"], {}),
+    "firm_usage": ("plot_firm_engagement", ["firm_usage_df"], {"mode": None}),
+    "concern_evo": ("plot_concern", ["concern_evo"], {"mode": None}),
+    "privacy_score": ("plot_privacy_score", ["ps_score_evo"], {"mode": None}),
+    "capital": ("plot_capital", ["capital"], {"mode": None}),
+    "data_requests": ("plot_data_requests", ["data_request_plot_df"], {}),
+}
+
+# the figures of an ensemble (see ensemble.py), made from the summaries of its outputs
+ENSEMBLE_FIGURES = {
+    "market_share": (
+        "plot_ensemble_timeline",
+        ["market_share"],
+        {
+            "title": "Market share of top three firms in each category",
+            "yaxis": "% of category served by top three",
+        },
+    ),
+    "market_concentration": (
+        "plot_ensemble_by_category",
+        ["market_concentration"],
+        {
+            "title": "Market share of top three firms in each category",
+            "yaxis": "% of category served by top three",
+        },
+    ),
+    "quality": (
+        "plot_ensemble_by_category",
+        ["quality"],
+        {"title": "(Highest) quality per category", "yaxis": "Quality"},
+    ),
+    "firms_per_category": (
+        "plot_ensemble_by_category",
+        ["firms_per_category"],
+        {"title": "Number of firms per category", "yaxis": "Firms"},
+    ),
+    "active_firms": (
+        "plot_ensemble_timeline",
+        ["active_firms"],
+        {"title": "Firms with products in use", "yaxis": "Firms"},
+    ),
+    "products_used": (
+        "plot_ensemble_timeline",
+        ["products_used"],
+        {"title": "Products in use", "yaxis": "Products"},
+    ),
+    "capital": (
+        "plot_ensemble_timeline",
+        ["capital"],
+        {"title": "Mean capital of firms", "yaxis": "Capital"},
+    ),
+    "concern": (
+        "plot_ensemble_timeline",
+        ["concern"],
+        {"title": "Mean privacy concern over time", "yaxis": "Privacy concern"},
+    ),
+    "privacy_score": (
+        "plot_ensemble_timeline",
+        ["privacy_score"],
+        {"title": "Mean privacy score over time", "yaxis": "Privacy score"},
+    ),
+    "new_products": (
+        "plot_ensemble_timeline",
+        ["new_products_new_cat"],
+        {"title": "Cumulative number of products released in new categories"},
+    ),
+    "existing_products": (
+        "plot_ensemble_timeline",
+        ["new_products_existing_cat"],
+        {"title": "Cumulative number of products released in existing categories"},
+    ),
+    "investment": (
+        "plot_ensemble_timeline",
+        ["investment"],
+        {"title": "investment choices"},
+    ),
+}
+
+PLOTLYJS = "plotly.min.js"
+
+
+def write_plotlyjs(output_dir):
+    """
+    writes the plotly.js bundle that all html files in output_dir refer to
+    """
+    import plotly.offline as py
+
+    path = os.path.join(output_dir, PLOTLYJS)
+    if not os.path.exists(path):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(py.get_plotlyjs())
+
+
+def render_figure(name, inputs, kwargs, output_dir, function_name=None):
+    """
+    draws one figure and writes it to <output_dir>/<name>.html, with function_name
+    in figures.py (by default the one of name in FIGURES)
+    """
+    # plotting libraries are only imported when figures are made
+    import plotly.offline as py
+    import model.figures as figures
+
+    if function_name is None:
+        function_name = FIGURES[name][0]
+    fig = getattr(figures, function_name)(*inputs, **kwargs)
+    filename = os.path.join(output_dir, name + ".html")
+    py.plot(fig, filename=filename, auto_open=False, include_plotlyjs="directory")
+    return filename
+
+
+def write_index(output_dir, names):
+    """
+    a single page showing all figures in the report
+    """
+    frame = '<iframe src="{}.html" style="width:100%;height:600px;border:0"></iframe>'
+    frames = "\n".join(frame.format(name) for name in names)
+    with open(os.path.join(output_dir, "index.html"), "w") as f:
+        f.write("<html>\n<body>\n" + frames + "\n</body>\n</html>\n")
+
+
+def render_report(
+    out, output_dir, plots=None, plot_mode="auto", n_workers=None, figures=FIGURES
+):
+    """
+    Renders the figures named in plots (all of figures if None) from the outputs out of a
+    simulation run. Only the outputs the figures need are accessed.
+    n_workers: number of processes used for rendering, 1 renders in this process
+    """
+    names = list(figures.keys()) if plots is None else list(plots)
+    unknown = [x for x in names if x not in figures]
+    assert not unknown, "unknown plots requested: " + ", ".join(unknown)
+    if not names:
+        return []
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    write_plotlyjs(output_dir)
+
+    tasks = []
+    for name in names:
+        function_name, output_names, kwargs = figures[name]
+        kwargs = {k: plot_mode if v is None else v for k, v in kwargs.items()}
+        inputs = [out[x] for x in output_names]
+        tasks.append((name, inputs, kwargs, output_dir, function_name))
+
+    if n_workers is None:
+        n_workers = min(len(tasks), os.cpu_count() or 1)
+    if n_workers <= 1:
+        filenames = [render_figure(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            filenames = list(pool.map(render_figure, *zip(*tasks)))
+    write_index(output_dir, names)
+    return filenames
+
+
+def render_ensemble_report(ensemble, output_dir, plots=None, n_workers=None):
+    """
+    Renders the figures named in plots (by default all of ENSEMBLE_FIGURES the outputs
+    of the ensemble allow) of an ensemble.Ensemble
+    """
+    summaries = ensemble.summaries()
+    if plots is None:
+        plots = [
+            name
+            for name, (_, output_names, _) in ENSEMBLE_FIGURES.items()
+            if all(x in summaries for x in output_names)
+        ]
+    return render_report(
+        summaries, output_dir, plots, n_workers=n_workers, figures=ENSEMBLE_FIGURES
+    )
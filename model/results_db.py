@@ -0,0 +1,243 @@
+"""
+An index of the runs of a sweep in a local SQLite database (<output_dir>/results.db), to
+ask questions like "the median concentration against openness_lower, without a cartel"
+without loading the outputs of every run.
+
+Every run has a row in runs with its directory, run time and the path of its stored
+outputs (see storage.py), which stay on disk next to it. Its parameters (every value in
+the parameter yaml, under its dotted key, e.g. openness_dict.cartel) are rows of
+parameters, and its metrics (scalar summaries of its outputs, e.g. sweep.METRICS) rows
+of metrics. Both are indexed by name and value, so a query filtered on parameters only
+reads the rows of the runs it matches.
+
+The database is in WAL mode, so the workers of a sweep add their runs concurrently
+while it is read; a writer waits for the others (up to TIMEOUT seconds).
+"""
+
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+from .storage import load_results
+
+DB_NAME = "results.db"
+# seconds a connection waits for another process that is writing
+TIMEOUT = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    run_dir TEXT UNIQUE NOT NULL,
+    results TEXT,
+    run_time REAL,
+    added REAL,
+    config TEXT
+);
+CREATE TABLE IF NOT EXISTS parameters (
+    run_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value
+);
+CREATE INDEX IF NOT EXISTS parameters_name_value ON parameters (name, value, run_id);
+CREATE INDEX IF NOT EXISTS parameters_run ON parameters (run_id);
+CREATE TABLE IF NOT EXISTS metrics (
+    run_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS metrics_name ON metrics (name, run_id);
+CREATE INDEX IF NOT EXISTS metrics_run ON metrics (run_id);
+"""
+
+
+def _value(x):
+    """
+    a parameter value as sqlite stores it: numbers, text, or json for lists
+    """
+    if isinstance(x, np.generic):
+        x = x.item()
+    if isinstance(x, (list, tuple, dict)):
+        return json.dumps(x, sort_keys=True)
+    return x
+
+
+def flatten(config, prefix=""):
+    """
+    the values of a (nested) parameter dict under their dotted keys
+    """
+    flat = {}
+    for key, value in config.items():
+        name = prefix + str(key)
+        if isinstance(value, dict) and value:
+            flat.update(flatten(value, name + "."))
+        else:
+            flat[name] = _value(value)
+    return flat
+
+
+class ResultsDB(object):
+    """
+    the index of the runs in a directory, see the top of this module. path: the
+    database file, or a directory to keep it in as results.db
+    """
+
+    def __init__(self, path):
+        if os.path.isdir(path):
+            path = os.path.join(path, DB_NAME)
+        self.path = path
+        self.root = os.path.dirname(os.path.abspath(path))
+        # autocommit: transactions are begun explicitly
+        self.conn = sqlite3.connect(path, timeout=TIMEOUT, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _relative(self, path):
+        return os.path.relpath(os.path.abspath(path), self.root)
+
+    def add_run(self, run_dir, config, outputs=None, metrics=None, run_time=None):
+        """
+        adds the run in run_dir with parameters config to the index, replacing an
+        earlier entry of run_dir. outputs: its outputs, to compute metrics from (a dict
+        of name: function of the outputs); metrics that fail (e.g. because the output
+        they need isn't stored) are left out
+        """
+        values = {}
+        for name, metric in (metrics or {}).items():
+            try:
+                values[name] = float(metric(outputs))
+            except (KeyError, ValueError, TypeError, IndexError):
+                continue
+        parameters = flatten(config)
+        results = os.path.join(run_dir, "results")
+        cursor = self.conn.cursor()
+        # take the write lock now, instead of when the first row is written
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute(
+                "SELECT id FROM runs WHERE run_dir = ?", (self._relative(run_dir),)
+            )
+            old = cursor.fetchone()
+            if old is not None:
+                for table in ("parameters", "metrics"):
+                    cursor.execute("DELETE FROM {} WHERE run_id = ?".format(table), old)
+                cursor.execute("DELETE FROM runs WHERE id = ?", old)
+            cursor.execute(
+                "INSERT INTO runs (run_dir, results, run_time, added, config) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    self._relative(run_dir),
+                    self._relative(results),
+                    run_time,
+                    time.time(),
+                    json.dumps(config, sort_keys=True, default=_value),
+                ),
+            )
+            run_id = cursor.lastrowid
+            cursor.executemany(
+                "INSERT INTO parameters VALUES (?, ?, ?)",
+                [(run_id, k, v) for k, v in parameters.items()],
+            )
+            cursor.executemany(
+                "INSERT INTO metrics VALUES (?, ?, ?)",
+                [(run_id, k, v) for k, v in values.items()],
+            )
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+
+    def has_run(self, run_dir):
+        return (
+            self.conn.execute(
+                "SELECT 1 FROM runs WHERE run_dir = ?", (self._relative(run_dir),)
+            ).fetchone()
+            is not None
+        )
+
+    def varied(self):
+        """
+        the names of the parameters that differ between runs
+        """
+        return [
+            row[0]
+            for row in self.conn.execute(
+                "SELECT name FROM parameters GROUP BY name "
+                "HAVING COUNT(DISTINCT value) > 1 ORDER BY name"
+            )
+        ]
+
+    def metric_names(self):
+        return [
+            row[0]
+            for row in self.conn.execute("SELECT DISTINCT name FROM metrics ORDER BY 1")
+        ]
+
+    def query(self, where=None, parameters=None, metrics=None):
+        """
+        a DataFrame with a row per run matching where ({dotted key: a value or a list of
+        values}), indexed by run directory, with the values of parameters (default: the
+        ones that differ between runs) and metrics (default: all), e.g.
+            db.query({"openness_dict.cartel": False}, ["openness_dict.openness_lower"])
+              .groupby("openness_dict.openness_lower")["concentration"].median()
+        """
+        joins, args = [], []
+        for i, (name, value) in enumerate((where or {}).items()):
+            values = value if isinstance(value, list) else [value]
+            joins.append(
+                "JOIN parameters w{0} ON w{0}.run_id = runs.id AND w{0}.name = ? "
+                "AND w{0}.value IN ({1})".format(i, ", ".join("?" * len(values)))
+            )
+            args += [name] + [_value(v) for v in values]
+        matched = "SELECT runs.id FROM runs " + " ".join(joins)
+        runs = pd.read_sql_query(
+            "SELECT id, run_dir, run_time FROM runs WHERE id IN ({})".format(matched),
+            self.conn,
+            params=args,
+            index_col="id",
+        )
+        if parameters is None:
+            parameters = self.varied()
+        if metrics is None:
+            metrics = self.metric_names()
+        for table, names in (("parameters", parameters), ("metrics", metrics)):
+            if not names:
+                continue
+            rows = pd.read_sql_query(
+                "SELECT run_id, name, value FROM {} WHERE name IN ({}) "
+                "AND run_id IN ({})".format(
+                    table, ", ".join("?" * len(names)), matched
+                ),
+                self.conn,
+                params=list(names) + args,
+            )
+            wide = rows.pivot(index="run_id", columns="name", values="value")
+            runs = runs.join(wide.reindex(columns=list(names)))
+        return runs.set_index("run_dir")
+
+    def load(self, run_dir, outputs=None):
+        """
+        the stored outputs of a run in the index, see storage.load_results
+        """
+        row = self.conn.execute(
+            "SELECT results FROM runs WHERE run_dir = ?", (run_dir,)
+        ).fetchone()
+        assert row is not None, "no run {} in {}".format(run_dir, self.path)
+        return load_results(os.path.join(self.root, row[0]), outputs=outputs)
+
+    def config(self, run_dir):
+        """
+        the parameters of a run in the index
+        """
+        row = self.conn.execute(
+            "SELECT config FROM runs WHERE run_dir = ?", (run_dir,)
+        ).fetchone()
+        assert row is not None, "no run {} in {}".format(run_dir, self.path)
+        return json.loads(row[0])
@@ -0,0 +1,42 @@
+"""
+Random number streams, for common random numbers and reproducible parallel execution.
+
+In the legacy mode every draw of a run comes from one RandomState(overall_seed), so any
+change in the number of draws (e.g. more data requests, or the scenario) shifts every
+later draw, and no phase can be split up without changing the results.
+
+In the common mode every phase of every tick draws from its own stream, and the
+consumer phases from a stream per chunk of consumers. A stream is a Generator on the
+counter-based Philox bit generator, seeded by a SeedSequence with the spawn key
+(phase, tick, chunk), so streams are independent, cheap to create in any order, and only
+depend on the overall seed and their key:
+- two runs with the same seeds (e.g. cartel vs. open) use the same random numbers
+  wherever they behave the same, as draws are made for every agent
+- chunks of consumers can be computed in any order or in parallel, with the same results
+"""
+
+import numpy as np
+
+RNG_MODES = ["legacy", "common"]
+
+# the key of every phase that draws random numbers; never renumber these, as that
+# changes the results of the common mode
+PHASE_KEYS = {
+    "setup": 0,
+    "births": 1,
+    "data_requests": 2,
+    "granting": 3,
+    "innovation": 4,
+    "needs": 5,
+    "choice": 6,
+}
+
+
+def phase_stream(seed, phase, tick, chunk=0):
+    """
+    the random number generator of one phase (and chunk of consumers) in one tick
+    """
+    seed_sequence = np.random.SeedSequence(
+        seed, spawn_key=(PHASE_KEYS[phase], int(tick), chunk)
+    )
+    return np.random.Generator(np.random.Philox(seed_sequence))
@@ -0,0 +1,351 @@
+"""
+A local daemon that runs simulations for other processes (a dashboard, a notebook loop),
+so that they don't pay for starting python, importing the model and compiling the numba
+kernels on every run. It keeps a pool of warm worker processes: every worker imports
+the model and runs a small simulation once at start-up, which compiles the kernels, and
+keeps the worlds of its runs in memory (see world.py) for the next ones.
+
+The daemon serves HTTP on localhost:
+    POST /run: the parameters of a run as JSON or YAML, sections of which replace the
+        ones of the base parameters of the daemon (so {"openness_dict": {...}} is
+        enough). The response is a JSON message per line: {"tick": t, "n_ticks": T}
+        after every tick, then {"results": <directory>, "cached": ..., "seconds": ...}
+        with the stored outputs of the run (see storage.py), or {"error": traceback}
+    GET /status: the number of workers, of busy workers and of runs served
+The outputs are stored in the result cache of the daemon (see cache.py), so a repeated
+request is answered from the cache (profiled runs aren't cached). Every request gets its
+outputs in a directory of its own in <cache directory>/.requests, hard linked to the
+cache entry where possible, so that they outlive the eviction of the entry; these are
+removed after REQUEST_HOURS. request_run is the client side.
+
+A request waits for a free worker. A worker that dies is replaced.
+"""
+
+import copy
+import json
+import os
+import queue
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import traceback
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing import Pipe, Process
+from socketserver import ThreadingMixIn
+
+import yaml
+
+from .cache import ResultCache, cacheable
+from .simulation import create_simulation
+from .storage import load_results, save_results
+from .world import use_world_store
+
+DEFAULT_PORT = 8765
+DEFAULT_URL = "http://127.0.0.1:{}".format(DEFAULT_PORT)
+
+# a run small enough to take next to no time, to compile the kernels with: of
+# individual consumers, also if the base parameters are in cohort mode
+WARM_UP = {
+    "general_dict": {"n_ticks": 4, "n_consumers": 20, "n_shards": 1},
+    "category_dict": {"n_init_categories": 4, "n_total_categories": 6},
+    "cohort_dict": {"n_archetypes": None},
+}
+
+
+def merge(base, request):
+    """
+    the base parameters with the sections in request replacing theirs, key by key
+    """
+    params = copy.deepcopy(base)
+    for section, values in (request or {}).items():
+        if isinstance(values, dict):
+            params.setdefault(section, {}).update(copy.deepcopy(values))
+        else:
+            params[section] = copy.deepcopy(values)
+    return params
+
+
+# the outputs of requests are kept this many hours
+REQUEST_HOURS = 24
+
+
+def request_directory(cache_dir):
+    """
+    a new directory for the outputs of a request, in the .requests directory of
+    cache_dir (which the cache leaves alone). The directories of requests older than
+    REQUEST_HOURS are removed
+    """
+    directory = os.path.join(cache_dir, ".requests")
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    cutoff = time.time() - REQUEST_HOURS * 3600
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            continue
+    return tempfile.mkdtemp(dir=directory)
+
+
+def _link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def link_results(path, directory):
+    """
+    hard links the stored outputs in path (or copies them, where that isn't possible)
+    to directory. Returns False if they aren't there, e.g. evicted from the cache
+    """
+    try:
+        shutil.copytree(path, directory, copy_function=_link_or_copy)
+        return True
+    except (OSError, shutil.Error):
+        shutil.rmtree(directory, ignore_errors=True)
+        return False
+
+
+def serve_runs(connection, base, cache_dir, cache_size):
+    """
+    the worker process of the daemon: warms up, then runs the parameters it gets over
+    connection, sending ("tick", tick, n_ticks) after every tick and ("done", results
+    directory, cached) or ("error", traceback) at the end of a run, until it gets None
+    """
+    # ctrl-c stops the daemon, which stops its workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    cache = ResultCache(cache_dir, cache_size)
+    use_world_store(cache_dir)
+    sim = create_simulation(**merge(base, WARM_UP))
+    sim.run_until()
+    results = sim.results()
+    for name in results:
+        results[name]
+    connection.send(("ready",))
+    while True:
+        try:
+            params = connection.recv()
+        except EOFError:
+            break
+        if params is None:
+            break
+        try:
+            path = os.path.join(request_directory(cache_dir), "results")
+            cached = cache.get(params) is not None and link_results(
+                cache.path(params), path
+            )
+            if not cached:
+                sim = create_simulation(**copy.deepcopy(params))
+                while sim.tick < sim.n_ticks and sim.stop_reason is None:
+                    sim.run_until(sim.tick + 1)
+                    connection.send(("tick", sim.tick, sim.n_ticks))
+                outputs = params.get("output_dict", {}).get("outputs")
+                results = sim.results(outputs)
+                cache.put(params, results)
+                # not cached, or already evicted
+                if not (cacheable(params) and link_results(cache.path(params), path)):
+                    save_results(results, path)
+            connection.send(("done", path, cached))
+        except Exception:
+            connection.send(("error", traceback.format_exc()))
+    connection.close()
+
+
+class Worker(object):
+    def __init__(self, base, cache_dir, cache_size):
+        self.connection, worker_connection = Pipe()
+        # not a daemon process: sharded runs start processes of their own
+        self.process = Process(
+            target=serve_runs,
+            args=(worker_connection, base, cache_dir, cache_size),
+        )
+        self.process.start()
+        worker_connection.close()
+
+    def wait_ready(self):
+        assert self.connection.recv() == ("ready",), "the worker failed to start"
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join()
+
+
+class WorkerPool(object):
+    """
+    n_workers warm workers, see the top of this module
+    """
+
+    def __init__(self, n_workers, base, cache_dir, cache_size):
+        self.args = (base, cache_dir, cache_size)
+        self.workers = [Worker(*self.args) for _ in range(n_workers)]
+        for worker in self.workers:
+            worker.wait_ready()
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+        self.lock = threading.Lock()
+        self.n_runs = 0
+
+    def run(self, params):
+        """
+        runs params on a free worker, yielding the messages of the worker (see
+        serve_runs)
+        """
+        worker = self.idle.get()
+        finished = False
+        try:
+            worker.connection.send(params)
+            while not finished:
+                message = worker.connection.recv()
+                finished = message[0] in ("done", "error")
+                yield message
+        except (EOFError, OSError):
+            finished = True
+            worker = self.replace(worker)
+            yield ("error", "the worker running the simulation died")
+        finally:
+            # the client went away: wait for the run to end before reusing the worker
+            while not finished:
+                try:
+                    finished = worker.connection.recv()[0] in ("done", "error")
+                except (EOFError, OSError):
+                    finished = True
+                    worker = self.replace(worker)
+            with self.lock:
+                self.n_runs += 1
+            self.idle.put(worker)
+
+    def replace(self, worker):
+        worker.process.join()
+        new = Worker(*self.args)
+        new.wait_ready()
+        with self.lock:
+            self.workers[self.workers.index(worker)] = new
+        return new
+
+    def status(self):
+        return {
+            "workers": len(self.workers),
+            "busy": len(self.workers) - self.idle.qsize(),
+            "runs": self.n_runs,
+        }
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+
+
+class RunHandler(BaseHTTPRequestHandler):
+    def send_json(self, message):
+        self.wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path != "/status":
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.send_json(self.server.pool.status())
+
+    def do_POST(self):
+        if self.path != "/run":
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            # JSON is YAML too
+            request = yaml.safe_load(body.decode("utf-8"))
+            assert request is None or isinstance(request, dict)
+        except Exception:
+            self.send_error(400, "the parameters must be a JSON or YAML mapping")
+            return
+        params = merge(self.server.base, request)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        start = time.time()
+        for message in self.server.pool.run(params):
+            if message[0] == "tick":
+                self.send_json({"tick": message[1], "n_ticks": message[2]})
+            elif message[0] == "done":
+                self.send_json(
+                    {
+                        "results": message[1],
+                        "cached": message[2],
+                        "seconds": time.time() - start,
+                    }
+                )
+            else:
+                self.send_json({"error": message[1]})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class RunServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, pool, base, verbose=True):
+        super().__init__(address, RunHandler)
+        self.pool = pool
+        self.base = base
+        self.verbose = verbose
+
+
+def serve(base, host="127.0.0.1", port=DEFAULT_PORT, n_workers=1, cache=None):
+    """
+    runs the daemon with the base parameters base until it is interrupted. cache: the
+    ResultCache the outputs are stored in (by default the one in DEFAULT_CACHE_DIR)
+    """
+    if cache is None:
+        cache = ResultCache()
+    pool = WorkerPool(n_workers, base, cache.cache_dir, cache.max_bytes / 1e9)
+    server = RunServer((host, port), pool, base)
+    print(
+        "serving simulations on http://{}:{} with {} workers".format(
+            host, port, n_workers
+        )
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
+
+
+def request_run(params=None, url=DEFAULT_URL, progress=None, outputs=None):
+    """
+    runs params (sections replacing the base parameters of the daemon) on the daemon at
+    url and returns the outputs, see storage.load_results. progress(tick, n_ticks) is
+    called after every tick
+    """
+    request = urllib.request.Request(
+        url.rstrip("/") + "/run",
+        data=json.dumps(params or {}).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request) as response:
+        for line in response:
+            message = json.loads(line.decode("utf-8"))
+            if "tick" in message:
+                if progress is not None:
+                    progress(message["tick"], message["n_ticks"])
+            elif "error" in message:
+                raise RuntimeError("the run failed on the daemon:\n" + message["error"])
+            else:
+                return load_results(message["results"], outputs=outputs)
+    raise RuntimeError("the daemon closed the connection during the run")
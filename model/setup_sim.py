@@ -1,6 +1,7 @@
 import numpy as np
 
-from .needs import draw_from_one_need_distribution
+from .out_of_core import ArrayAllocator
+from .world import get_world, max_firm_births
 
 
 def setup_simulation(
@@ -14,20 +15,29 @@ def setup_simulation(
     privacy_dict,
     openness_dict,
     innovation_dict,
+    consumer_state=True,
+    arrays=None,
 ):
+    """
+    the initial state of a simulation. With consumer_state False, the state arrays with
+    a row per consumer that start empty (usage, usage counter, data, privacy mask) get
+    no rows, for a simulation that keeps its consumers elsewhere (see sharded.py).
+    arrays: the ArrayAllocator of the largest arrays (see out_of_core.py), by default
+    they are all in memory
+    """
+    if arrays is None:
+        arrays = ArrayAllocator()
 
     # grab constants
     n_ticks = general_dict["n_ticks"]
     n_init_firms = general_dict["n_init_firms"]
     n_init_big_firms = general_dict["n_init_big_firms"]
     n_consumers = general_dict["n_consumers"]
+    n_rows = n_consumers if consumer_state else 0
     n_total_categories = category_dict["n_total_categories"]
     n_init_categories = category_dict["n_init_categories"]
 
-    # Estimating how many firms there will eventually be in the model (high upper bound)
-    mean_new_firms = general_dict["birth_lambda"] * n_ticks
-    var_new_firms = mean_new_firms
-    max_new_firms = np.floor(mean_new_firms + 1 * np.sqrt(var_new_firms)).astype(int)
+    max_new_firms = max_firm_births(general_dict)
     n_total_firms = n_init_firms + max_new_firms
 
     # indicator vector: is the firm still in business?
@@ -42,7 +52,7 @@ def setup_simulation(
         ]
     )
     # setting up usage matrix (consumer, category, firm)
-    usage = np.zeros((n_consumers, n_total_categories, n_total_firms))
+    usage = np.zeros((n_rows, n_total_categories, n_total_firms))
 
     # quality matrix set-up: zero if product not in firm portfolio
     quality = np.zeros((n_init_firms + max_new_firms, n_total_categories))
@@ -53,32 +63,6 @@ def setup_simulation(
     # big firms have higher quality products
     quality[:n_init_big_firms] *= 2
 
-    # privacy score setup
-    privacy_rng = np.random.RandomState(seed=seed_dict["privacy_seed"])
-    firm_privacy_score = np.maximum(
-        np.minimum(
-            privacy_rng.normal(
-                privacy_dict["mean_firm_score"],
-                privacy_dict["var_firm_score"],
-                size=n_init_firms + max_new_firms,
-            ),
-            1,
-        ),
-        0,
-    )
-
-    # consumer characteristics
-    consumer_privacy_concern = np.maximum(
-        np.minimum(
-            privacy_rng.normal(
-                privacy_dict["mean_cons_concern"],
-                privacy_dict["var_cons_concern"],
-                size=n_consumers,
-            ),
-            1,
-        ),
-        0,
-    )
     consumer_wealth = 1 + rng.uniform(size=n_consumers) * 9
 
     # firm investment profile
@@ -91,115 +75,45 @@ def setup_simulation(
         "new_category"
     ]
 
-    # Assign needs for categories
-    need_matrix = np.zeros(shape=(n_consumers, n_total_categories))
-    need_rng = np.random.RandomState(seed=seed_dict["need_seed"])
-    n_modes_probs = needs_dict["n_modes_probs"]
-    for i in range(np.minimum(n_init_big_firms, n_total_categories)):
-        # assure the big firms are in high-need categories
-        modality = need_rng.choice(np.arange(len(n_modes_probs)), p=n_modes_probs)
-        if needs_dict["hyper_mode"] == "uniform":
-            modes = need_rng.uniform(
-                np.maximum(needs_dict["needs_range_mode_low"], 0.5),
-                needs_dict["needs_range_mode_high"],
-                modality,
-            )
-        if needs_dict["hyper_var"] == "uniform":
-            vars = need_rng.uniform(
-                needs_dict["needs_range_var_low"],
-                needs_dict["needs_range_var_high"],
-                modality,
-            )
-        need_matrix[:, i] = draw_from_one_need_distribution(
-            modes, vars, n_consumers, need_rng
-        )
-    for i in range(
-        np.minimum(n_init_big_firms, n_total_categories), n_total_categories
-    ):
-        modality = need_rng.choice(np.arange(len(n_modes_probs)), p=n_modes_probs)
-        if needs_dict["hyper_mode"] == "uniform":
-            modes = need_rng.uniform(
-                needs_dict["needs_range_mode_low"],
-                needs_dict["needs_range_mode_high"],
-                modality,
-            )
-        if needs_dict["hyper_var"] == "uniform":
-            vars = need_rng.uniform(
-                needs_dict["needs_range_var_low"],
-                needs_dict["needs_range_var_high"],
-                modality,
-            )
-        need_matrix[:, i] = draw_from_one_need_distribution(
-            modes, vars, n_consumers, need_rng
-        )
-
-    # datatypes for categories
-    n_data_types_init = data_dict["n_data_types_init"]
-    n_data_types_total = data_dict["n_data_types_total"]
-    data_rng = np.random.RandomState(seed=seed_dict["data_seed"])
-    category_datatype = np.zeros(
-        (n_total_categories, n_data_types_total), dtype=np.int8
+    # needs, datatypes of the categories, privacy and data combination skills: read-only
+    # and shared between runs, copied where the simulation changes them
+    world = get_world(
+        general_dict=general_dict,
+        seed_dict=seed_dict,
+        needs_dict=needs_dict,
+        data_dict=data_dict,
+        category_dict=category_dict,
+        privacy_dict=privacy_dict,
     )
-    for j in range(n_init_categories):
-        num_types = data_rng.choice(np.arange(np.minimum(n_data_types_init, 3))) + 1
-        choice_types = data_rng.choice(
-            np.arange(n_data_types_init), size=num_types, replace=False
-        )
-        category_datatype[j, choice_types] = 1
-    for e, i in enumerate(range(n_init_categories, n_total_categories)):
-        shift_num_types = np.floor(e / data_dict["growth_factor"]).astype(int)
-        num_types = (
-            data_rng.choice(
-                np.arange(np.minimum(n_data_types_total, 3 + shift_num_types))
-            )
-            + 1
-        )
-        choice_types = data_rng.choice(
-            np.arange(
-                np.minimum(n_data_types_total, n_data_types_init + 3 * shift_num_types)
-            ),
-            size=num_types,
-            replace=False,
-        )
-        category_datatype[i, choice_types] = 1
-    # remove datatypes that are not used at all
-    category_datatype = category_datatype[:, category_datatype.sum(axis=0) > 0]
+    need_matrix = world["need_matrix"]
+    category_datatype = world["category_datatype"]
+    firm_privacy_score = np.array(world["firm_privacy_score"])
+    consumer_privacy_concern = np.array(world["consumer_privacy_concern"])
+    data_combination_skill = np.array(world["data_combination_skill"])
     n_datatypes = category_datatype.shape[1]
 
     # usage counter, will be used to keep track of consumption - which will be discounted over time
-    usage_counter = np.zeros((n_consumers, n_total_categories, n_total_firms))
+    usage_counter = np.zeros((n_rows, n_total_categories, n_total_firms))
 
     # tracker of usage, capital to decide on firm death
     ticks_no_usage = np.zeros((n_init_firms + max_new_firms))
     ticks_no_capital = np.zeros((n_init_firms + max_new_firms))
 
-    # Data combination skills
-    if data_dict["data_skill_distr"] == "uniform":
-        low, hi = data_dict["data_skill_range_low"], data_dict["data_skill_range_high"]
-        data_combination_skill = data_rng.choice(
-            np.arange(low, hi), size=n_total_firms, replace=True
-        )
-
     # Data portability
     # mask - firms that haven't turned down each others requests yet
-    requestable = np.ones(
-        (
-            n_total_firms,
-            n_total_categories,
-            n_total_firms,
-            n_total_categories,
-            n_datatypes,
-        ),
-        dtype=np.int8,
+    firm_shape = (
+        n_total_firms,
+        n_total_categories,
+        n_total_firms,
+        n_total_categories,
+        n_datatypes,
     )
+    requestable = arrays.ones("requestable", firm_shape, dtype=np.int8)
     # firms won't request their own data to be shared
     requestable[np.arange(n_total_firms), :, np.arange(n_total_firms)] = 0
     # only requestable if categories have the right datatype
-    requestable = (
-        requestable
-        * category_datatype[None, :, None, None, :]
-        * category_datatype[None, None, None, :, :]
-    )
+    requestable *= category_datatype[None, :, None, None, :]
+    requestable *= category_datatype[None, None, None, :, :]
     # if there is a cartel, only get big firms will share
     if openness_dict["cartel"]:
         requestable[n_init_big_firms:] = 0
@@ -221,20 +135,13 @@ def setup_simulation(
         "usage_counter": usage_counter,
         "data_combination_skill": data_combination_skill,
         "requestable": requestable,
-        "portability_matrix": np.zeros(
-            (
-                n_total_firms,
-                n_total_categories,
-                n_total_firms,
-                n_total_categories,
-                n_datatypes,
-            )
-        ),
-        "data_value": np.zeros(
-            (n_consumers, n_total_categories, n_total_firms, n_datatypes)
+        "portability_matrix": arrays.zeros("portability_matrix", firm_shape),
+        "data_value": arrays.zeros(
+            "data_value", (n_rows, n_total_categories, n_total_firms, n_datatypes)
         ),
-        "data_held": np.zeros(
-            (n_ticks, n_consumers, n_total_categories, n_total_firms, n_datatypes)
+        "data_held": arrays.zeros(
+            "data_held",
+            (n_ticks, n_rows, n_total_categories, n_total_firms, n_datatypes),
         ),
-        "privacy_mask": np.ones((n_consumers, n_total_firms)),
+        "privacy_mask": np.ones((n_rows, n_total_firms)),
     }
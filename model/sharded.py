@@ -0,0 +1,290 @@
+"""
+Sharded execution of a single run: the consumers are partitioned over worker processes.
+
+Every shard is a process that owns the state of a range of consumers (usage, usage
+counters, data held and its value, privacy mask, needs, concern and wealth), made of
+whole chunks of the common rng_mode. The coordinator, a ShardedSimulation, owns the
+state of the firms and runs the firm phases (births, deaths, data requests, innovation)
+as usual. Every tick it copies the firm state the consumers need (quality, privacy
+scores, portability matrix) to shared memory, the shards run the consumer phases of
+their chunks, and send back only totals: payments and usage per firm and category per
+chunk, the value of the data held per firm, and what the tracker records per consumer.
+
+The chunks draw from their own random streams and the totals are added up in chunk
+order, so a sharded run gives exactly the same results as the same run in one process
+with rng_mode: common, for any number of shards. The memory for the consumers, and the
+time of the consumer phases, are divided over the shards.
+"""
+
+import multiprocessing as mp
+import traceback
+
+import numpy as np
+
+from .simulation import Simulation
+from .out_of_core import ArrayAllocator
+from .profiling import NO_TIMERS
+
+# the firm state read by the consumer phases, broadcast to the shards every tick
+SHARED_FIRM_STATE = ["quality", "firm_privacy_score", "portability_matrix"]
+
+
+def shared_array(array):
+    """
+    shared memory for a copy of array, which can be handed to worker processes
+    """
+    return mp.RawArray("b", max(array.nbytes, 1)), array.shape, array.dtype.str
+
+
+def as_array(shared):
+    """
+    the numpy array on shared memory made by shared_array
+    """
+    buffer, shape, dtype = shared
+    count = int(np.prod(shape))
+    return np.frombuffer(buffer, dtype=dtype, count=count).reshape(shape)
+
+
+class ConsumerShard(object):
+    """
+    The consumers of one shard. The consumer phases are the ones of Simulation, run on
+    the rows of the shard; chunks is a list of (chunk, slice of the shard's rows).
+    """
+
+    phase_rng = Simulation.phase_rng
+    consumer_chunk = Simulation.consumer_chunk
+    consumer_choices = Simulation.consumer_choices
+    consumer_bookkeeping = Simulation.consumer_bookkeeping
+    port_data = Simulation.port_data
+    privacy_shock = Simulation.privacy_shock
+    # the phases of the shards are timed together, by the simulation
+    profiler = NO_TIMERS
+
+    def __init__(
+        self,
+        params,
+        chunks,
+        need_matrix,
+        consumer_privacy_concern,
+        consumer_wealth,
+        category_datatype,
+        shared,
+    ):
+        self.seed_dict = params["seed_dict"]
+        self.util_weight_dict = params["util_weight_dict"]
+        self.port_dict = params["port_dict"]
+        self.rng_mode = "common"
+        self.w_logit = params["util_weight_dict"]["w_logit"]
+        self.alpha_usage_decay = params["usage_dict"]["alpha_usage_decay"]
+        self.data_worth_exp = params["data_dict"]["data_worth_exp"]
+        self.tick = 0
+        self.chunks = chunks
+        self.need_matrix = need_matrix
+        self.consumer_privacy_concern = consumer_privacy_concern
+        self.consumer_wealth = consumer_wealth
+        self.category_datatype = category_datatype
+        self.n_datatypes = category_datatype.shape[1]
+        for name, array in shared.items():
+            setattr(self, name, as_array(array))
+
+        general_dict = params["general_dict"]
+        self.arrays = ArrayAllocator(
+            general_dict.get("out_of_core") or [], general_dict.get("scratch_dir")
+        )
+        n_ticks = general_dict["n_ticks"]
+        n_consumers = need_matrix.shape[0]
+        self.n_total_firms, n_categories = self.quality.shape
+        shape = (n_consumers, n_categories, self.n_total_firms)
+        self.usage = np.zeros(shape)
+        self.usage_counter = np.zeros(shape)
+        self.usage_counter_raw = np.zeros(shape)
+        self.uninterrupted_usage = np.zeros(shape)
+        self.data_value = self.arrays.zeros("data_value", shape + (self.n_datatypes,))
+        self.data_held = self.arrays.zeros(
+            "data_held", (n_ticks,) + shape + (self.n_datatypes,)
+        )
+        self.privacy_mask = np.ones((n_consumers, self.n_total_firms))
+
+    def chunk_data_values(self):
+        return [self.data_value[c].sum(axis=(0, 1)) for _, c in self.chunks]
+
+    def consumer_phases(self, tick):
+        """
+        the consumer phases of tick, chunk by chunk. Returns the totals of every chunk,
+        the value of the data held on every chunk, the usage per (category, firm), the
+        firms used by every consumer, and the privacy concerns
+        """
+        self.tick = tick
+        usage = np.zeros(self.usage.shape, dtype=int)
+        totals = [
+            self.consumer_chunk(chunk, consumers, usage)
+            for chunk, consumers in self.chunks
+        ]
+        self.usage = usage
+        return (
+            totals,
+            self.chunk_data_values(),
+            usage.sum(axis=0),
+            usage.sum(axis=1) > 0,
+            self.consumer_privacy_concern,
+        )
+
+    def shock(self, tick, shock, deletion_draws, firm_list):
+        """
+        the privacy shock of the scenario; returns the value of the data held on every
+        chunk afterwards
+        """
+        self.tick = tick
+        self.privacy_shock(slice(None), shock, deletion_draws, firm_list)
+        return self.chunk_data_values()
+
+
+def serve_shard(connection, *args):
+    """
+    the worker process of a shard: runs the methods of a ConsumerShard(*args) asked
+    for over connection, until it is told to stop
+    """
+    shard = ConsumerShard(*args)
+    while True:
+        method, method_args = connection.recv()
+        if method == "stop":
+            break
+        try:
+            connection.send((None, getattr(shard, method)(*method_args)))
+        except Exception:
+            connection.send((traceback.format_exc(), None))
+    connection.close()
+
+
+class ShardedSimulation(Simulation):
+    """
+    A Simulation whose consumers are partitioned over general_dict["n_shards"] worker
+    processes, see the top of this module. Needs rng_mode: common. The workers stop
+    when the run is over, or with close().
+    """
+
+    consumer_state = False
+
+    def __init__(self, **params):
+        super().__init__(**params)
+        assert self.rng_mode == "common", "sharded runs need rng_mode: common"
+        assert self.n_threads == 1, "sharded runs use processes, not threads"
+        self.n_shards = self.general_dict["n_shards"]
+
+        self.shared = {
+            name: shared_array(getattr(self, name)) for name in SHARED_FIRM_STATE
+        }
+        chunks = self.consumer_chunks()
+        self.data_values = [np.zeros((self.n_total_firms, self.n_datatypes))] * len(
+            chunks
+        )
+        # whole chunks per shard
+        self.shard_rows = []
+        self.connections = []
+        self.workers = []
+        for ids in np.array_split(np.arange(len(chunks)), self.n_shards):
+            if len(ids) == 0:
+                continue
+            start, stop = chunks[ids[0]].start, chunks[ids[-1]].stop
+            local_chunks = [
+                (int(i), slice(chunks[i].start - start, chunks[i].stop - start))
+                for i in ids
+            ]
+            connection, worker_connection = mp.Pipe()
+            worker = mp.Process(
+                target=serve_shard,
+                args=(
+                    worker_connection,
+                    params,
+                    local_chunks,
+                    self.need_matrix[start:stop],
+                    self.consumer_privacy_concern[start:stop],
+                    self.consumer_wealth[start:stop],
+                    self.category_datatype,
+                    self.shared,
+                ),
+                daemon=True,
+            )
+            worker.start()
+            worker_connection.close()
+            self.shard_rows.append((start, stop))
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def __getstate__(self):
+        raise TypeError("a sharded simulation can't be pickled or checkpointed")
+
+    def ask(self, method, *args):
+        """
+        runs method with args in every shard at once, and returns their replies
+        """
+        for connection, arg in zip(self.connections, zip(*args) if args else None):
+            connection.send((method, arg))
+        replies = []
+        for connection in self.connections:
+            error, reply = connection.recv()
+            if error is not None:
+                raise RuntimeError("error in a shard:\n" + error)
+            replies.append(reply)
+        return replies
+
+    def per_shard(self, value):
+        return [value] * len(self.connections)
+
+    def broadcast(self):
+        """
+        copies the firm state the consumers need to shared memory
+        """
+        for name, shared in self.shared.items():
+            np.copyto(as_array(shared), getattr(self, name))
+
+    def consumer_phases(self):
+        with self.profiler.phase("shards"):
+            self.broadcast()
+            replies = self.ask("consumer_phases", self.per_shard(self.tick))
+        totals = [x for reply in replies for x in reply[0]]
+        self.data_values = [x for reply in replies for x in reply[1]]
+        self.usage_total = sum(reply[2] for reply in replies)
+        self.firms_used = np.concatenate([reply[3] for reply in replies])
+        for (start, stop), reply in zip(self.shard_rows, replies):
+            self.consumer_privacy_concern[start:stop] = reply[4]
+        with self.profiler.phase("bookkeeping"):
+            self.firm_bookkeeping(*[sum(x) for x in zip(*totals)])
+
+    def privacy_shock(self, consumers, shock, deletion_draws, firm_list):
+        self.consumer_privacy_concern[consumers] += shock
+        replies = self.ask(
+            "shock",
+            self.per_shard(self.tick),
+            [shock[start:stop] for start, stop in self.shard_rows],
+            [deletion_draws[start:stop] for start, stop in self.shard_rows],
+            self.per_shard(firm_list),
+        )
+        self.data_values = [x for reply in replies for x in reply]
+
+    def data_value_per_firm(self):
+        return sum(self.data_values)
+
+    def tracked_consumers(self):
+        return (self.usage_total, self.firms_used), self.consumer_privacy_concern
+
+    def category_firm_usage(self):
+        return self.usage_total
+
+    def run_until(self, tick=None):
+        stop_reason = super().run_until(tick)
+        if self.tick >= self.n_ticks or stop_reason is not None:
+            self.close()
+        return stop_reason
+
+    def close(self):
+        """
+        stops the worker processes
+        """
+        for connection in self.connections:
+            connection.send(("stop", None))
+            connection.close()
+        for worker in self.workers:
+            worker.join()
+        self.connections = []
+        self.workers = []
@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
 from .tracking import SimTracker
@@ -6,481 +8,1000 @@ import model.innovation as inno
 from .utility import utility_for_consumers, choose_firms
 from .utils import multinomial, min_max_scaler
 import model.data_handling as data
-from .privacy_scenario import delete_data
+from .privacy_scenario import delete_data, delete_data_tick_major
+from .out_of_core import ArrayAllocator
+from .estimate import preflight
+from .rng import RNG_MODES, phase_stream
+from .profiling import LotsOfTimers, NO_TIMERS, make_timers, summarise_profile
 
 
-def run(
-    general_dict={},
-    seed_dict={},
-    util_weight_dict={},
-    innovation_dict={},
-    capital_dict={},
-    needs_dict={},
-    data_dict={},
-    category_dict={},
-    usage_dict={},
-    port_dict={},
-    privacy_dict={},
-    scenario_dict={},
-    openness_dict={},
-):
+class Simulation(object):
+    """
+    The state of a simulation run, advanced one tick at a time with step(), which runs
+    the phases of a tick (births, deaths, data_requests, ...) in turn, or with
+    run_until(). The state is everything needed to continue the run, including the
+    random number generator and the tracker, so a Simulation can be checkpointed (see
+    checkpoint.py). The rules in stopping_dict can end a run before n_ticks, see
+    check_stopping; results() then has the outputs of the ticks that were run.
+    """
 
-    # unpacking some general parameters
-    n_ticks = general_dict["n_ticks"]
-    n_consumers = general_dict["n_consumers"]
-    n_init_firms = general_dict["n_init_firms"]
-    w_logit = util_weight_dict["w_logit"]
-    alpha_usage_decay = usage_dict["alpha_usage_decay"]
-    data_worth_exp = data_dict["data_worth_exp"]
-    qual_diff_param = innovation_dict["qual_diff_param"]
-    inno_low = innovation_dict["success_invest_low"]
-    inno_high = innovation_dict["success_invest_high"]
-    # setting up random number generator
-    rng = np.random.RandomState(seed=seed_dict["overall_seed"])
-
-    # setting the scene
-    setup_dict = setup_simulation(
-        general_dict,
-        seed_dict,
-        rng,
-        capital_dict,
-        needs_dict,
-        data_dict,
-        category_dict,
-        privacy_dict,
-        openness_dict,
-        innovation_dict,
-    )
-    capital = setup_dict["capital"]
-    ticks_no_capital = setup_dict["ticks_no_capital"]
-    usage = setup_dict["usage"]
-    ticks_no_usage = setup_dict["ticks_no_usage"]
-    quality = setup_dict["quality"]
-    firm_privacy_score = setup_dict["firm_privacy_score"]
-    consumer_privacy_concern = setup_dict["consumer_privacy_concern"]
-    consumer_wealth = setup_dict["consumer_wealth"]
-    F_alive = setup_dict["F_alive"]
-    need_matrix = setup_dict["need_matrix"]
-    category_datatype = setup_dict["category_datatype"]
-    n_datatypes = category_datatype.shape[1]
-    firm_investment_profile = setup_dict["firm_investment_profile"]
-    usage_counter = setup_dict["usage_counter"]
-    usage_counter_raw = np.zeros_like(usage_counter)
-    data_combination_skill = setup_dict["data_combination_skill"]
-    requestable = setup_dict["requestable"]
-    requestable_now = np.zeros_like(requestable, dtype=np.int8)
-    portability_matrix = setup_dict["portability_matrix"]
-    data_value = setup_dict["data_value"]
-    data_held = setup_dict["data_held"]
-    uninterrupted_usage = np.zeros_like(usage_counter)
-    privacy_mask = setup_dict["privacy_mask"]
-    inno_new_prod_alpha = innovation_dict["new_product_scaler_alpha"]
-
-    new_firm_new_category_prob = innovation_dict["new_firm_new_category_prob"]
-
-    i_alive = n_init_firms  # highest index of an active firm, plus one
-    cat_ever_alive = (quality.sum(axis=0) > 0).astype(int)
-    n_total_firms = capital.shape[0]
-    n_total_categories = category_dict["n_total_categories"]
-
-    category_total_usage = np.zeros(n_total_categories)
-    category_ticks_alive = (quality.sum(axis=0) > 0).astype(int)
-
-    # setting up the tracker
-    tracker = SimTracker(
-        n_ticks,
-        n_total_firms,
-        n_total_categories,
-        n_consumers,
-        quality,
-        capital_dict["small"],
-    )
-    tracker.add_needs(need_matrix)
-
-    scen_tick = -1
-    if scenario_dict:
-        scen_tick = scenario_dict["scen_tick"]
-
-    for tick in np.arange(0, n_ticks):
-
-        # SCENARIO
-        if tick == scen_tick:
-            # set up a random number generator for the scenario
-            scen_rng = np.random.RandomState(seed_dict["scenario_seed"])
-            # choose which firms to shock: the n biggest in terms of capital
-            firm_list = np.argsort(capital)[-scenario_dict["scen_number_of_firms"]:]
-            # adjust the privacy score of the affected firms
-            firm_privacy_score[firm_list] = np.maximum(
-                firm_privacy_score[firm_list] - scenario_dict["firm_hit"], 0.05
-            )
-            # Adjust consumer privacy concern
-            consumer_privacy_concern += scen_rng.normal(
-                scenario_dict["consumer_hit_mean"],
-                scenario_dict["consumer_hit_var"],
-                size=n_consumers,
-            )
-            # some people request a deletion of data and will never use the firm again
-            # (consumer, firm)
-            data_deleters = np.zeros((n_consumers, n_total_firms))
-            data_deleters[:, firm_list] = (
-                scen_rng.uniform(size=(n_consumers, len(firm_list)))
-                < consumer_privacy_concern[:, None]
-            ).astype(int)
-            # recalculate the amount of data held by the firms, and its value
-            data_held, data_value = delete_data(
-                data_deleters, data_held, data_value, tick, data_worth_exp
-            )
-            # The consumers who have requested data to be deleted by the impacted firms,
-            # will never use these firms again
-            privacy_mask *= 1 - data_deleters
-
-        if tick > 0:
-            # BIRTH OF NEW FIRMS
-            # either in new market or in existing market
-            num_new_firms = rng.poisson(general_dict["birth_lambda"])
-            # make sure we're not running out of firms
-            num_new_firms_ = np.minimum(num_new_firms, n_total_firms - i_alive)
-            if num_new_firms_ > 0:
-                # change aliveness indicator
-                F_alive[i_alive : (i_alive + num_new_firms_)] = 1
-                # give capital
-                capital[i_alive : (i_alive + num_new_firms_)] = capital_dict["small"]
-                # entering existing category or make a new one?
-                # last_cat = np.max(np.where(cat_ever_alive > 0)[0])
-                # remaining_categories = n_total_categories - last_cat - 1
-                remaining_categories = (cat_ever_alive == 0).astype(int).sum()
-                new_category_count = np.minimum(
-                    np.sum(
-                        rng.uniform(size=num_new_firms_) < new_firm_new_category_prob
-                    ),
-                    remaining_categories,
-                )
-                # assign quality 1 for companies entering a non-existing category
-                quality[
-                    i_alive + np.arange(new_category_count),
-                    np.where(cat_ever_alive == 0)[0][:new_category_count],
-                ] = 1
-                # deal with companies entering an existing category
-                existing_category_count = num_new_firms_ - new_category_count
-                if existing_category_count > 0:
-                    quality[
-                        i_alive
-                        + new_category_count
-                        + np.arange(existing_category_count)
-                    ] += inno.enter_new_category(
-                        quality,
-                        category_datatype,
-                        None,
-                        category_total_usage,
-                        category_ticks_alive,
-                        innovation_dict,
-                        qual_diff_param,
-                        rng,
-                        n=existing_category_count,
-                    )
-                # more bookkeeping
-                ticks_no_usage[i_alive : (i_alive + num_new_firms_)] = 0
-                ticks_no_capital[i_alive : (i_alive + num_new_firms_)] = 0
-                i_alive += num_new_firms_
-                cat_ever_alive = ((cat_ever_alive + quality.sum(axis=0)) > 0).astype(
-                    int
-                )
+    # False for simulations that keep the state of their consumers elsewhere
+    consumer_state = True
+    # not profiled, unless general_dict sets profile (also for older checkpoints)
+    profiler = NO_TIMERS
+
+    def __init__(
+        self,
+        general_dict={},
+        seed_dict={},
+        util_weight_dict={},
+        innovation_dict={},
+        capital_dict={},
+        needs_dict={},
+        data_dict={},
+        category_dict={},
+        usage_dict={},
+        port_dict={},
+        privacy_dict={},
+        scenario_dict={},
+        openness_dict={},
+        output_dict={},
+        stopping_dict={},
+        cohort_dict={},
+    ):
+        self.general_dict = general_dict
+        self.seed_dict = seed_dict
+        self.util_weight_dict = util_weight_dict
+        self.innovation_dict = innovation_dict
+        self.capital_dict = capital_dict
+        self.needs_dict = needs_dict
+        self.data_dict = data_dict
+        self.category_dict = category_dict
+        self.usage_dict = usage_dict
+        self.port_dict = port_dict
+        self.privacy_dict = privacy_dict
+        self.scenario_dict = scenario_dict
+        self.openness_dict = openness_dict
+        self.output_dict = output_dict
+        self.stopping_dict = stopping_dict
+        self.cohort_dict = cohort_dict
+
+        # unpacking some general parameters
+        self.n_ticks = general_dict["n_ticks"]
+        self.n_consumers = general_dict["n_consumers"]
+        self.n_init_firms = general_dict["n_init_firms"]
+        self.w_logit = util_weight_dict["w_logit"]
+        self.alpha_usage_decay = usage_dict["alpha_usage_decay"]
+        self.data_worth_exp = data_dict["data_worth_exp"]
+        self.qual_diff_param = innovation_dict["qual_diff_param"]
+        self.inno_low = innovation_dict["success_invest_low"]
+        self.inno_high = innovation_dict["success_invest_high"]
+        # setting up random number generator
+        self.rng = np.random.RandomState(seed=seed_dict["overall_seed"])
+        # legacy: all draws from rng, common: a stream per phase and tick (see rng.py)
+        self.rng_mode = seed_dict.get("rng_mode", "legacy")
+        assert self.rng_mode in RNG_MODES, "unknown rng_mode: " + str(self.rng_mode)
+        self.chunk_size = seed_dict.get("chunk_size", 250)
+        # threads for the consumer phases, only in the common mode
+        self.n_threads = general_dict.get("n_threads", 1)
+        assert (
+            self.n_threads == 1 or self.rng_mode == "common"
+        ), "more than one thread needs rng_mode: common"
+        self.tick = 0  # the next tick to run
+        # times the phases of every tick if profile is set, see profiling.py
+        self.profiler = make_timers(general_dict.get("profile", False))
+        # the largest arrays can be memory-mapped files, see out_of_core.py
+        self.arrays = ArrayAllocator(
+            general_dict.get("out_of_core") or [], general_dict.get("scratch_dir")
+        )
+
+        # setting the scene
+        setup_dict = setup_simulation(
+            general_dict,
+            seed_dict,
+            self.phase_rng("setup"),
+            capital_dict,
+            needs_dict,
+            data_dict,
+            category_dict,
+            privacy_dict,
+            openness_dict,
+            innovation_dict,
+            consumer_state=self.consumer_state,
+            arrays=self.arrays,
+        )
+        self.capital = setup_dict["capital"]
+        self.ticks_no_capital = setup_dict["ticks_no_capital"]
+        self.usage = setup_dict["usage"]
+        self.ticks_no_usage = setup_dict["ticks_no_usage"]
+        self.quality = setup_dict["quality"]
+        self.firm_privacy_score = setup_dict["firm_privacy_score"]
+        self.consumer_privacy_concern = setup_dict["consumer_privacy_concern"]
+        self.consumer_wealth = setup_dict["consumer_wealth"]
+        self.F_alive = setup_dict["F_alive"]
+        self.need_matrix = setup_dict["need_matrix"]
+        self.category_datatype = setup_dict["category_datatype"]
+        self.n_datatypes = self.category_datatype.shape[1]
+        self.firm_investment_profile = setup_dict["firm_investment_profile"]
+        self.usage_counter = setup_dict["usage_counter"]
+        self.usage_counter_raw = np.zeros_like(self.usage_counter)
+        self.data_combination_skill = setup_dict["data_combination_skill"]
+        self.requestable = setup_dict["requestable"]
+        self.portability_matrix = setup_dict["portability_matrix"]
+        self.data_value = setup_dict["data_value"]
+        self.data_held = setup_dict["data_held"]
+        self.uninterrupted_usage = np.zeros_like(self.usage_counter)
+        self.privacy_mask = setup_dict["privacy_mask"]
+        self.inno_new_prod_alpha = innovation_dict["new_product_scaler_alpha"]
+
+        self.new_firm_new_category_prob = innovation_dict["new_firm_new_category_prob"]
 
-            # DEATH OF FIRMS
-            # check whether firms should die based on usage/capital
-            death_mask = (
-                (ticks_no_usage > general_dict["no_usage_ticks_before_death"])
-                | (ticks_no_capital > general_dict["no_money_ticks_before_death"])
-            ) & F_alive.astype(bool)
-            # for tracking
-            num_dead_firms = death_mask.astype(int).sum()
-            # update alive mask
-            F_alive[death_mask] = 0
-            # take products off market
-            quality[death_mask] = 0
-            # no porting from/between dead firms
-            portability_matrix[death_mask] = 0
-            portability_matrix[:, :, death_mask] = 0
-            # also no more requests from/to dead firms
-            requestable[death_mask] = 0
-            requestable[:, :, death_mask] = 0
-
-            # REQUESTING DATA RIGHTS
-            A = (quality > 0).astype(int)
-            # what is requestable now?
-            A_where_0, A_where_1 = np.where(A)
-            requestable_now = data.numba_calc_avail_now(
-                requestable, A_where_0, A_where_1
+        self.i_alive = self.n_init_firms  # highest index of an active firm, plus one
+        self.cat_ever_alive = (self.quality.sum(axis=0) > 0).astype(int)
+        self.n_total_firms = self.capital.shape[0]
+        self.n_total_categories = category_dict["n_total_categories"]
+
+        self.category_total_usage = np.zeros(self.n_total_categories)
+        self.category_ticks_alive = (self.quality.sum(axis=0) > 0).astype(int)
+
+        # setting up the tracker
+        self.tracker = self.make_tracker()
+
+        self.scen_tick = -1
+        if scenario_dict:
+            self.scen_tick = scenario_dict["scen_tick"]
+
+        # early stopping: the values watched for convergence, one per tick run
+        self.history = {"concentration": [], "quality": []}
+        self.stop_reason = None
+
+    def make_tracker(self):
+        tracker = SimTracker(
+            self.n_ticks,
+            self.n_total_firms,
+            self.n_total_categories,
+            self.n_consumers,
+            self.quality,
+            self.capital_dict["small"],
+        )
+        tracker.add_needs(self.need_matrix)
+        return tracker
+
+    def phase_rng(self, phase, chunk=0):
+        """
+        the random number generator of a phase (and chunk of consumers) in the current
+        tick
+        """
+        if self.rng_mode == "legacy":
+            return self.rng
+        return phase_stream(self.seed_dict["overall_seed"], phase, self.tick, chunk)
+
+    def set_scenario(self, scenario_dict, scenario_seed=None):
+        """
+        replaces the privacy scenario (and optionally its seed), as long as it hasn't
+        happened yet and the simulation hasn't stopped
+        """
+        assert self.stop_reason is None, (
+            "the simulation has stopped (" + self.stop_reason + ")"
+        )
+        if scenario_dict:
+            assert self.tick <= scenario_dict["scen_tick"], (
+                "the scenario would start at tick {}, but the simulation is at tick {}"
+            ).format(scenario_dict["scen_tick"], self.tick)
+        assert (
+            self.tick <= self.scen_tick or self.scen_tick < 0
+        ), "the scenario has already happened"
+        self.scenario_dict = scenario_dict
+        if scenario_seed is not None:
+            self.seed_dict = dict(self.seed_dict, scenario_seed=scenario_seed)
+        self.scen_tick = scenario_dict["scen_tick"] if scenario_dict else -1
+
+    def step(self):
+        """
+        runs the next tick of the simulation, one phase after the other
+        """
+        assert self.tick < self.n_ticks, "the simulation has already run all ticks"
+        profiler = self.profiler
+        with profiler.tick(self.tick):
+            if self.tick == self.scen_tick:
+                with profiler.phase("scenario"):
+                    self.scenario()
+            if self.tick > 0:
+                with profiler.phase("births"):
+                    self.births()
+                with profiler.phase("deaths"):
+                    self.deaths()
+                self.data_requests()
+                self.innovation()
+            self.consumer_phases()
+            with profiler.phase("tracking"):
+                self.track()
+                if early_stopping_enabled(self.stopping_dict):
+                    self.check_stopping()
+        self.tick += 1
+
+    def run_until(self, tick=None):
+        """
+        runs ticks until the simulation is at tick (default: n_ticks), or until a
+        stopping rule says to stop. Returns the reason for stopping early, or None
+        """
+        tick = self.n_ticks if tick is None else min(tick, self.n_ticks)
+        while self.tick < tick and self.stop_reason is None:
+            self.step()
+        return self.stop_reason
+
+    def scenario(self):
+        """
+        the privacy shock: applied at the start of scen_tick
+        """
+        # set up a random number generator for the scenario
+        scen_rng = np.random.RandomState(self.seed_dict["scenario_seed"])
+        # choose which firms to shock: the n biggest in terms of capital
+        firm_list = np.argsort(self.capital)[
+            -self.scenario_dict["scen_number_of_firms"] :
+        ]
+        # adjust the privacy score of the affected firms
+        self.firm_privacy_score[firm_list] = np.maximum(
+            self.firm_privacy_score[firm_list] - self.scenario_dict["firm_hit"],
+            0.05,
+        )
+        # Adjust consumer privacy concern
+        shock = scen_rng.normal(
+            self.scenario_dict["consumer_hit_mean"],
+            self.scenario_dict["consumer_hit_var"],
+            size=self.n_consumers,
+        )
+        # some people request a deletion of data and will never use the firm again
+        deletion_draws = scen_rng.uniform(size=(self.n_consumers, len(firm_list)))
+        self.privacy_shock(slice(None), shock, deletion_draws, firm_list)
+
+    def privacy_shock(self, consumers, shock, deletion_draws, firm_list):
+        """
+        the privacy shock of consumers (a slice): their concern rises by shock, and they
+        delete their data at the firms in firm_list where deletion_draws is below it
+        """
+        tick = self.tick
+        concern = self.consumer_privacy_concern[consumers]
+        concern += shock
+        # (consumer, firm)
+        data_deleters = np.zeros((len(concern), self.n_total_firms))
+        data_deleters[:, firm_list] = (deletion_draws < concern[:, None]).astype(int)
+        # recalculate the amount of data held by the firms, and its value
+        data_held = self.data_held[:, consumers]
+        data_value = self.data_value[consumers]
+        if self.arrays.is_out_of_core("data_held"):
+            lost = self.arrays.zeros("data_value", data_value.shape)
+            delete_data_tick_major(
+                data_deleters, data_held, data_value, tick, self.data_worth_exp, lost
             )
-            # first pick datatype to request:
-            # (Firm requesting, Datatype) mask for what follows
-            firm_dt_avail_for_request = (
-                requestable_now.sum(axis=(1, 2, 3)) > 0
-            ).astype(int)
-            # (firm, dt): how much of each datatype does the firm use
-            firm_datatype = (
-                (quality > 0).astype(int)[:, :, None] * category_datatype[None, :, :]
-            ).sum(axis=1)
-            firm_datatype *= firm_dt_avail_for_request
-            # (firm, datatype) datatype choice to request
-            firm_dt_prob = np.nan_to_num(
-                firm_datatype / firm_datatype.sum(axis=-1, keepdims=True)
+        else:
+            delete_data(data_deleters, data_held, data_value, tick, self.data_worth_exp)
+        # The consumers who have requested data to be deleted by the impacted firms,
+        # will never use these firms again
+        self.privacy_mask[consumers] *= 1 - data_deleters
+
+    def births(self):
+        """
+        new firms enter, either in a new or an existing category
+        """
+        rng = self.phase_rng("births")
+        # either in new market or in existing market
+        num_new_firms = rng.poisson(self.general_dict["birth_lambda"])
+        # make sure we're not running out of firms
+        num_new_firms_ = np.minimum(num_new_firms, self.n_total_firms - self.i_alive)
+        if num_new_firms_ > 0:
+            # change aliveness indicator
+            self.F_alive[self.i_alive : (self.i_alive + num_new_firms_)] = 1
+            # give capital
+            self.capital[self.i_alive : (self.i_alive + num_new_firms_)] = (
+                self.capital_dict["small"]
             )
-            firm_dt_choice = multinomial(firm_dt_prob, rng)
-            # line below: in case there is no datatype available for requesting, just choose the first ones
-            # will be dealt with later
-            firm_dt_choice[firm_dt_choice.sum(axis=-1) == 0, 0] = 1
-            # choose firm from which data will be requested
-            r_dt, c_dt = np.where(firm_dt_choice)
-            firm_firm_avail = (
-                requestable_now[r_dt, :, :, :, c_dt].sum(axis=(1, 3)) > 0
-            ).astype(int)
-            firm_firm_prob = np.nan_to_num(
-                firm_firm_avail / firm_firm_avail.sum(axis=-1, keepdims=True)
+            # entering existing category or make a new one?
+            # last_cat = np.max(np.where(cat_ever_alive > 0)[0])
+            # remaining_categories = n_total_categories - last_cat - 1
+            remaining_categories = (self.cat_ever_alive == 0).astype(int).sum()
+            new_category_count = np.minimum(
+                np.sum(
+                    rng.uniform(size=num_new_firms_) < self.new_firm_new_category_prob
+                ),
+                remaining_categories,
             )
-            firm_firm_choice = multinomial(firm_firm_prob, rng)
-            # again a hack for firms that can't make any requests
-            firm_firm_choice[firm_firm_choice.sum(axis=-1) == 0, 0] = 1
-            # Choose which category to import data from
-            r_f, c_f = np.where(firm_firm_choice)
-            firm_cat_from_avail = (
-                requestable_now[r_dt, :, c_f, :, c_dt].sum(axis=1) > 0
+            # assign quality 1 for companies entering a non-existing category
+            self.quality[
+                self.i_alive + np.arange(new_category_count),
+                np.where(self.cat_ever_alive == 0)[0][:new_category_count],
+            ] = 1
+            # deal with companies entering an existing category
+            existing_category_count = num_new_firms_ - new_category_count
+            if existing_category_count > 0:
+                self.quality[
+                    self.i_alive
+                    + new_category_count
+                    + np.arange(existing_category_count)
+                ] += inno.enter_new_category(
+                    self.quality,
+                    self.category_datatype,
+                    None,
+                    self.category_total_usage,
+                    self.category_ticks_alive,
+                    self.innovation_dict,
+                    self.qual_diff_param,
+                    rng,
+                    n=existing_category_count,
+                )
+            # more bookkeeping
+            self.ticks_no_usage[self.i_alive : (self.i_alive + num_new_firms_)] = 0
+            self.ticks_no_capital[self.i_alive : (self.i_alive + num_new_firms_)] = 0
+            self.i_alive += num_new_firms_
+            self.cat_ever_alive = (
+                (self.cat_ever_alive + self.quality.sum(axis=0)) > 0
             ).astype(int)
-            firm_cat_from_prob = np.nan_to_num(
-                firm_cat_from_avail / firm_cat_from_avail.sum(axis=-1, keepdims=True)
-            )
-            firm_cat_from_choice = multinomial(firm_cat_from_prob, rng)
-            # same hack again...
-            firm_cat_from_choice[firm_cat_from_choice.sum(axis=-1) == 0, 0] = 1
-            # Choose which category the import will be made to
-            r_cf, c_cf = np.where(firm_cat_from_choice)
-            firm_cat_to_avail = requestable_now[r_dt, :, c_f, c_cf, c_dt]
-            firm_cat_to_prob = np.nan_to_num(
-                firm_cat_to_avail / firm_cat_to_avail.sum(axis=-1, keepdims=True)
-            )
-            firm_cat_to_choice = multinomial(firm_cat_to_prob, rng)
-            # ... and the same hack again
-            firm_cat_to_choice[firm_cat_to_choice.sum(axis=-1) == 0, 0] = 1
-            r_ct, c_ct = np.where(firm_cat_to_choice)
-            # deal with the hacks done above
-            request_mask = data.numba_mask_impossible_requests(
-                r_ct, c_ct, c_f, c_cf, c_dt, requestable_now
-            )
-            r_ct, c_ct, c_f, c_cf, c_dt = [
-                x[request_mask == 1] for x in [r_ct, c_ct, c_f, c_cf, c_dt]
-            ]
-            # r_ct: firm requesting the rights to datatype
-            # c_ct: category they want to import data to
-            # c_f: firm receiving the data request
-            # c_cf: category data will be imported from if request is granted
-            # c_dt: datatype asked for
-
-            # GRANTING/DENYING DATA RIGHTS
-            granting_probs = data.calculate_granting_probs(
-                r_ct,
-                c_f,
-                A,
-                openness_dict["openness_lower"],
-                openness_dict["openness_upper"],
-            )
+        self.num_new_firms = num_new_firms_
+
+    def deaths(self):
+        """
+        firms without usage or capital for too long leave the market
+        """
+        # check whether firms should die based on usage/capital
+        death_mask = (
+            (self.ticks_no_usage > self.general_dict["no_usage_ticks_before_death"])
+            | (self.ticks_no_capital > self.general_dict["no_money_ticks_before_death"])
+        ) & self.F_alive.astype(bool)
+        # for tracking
+        num_dead_firms = death_mask.astype(int).sum()
+        # update alive mask
+        self.F_alive[death_mask] = 0
+        # take products off market
+        self.quality[death_mask] = 0
+        # no porting from/between dead firms
+        self.portability_matrix[death_mask] = 0
+        self.portability_matrix[:, :, death_mask] = 0
+        # also no more requests from/to dead firms
+        self.requestable[death_mask] = 0
+        self.requestable[:, :, death_mask] = 0
+        self.num_dead_firms = num_dead_firms
+
+    def data_requests(self):
+        """
+        firms request data rights from other firms, which are granted or denied
+        """
+        rng = self.phase_rng("data_requests")
+        with self.profiler.phase("request_selection"):
+            requests = self.select_requests(rng)
+        with self.profiler.phase("granting"):
+            self.grant_requests(rng, *requests)
+
+    def select_requests(self, rng):
+        """
+        the data requests of the firms: who asks whom for which datatype, from and to
+        which categories
+        """
+        # REQUESTING DATA RIGHTS
+        A = (self.quality > 0).astype(int)
+        # what is requestable now?
+        A_where_0, A_where_1 = np.where(A)
+        requestable_now = data.numba_fill_avail_now(
+            self.requestable,
+            A_where_0,
+            A_where_1,
+            self.arrays.zeros("requestable_now", self.requestable.shape, np.int8),
+        )
+        # first pick datatype to request:
+        # (Firm requesting, Datatype) mask for what follows
+        firm_dt_avail_for_request = (requestable_now.sum(axis=(1, 2, 3)) > 0).astype(
+            int
+        )
+        # (firm, dt): how much of each datatype does the firm use
+        firm_datatype = (
+            (self.quality > 0).astype(int)[:, :, None]
+            * self.category_datatype[None, :, :]
+        ).sum(axis=1)
+        firm_datatype *= firm_dt_avail_for_request
+        # (firm, datatype) datatype choice to request
+        firm_dt_prob = np.nan_to_num(
+            firm_datatype / firm_datatype.sum(axis=-1, keepdims=True)
+        )
+        firm_dt_choice = multinomial(firm_dt_prob, rng)
+        # line below: in case there is no datatype available for requesting, just choose the first ones
+        # will be dealt with later
+        firm_dt_choice[firm_dt_choice.sum(axis=-1) == 0, 0] = 1
+        # choose firm from which data will be requested
+        r_dt, c_dt = np.where(firm_dt_choice)
+        firm_firm_avail = (
+            requestable_now[r_dt, :, :, :, c_dt].sum(axis=(1, 3)) > 0
+        ).astype(int)
+        firm_firm_prob = np.nan_to_num(
+            firm_firm_avail / firm_firm_avail.sum(axis=-1, keepdims=True)
+        )
+        firm_firm_choice = multinomial(firm_firm_prob, rng)
+        # again a hack for firms that can't make any requests
+        firm_firm_choice[firm_firm_choice.sum(axis=-1) == 0, 0] = 1
+        # Choose which category to import data from
+        r_f, c_f = np.where(firm_firm_choice)
+        firm_cat_from_avail = (
+            requestable_now[r_dt, :, c_f, :, c_dt].sum(axis=1) > 0
+        ).astype(int)
+        firm_cat_from_prob = np.nan_to_num(
+            firm_cat_from_avail / firm_cat_from_avail.sum(axis=-1, keepdims=True)
+        )
+        firm_cat_from_choice = multinomial(firm_cat_from_prob, rng)
+        # same hack again...
+        firm_cat_from_choice[firm_cat_from_choice.sum(axis=-1) == 0, 0] = 1
+        # Choose which category the import will be made to
+        r_cf, c_cf = np.where(firm_cat_from_choice)
+        firm_cat_to_avail = requestable_now[r_dt, :, c_f, c_cf, c_dt]
+        firm_cat_to_prob = np.nan_to_num(
+            firm_cat_to_avail / firm_cat_to_avail.sum(axis=-1, keepdims=True)
+        )
+        firm_cat_to_choice = multinomial(firm_cat_to_prob, rng)
+        # ... and the same hack again
+        firm_cat_to_choice[firm_cat_to_choice.sum(axis=-1) == 0, 0] = 1
+        r_ct, c_ct = np.where(firm_cat_to_choice)
+        # deal with the hacks done above
+        request_mask = data.numba_mask_impossible_requests(
+            r_ct, c_ct, c_f, c_cf, c_dt, requestable_now
+        )
+        r_ct, c_ct, c_f, c_cf, c_dt = [
+            x[request_mask == 1] for x in [r_ct, c_ct, c_f, c_cf, c_dt]
+        ]
+        # r_ct: firm requesting the rights to datatype
+        # c_ct: category they want to import data to
+        # c_f: firm receiving the data request
+        # c_cf: category data will be imported from if request is granted
+        # c_dt: datatype asked for
+        return A, r_ct, c_ct, c_f, c_cf, c_dt
+
+    def grant_requests(self, rng, A, r_ct, c_ct, c_f, c_cf, c_dt):
+        """
+        the data requests are granted or denied, and the data rights granted added to
+        the portability matrix
+        """
+        # GRANTING/DENYING DATA RIGHTS
+        granting_probs = data.calculate_granting_probs(
+            r_ct,
+            c_f,
+            A,
+            self.openness_dict["openness_lower"],
+            self.openness_dict["openness_upper"],
+        )
+        if self.rng_mode == "common":
+            # one draw per requesting firm, which paired runs have in common
+            rng = self.phase_rng("granting")
+            granted_mask = rng.uniform(size=self.n_total_firms)[r_ct] < granting_probs
+        else:
             granted_mask = rng.uniform(size=granting_probs.shape) < granting_probs
-            r_ct_g, c_ct_g, c_f_g, c_cf_g, c_dt_g = [
-                x[granted_mask] for x in [r_ct, c_ct, c_f, c_cf, c_dt]
+        r_ct_g, c_ct_g, c_f_g, c_cf_g, c_dt_g = [
+            x[granted_mask] for x in [r_ct, c_ct, c_f, c_cf, c_dt]
+        ]
+        # update requestable(also set to zero if request was granted, so we won't ask again)
+        self.requestable = data.numba_update_requestable(
+            self.requestable, r_ct, c_ct, c_f, c_cf, c_dt
+        )
+        # update the portability matrix
+        self.portability_matrix = data.numba_update_portability_matrix(
+            self.portability_matrix, r_ct_g, c_ct_g, c_f_g, c_cf_g, c_dt_g
+        )
+        self.r_ct_g = r_ct_g
+
+    def innovation(self):
+        """
+        firms invest in their products, or in products in new categories
+        """
+        rng = self.phase_rng("innovation")
+        with self.profiler.phase("innovation_existing"):
+            investment = self.invest_existing(rng)
+        with self.profiler.phase("innovation_new_category"):
+            self.invest_new_category(rng, *investment)
+
+    def invest_existing(self, rng):
+        """
+        firms take their capital to invest and choose what to invest in, and invest in
+        their existing products. Returns the capital to invest, the investment choices
+        and the investment profiles they were drawn from
+        """
+        tick = self.tick
+        # INNOVATION IN EXISTING FIRMS
+        # money to be invested - zero for firms that do no yet exist
+        capital_to_invest = np.maximum(
+            np.minimum(self.capital, self.innovation_dict["invest_cap"]), 0
+        )
+        self.capital = self.capital - capital_to_invest
+        # Either invest in a existing product; in an existing category which they don't have a product in;
+        # or in an non-existing category
+        firm_investment_profile_ = self.firm_investment_profile
+        # if a firm already has all categories, middle option can't be chosen
+        firm_investment_profile_[
+            (self.quality[:, self.cat_ever_alive] == 0).sum(axis=-1) == 0, 1
+        ] = 0
+        firm_investment_profile_[
+            (self.quality[:, self.cat_ever_alive] == 0).sum(axis=-1) == 0, 2
+        ] = (
+            1
+            - firm_investment_profile_[
+                (self.quality[:, self.cat_ever_alive] == 0).sum(axis=-1) == 0, 0
             ]
-            # update requestable(also set to zero if request was granted, so we won't ask again)
-            requestable = data.numba_update_requestable(
-                requestable, r_ct, c_ct, c_f, c_cf, c_dt
-            )
-            # update the portability matrix
-            portability_matrix = data.numba_update_portability_matrix(
-                portability_matrix, r_ct_g, c_ct_g, c_f_g, c_cf_g, c_dt_g
-            )
+        )
+        # no more new categories to expand into
+        firm_investment_profile_[:, -1] *= 1 - (
+            self.cat_ever_alive.sum() == self.n_total_categories
+        ).astype(int)
+        firm_investment_profile_ = (
+            firm_investment_profile_
+            / firm_investment_profile_.sum(axis=-1, keepdims=True)
+        )
+        investment_choice = (
+            multinomial(firm_investment_profile_, rng) * self.F_alive[:, None]
+        )
 
-            # INNOVATION IN EXISTING FIRMS
-            # money to be invested - zero for firms that do no yet exist
-            capital_to_invest = np.maximum(
-                np.minimum(capital, innovation_dict["invest_cap"]), 0
-            )
-            capital = capital - capital_to_invest
-            # Either invest in a existing product; in an existing category which they don't have a product in;
-            # or in an non-existing category
-            firm_investment_profile_ = firm_investment_profile
-            # if a firm already has all categories, middle option can't be chosen
-            firm_investment_profile_[
-                (quality[:, cat_ever_alive] == 0).sum(axis=-1) == 0, 1
-            ] = 0
-            firm_investment_profile_[
-                (quality[:, cat_ever_alive] == 0).sum(axis=-1) == 0, 2
-            ] = (
-                1
-                - firm_investment_profile_[
-                    (quality[:, cat_ever_alive] == 0).sum(axis=-1) == 0, 0
-                ]
-            )
-            # no more new categories to expand into
-            firm_investment_profile_[:, -1] *= 1 - (
-                cat_ever_alive.sum() == n_total_categories
-            ).astype(int)
-            firm_investment_profile_ = (
-                firm_investment_profile_
-                / firm_investment_profile_.sum(axis=-1, keepdims=True)
-            )
-            investment_choice = (
-                multinomial(firm_investment_profile_, rng) * F_alive[:, None]
-            )
+        # Existing product that investment will be in
+        invest_prob = inno.invest_utility_existing(
+            self.quality, self.category_total_usage, tick, self.innovation_dict
+        )
+        invest_product = (
+            multinomial(invest_prob, rng) * investment_choice[:, 0][:, None]
+        )
+        # calculating the data investment
+        # (firm, datatypes)
+        rel_datatypes = invest_product.dot(self.category_datatype)
+        invest_data_value_base = rel_datatypes * self.data_value_per_firm()
+        invest_data_value = inno.apply_data_skill(
+            invest_data_value_base, self.data_combination_skill
+        )
+        # investment = min_max_scaler(capital_to_invest * invest_data_value) * investment_choice[:, 0]
+        investment = inno.investment_scaler(
+            capital_to_invest * invest_data_value, 0, 1, self.inno_new_prod_alpha
+        )  # this is number between 0 and 1
+        # calculating the gain in quality
+        extra_quality = inno.product_quality_update(
+            self.quality, investment, self.innovation_dict["alpha_f"]
+        )
+        self.quality += extra_quality * invest_product
+        return capital_to_invest, investment_choice, firm_investment_profile_
 
-            # Existing product that investment will be in
-            invest_prob = inno.invest_utility_existing(
-                quality, category_total_usage, tick, innovation_dict
-            )
-            invest_product = (
-                multinomial(invest_prob, rng) * investment_choice[:, 0][:, None]
-            )
-            # calculating the data investment
-            # (firm, datatypes)
-            rel_datatypes = invest_product.dot(category_datatype)
-            invest_data_value_base = (rel_datatypes[None, None, :, :] * data_value).sum(
-                axis=(0, 1)
-            )
-            invest_data_value = inno.apply_data_skill(
-                invest_data_value_base, data_combination_skill
-            )
-            # investment = min_max_scaler(capital_to_invest * invest_data_value) * investment_choice[:, 0]
-            investment = inno.investment_scaler(
-                capital_to_invest * invest_data_value, 0, 1, inno_new_prod_alpha
-            )  # this is number between 0 and 1
-            # calculating the gain in quality
-            extra_quality = inno.product_quality_update(
-                quality, investment, innovation_dict["alpha_f"]
-            )
-            quality += extra_quality * invest_product
-
-            # Firms going into a category they haven't developed before
-            # get the potential added quality - IF firms succeed
-            potential_added_quality = inno.enter_new_category(
-                quality,
-                category_datatype,
-                investment_choice[:, 1:],
-                category_total_usage,
-                category_ticks_alive,
-                innovation_dict,
-                qual_diff_param,
-                rng,
-            )
-            assert (potential_added_quality * quality == 0).all(), (
-                np.where(potential_added_quality * quality),
-                investment_choice[1],
-                firm_investment_profile_[1],
-                quality[1],
-                cat_ever_alive,
-                n_total_categories,
-            )
-            # get the data investment for the product under development
-            rel_datatypes = (potential_added_quality > 0).dot(category_datatype)
-            invest_data_value_base = (rel_datatypes[None, None, :, :] * data_value).sum(
-                axis=(0, 1)
-            )
-            invest_data_value = inno.apply_data_skill(
-                invest_data_value_base, data_combination_skill
-            )
-            investment = inno.investment_scaler(
-                capital_to_invest * invest_data_value,
-                inno_low,
-                inno_high,
-                inno_new_prod_alpha,
-            )  # this is a probability
-            success = (
-                (rng.uniform(size=(n_total_firms)) < investment).astype(int)
-                * investment_choice[:, 1:].sum(axis=-1)
-                * F_alive
+    def invest_new_category(
+        self, rng, capital_to_invest, investment_choice, firm_investment_profile_
+    ):
+        """
+        firms invest in products in categories they don't have a product in yet
+        """
+        # Firms going into a category they haven't developed before
+        # get the potential added quality - IF firms succeed
+        potential_added_quality = inno.enter_new_category(
+            self.quality,
+            self.category_datatype,
+            investment_choice[:, 1:],
+            self.category_total_usage,
+            self.category_ticks_alive,
+            self.innovation_dict,
+            self.qual_diff_param,
+            rng,
+        )
+        assert (potential_added_quality * self.quality == 0).all(), (
+            np.where(potential_added_quality * self.quality),
+            investment_choice[1],
+            firm_investment_profile_[1],
+            self.quality[1],
+            self.cat_ever_alive,
+            self.n_total_categories,
+        )
+        # get the data investment for the product under development
+        rel_datatypes = (potential_added_quality > 0).dot(self.category_datatype)
+        invest_data_value_base = rel_datatypes * self.data_value_per_firm()
+        invest_data_value = inno.apply_data_skill(
+            invest_data_value_base, self.data_combination_skill
+        )
+        investment = inno.investment_scaler(
+            capital_to_invest * invest_data_value,
+            self.inno_low,
+            self.inno_high,
+            self.inno_new_prod_alpha,
+        )  # this is a probability
+        success = (
+            (rng.uniform(size=(self.n_total_firms)) < investment).astype(int)
+            * investment_choice[:, 1:].sum(axis=-1)
+            * self.F_alive
+        )
+        self.quality += potential_added_quality * success[:, None]
+        self.cat_ever_alive = (
+            (self.cat_ever_alive + self.quality.sum(axis=0)) > 0
+        ).astype(int)
+        self.investment_choice = investment_choice
+        self.success = success
+        self.success_prob = capital_to_invest * invest_data_value
+
+    def consumer_phases(self):
+        """
+        consumers, bookkeeping and porting
+        """
+        if self.rng_mode == "legacy":
+            with self.profiler.phase("consumer_choice"):
+                self.consumers()
+            with self.profiler.phase("bookkeeping"):
+                self.bookkeeping()
+            with self.profiler.phase("porting"):
+                self.porting()
+        else:
+            self.consumers_chunked()
+
+    def consumers(self):
+        """
+        consumers choose the products they use in this tick
+        """
+        self.usage = self.consumer_choices(slice(None), self.rng, self.rng)
+
+    def data_value_per_firm(self):
+        """
+        (firm, datatype): the value of the data each firm holds on all consumers
+        """
+        if self.rng_mode == "legacy":
+            return self.data_value.sum(axis=(0, 1))
+        # added up chunk by chunk, like everything else in the common mode
+        return sum(self.chunk_data_values())
+
+    def chunk_data_values(self):
+        """
+        (firm, datatype) value of the data held on every chunk of consumers
+        """
+        return [self.data_value[c].sum(axis=(0, 1)) for c in self.consumer_chunks()]
+
+    def consumers_chunked(self):
+        """
+        the consumer phases of the common rng_mode (consumers, bookkeeping and porting),
+        run chunk by chunk of consumers on n_threads threads. Every chunk draws from its
+        own streams, and the totals per firm and category are added up in chunk order,
+        so the results don't depend on the number of threads. On threads, the chunks
+        are timed together as consumer_threads, see profiling.py
+        """
+        usage = np.zeros(self.usage.shape, dtype=int)
+
+        def run_chunk(chunk, consumers, profiler=None):
+            return self.consumer_chunk(chunk, consumers, usage, profiler)
+
+        chunks = self.consumer_chunks()
+        if self.n_threads > 1:
+            pool = thread_pool(self.n_threads)
+            no_timers = [NO_TIMERS] * len(chunks)
+            with self.profiler.phase("consumer_threads", memory=False):
+                totals = list(
+                    pool.map(run_chunk, range(len(chunks)), chunks, no_timers)
+                )
+        else:
+            totals = [
+                run_chunk(chunk, consumers) for chunk, consumers in enumerate(chunks)
+            ]
+        self.usage = usage
+        with self.profiler.phase("bookkeeping"):
+            self.firm_bookkeeping(*[sum(x) for x in zip(*totals)])
+
+    def consumer_chunk(self, chunk, consumers, usage, profiler=None):
+        """
+        the consumer phases of one chunk of consumers (a slice), with the streams of the
+        chunk; their choices are written to usage. Returns the totals of
+        consumer_bookkeeping. The phases are timed by profiler (default: the profiler
+        of the simulation)
+        """
+        profiler = self.profiler if profiler is None else profiler
+        with profiler.phase("consumer_choice"):
+            usage[consumers] = self.consumer_choices(
+                consumers,
+                self.phase_rng("needs", chunk),
+                self.phase_rng("choice", chunk),
             )
-            quality += potential_added_quality * success[:, None]
-            cat_ever_alive = ((cat_ever_alive + quality.sum(axis=0)) > 0).astype(int)
+        with profiler.phase("bookkeeping"):
+            totals = self.consumer_bookkeeping(consumers, usage[consumers])
+        with profiler.phase("porting"):
+            self.port_data(consumers)
+        return totals
 
-        # CONSUMERS USING A PRODUCT
+    def consumer_chunks(self):
+        """
+        slices of consumers that get their own random streams
+        """
+        return [
+            slice(start, min(start + self.chunk_size, self.n_consumers))
+            for start in range(0, self.n_consumers, self.chunk_size)
+        ]
+
+    def consumer_choices(self, consumers, needs_rng, choice_rng):
+        """
+        the products used in this tick by consumers (a slice): (consumer, category, firm)
+        """
         # decide which product categories consumers will use in this tick (consumers, categories
         #  - provided the category exists
-        usage_product_mask = (need_matrix > rng.uniform(size=need_matrix.shape)).astype(
-            int
-        ) * (quality.sum(axis=0) > 0).astype(int)[None, :]
+        need_matrix = self.need_matrix[consumers]
+        usage_product_mask = (
+            need_matrix > needs_rng.uniform(size=need_matrix.shape)
+        ).astype(int) * (self.quality.sum(axis=0) > 0).astype(int)[None, :]
         # utility (consumer, category, firm)
         utility_ = utility_for_consumers(
-            quality,
-            usage,
-            usage_counter,
-            consumer_privacy_concern,
-            firm_privacy_score,
-            util_weight_dict,
+            self.quality,
+            self.usage[consumers],
+            self.usage_counter[consumers],
+            self.consumer_privacy_concern[consumers],
+            self.firm_privacy_score,
+            self.util_weight_dict,
         )
         # choosing a firm (consumer, category, firm)
-        usage_firm = choose_firms(utility_, quality, w_logit, privacy_mask, rng)
+        usage_firm = choose_firms(
+            utility_,
+            self.quality,
+            self.w_logit,
+            self.privacy_mask[consumers],
+            choice_rng,
+        )
         # mask for products used (consumer, category, firm)
-        usage = usage_firm * usage_product_mask[:, :, None].astype(int)
+        return usage_firm * usage_product_mask[:, :, None].astype(int)
+
+    def bookkeeping(self):
+        """
+        payments, data collected from the consumers and usage counters
+        """
+        totals = self.consumer_bookkeeping(slice(None), self.usage)
+        self.firm_bookkeeping(*totals)
 
-        # BOOKKEEPING: CUSTOMER DATA + PAYMENT
-        # update capital: agents uniformly distribute money over products consumers in tick
+    def consumer_bookkeeping(self, consumers, usage):
+        """
+        the payments, data and usage counters of consumers (a slice) that used the
+        products in usage. Returns their payments per firm, and usage per category and
+        per firm
+        """
+        tick = self.tick
+        # agents uniformly distribute money over products consumers in tick
         prod_per_consumer = np.maximum(usage.sum(axis=(1, 2)), 1)
-        capital += (
-            np.nan_to_num(consumer_wealth / prod_per_consumer)[:, None]
+        revenue = (
+            np.nan_to_num(self.consumer_wealth[consumers] / prod_per_consumer)[:, None]
             * usage.sum(axis=1)
         ).sum(axis=0)
-        data_value *= np.exp(-data_worth_exp)
+        data_value = self.data_value[consumers]
+        data_value *= np.exp(-self.data_worth_exp)
         usage_cons, usage_cat, usage_firm = np.where(usage)
-        data_held, data_value = data.update_data_stuff(
-            data_held,
+        data.update_data_stuff(
+            self.data_held[:, consumers],
             data_value,
             usage_cons,
             usage_cat,
             usage_firm,
-            category_datatype,
+            self.category_datatype,
             tick,
-            n_datatypes,
+            self.n_datatypes,
         )
         has_used_mask = (usage.sum(axis=2, keepdims=True) > 0) * np.ones(
-            n_total_firms
+            self.n_total_firms
         ).astype(bool)[None, None, :]
+        uninterrupted_usage = self.uninterrupted_usage[consumers]
         uninterrupted_usage[has_used_mask] *= usage[has_used_mask]
         uninterrupted_usage[has_used_mask] += usage[has_used_mask]
-        usage_counter_raw += usage
-        usage_counter *= np.exp(-alpha_usage_decay)
+        self.usage_counter_raw[consumers] += usage
+        usage_counter = self.usage_counter[consumers]
+        usage_counter *= np.exp(-self.alpha_usage_decay)
         usage_counter += usage
-        category_total_usage += usage.sum(axis=(0, 2))
-        category_ticks_alive[quality.sum(axis=0) > 0] += 1
+        return revenue, usage.sum(axis=(0, 2)), usage.sum(axis=(0, 1))
+
+    def firm_bookkeeping(self, revenue, category_usage, firm_usage):
+        """
+        capital, category usage and the no usage/no capital counters of the firms
+        """
+        self.capital += revenue
+        self.category_total_usage += category_usage
+        self.category_ticks_alive[self.quality.sum(axis=0) > 0] += 1
+
+        # update no usage/no capital trackers
+        self.ticks_no_usage[firm_usage == 0] += 1
+        self.ticks_no_usage[firm_usage > 0] = 0
+        self.ticks_no_capital[self.capital < self.capital_dict["capital_cutoff"]] += 1
+        self.ticks_no_capital[self.capital >= self.capital_dict["capital_cutoff"]] = 0
+
+    def porting(self):
+        """
+        consumers port their data after n_port ticks of uninterrupted usage
+        """
+        self.port_data(slice(None))
 
-        # PORTING
+    def port_data(self, consumers):
+        """
+        porting for consumers (a slice)
+        """
+        tick = self.tick
+        data_value = self.data_value[consumers]
         # Decision to port data: at nth consecutive usage, port everything that's portable
-        cons_, cat_, firm_ = np.where(uninterrupted_usage == port_dict["n_port"])
+        cons_, cat_, firm_ = np.where(
+            self.uninterrupted_usage[consumers] == self.port_dict["n_port"]
+        )
         if len(cons_) > 0:
-            PM = np.swapaxes(portability_matrix[firm_, cat_], 1, 2) * (
+            PM = np.swapaxes(self.portability_matrix[firm_, cat_], 1, 2) * (
                 data_value[cons_] > 0
             ).astype(int)
             if PM.sum() > 0:
-                data_held, data_value = data.port(
-                    cons_, cat_, firm_, data_held, data_value, tick, PM
+                # stream over the ticks if data_held is in a file
+                if self.arrays.is_out_of_core("data_held"):
+                    port = data.port_tick_major
+                else:
+                    port = data.port
+                port(
+                    cons_,
+                    cat_,
+                    firm_,
+                    self.data_held[:, consumers],
+                    data_value,
+                    tick,
+                    PM,
                 )
 
-        # update no usage/no capital trackers
-        ticks_no_usage[usage.sum(axis=(0, 1)) == 0] += 1
-        ticks_no_usage[usage.sum(axis=(0, 1)) > 0] = 0
-        ticks_no_capital[capital < capital_dict["capital_cutoff"]] += 1
-        ticks_no_capital[capital >= capital_dict["capital_cutoff"]] = 0
+    def tracked_consumers(self):
+        """
+        the usage (consumer, category, firm) and privacy concern (consumer) recorded by
+        the tracker
+        """
+        return self.usage, self.consumer_privacy_concern
+
+    def category_firm_usage(self):
+        """
+        (category, firm) number of consumers using each product in the current tick
+        """
+        return self.tracked_consumers()[0].sum(axis=0)
 
-        tracker.update(
+    def track(self):
+        """
+        records the tick in the tracker
+        """
+        tick = self.tick
+        usage, concern = self.tracked_consumers()
+        self.tracker.update(
             tick,
             (
-                quality,
-                capital,
+                self.quality,
+                self.capital,
                 usage,
-                0 if tick == 0 else num_new_firms_,
-                0 if tick == 0 else num_dead_firms,
-                F_alive,
-                0 if tick == 0 else investment_choice,
-                0 if tick == 0 else success,
-                consumer_privacy_concern,
-                firm_privacy_score,
-                0 if tick == 0 else r_ct_g,
-                0 if tick == 0 else capital_to_invest * invest_data_value,
+                0 if tick == 0 else self.num_new_firms,
+                0 if tick == 0 else self.num_dead_firms,
+                self.F_alive,
+                0 if tick == 0 else self.investment_choice,
+                0 if tick == 0 else self.success,
+                concern,
+                self.firm_privacy_score,
+                0 if tick == 0 else self.r_ct_g,
+                0 if tick == 0 else self.success_prob,
             ),
         )
-    output = tracker.gather_output()
-    return output
+
+    def check_stopping(self):
+        """
+        checks the stopping rules of stopping_dict after the current tick, and sets
+        stop_reason if the simulation should stop
+        """
+        window = self.stopping_dict.get("window", 12)
+        # market concentration: mean share of the top 3 firms in the used categories
+        cons_count = self.category_firm_usage()
+        total = cons_count.sum(axis=1)
+        top3 = np.sort(cons_count, axis=1)[:, -3:].sum(axis=1)
+        used = total > 0
+        concentration = (100 * top3[used] / total[used]).mean() if used.any() else 0.0
+        self.history["concentration"].append(concentration)
+        self.history["quality"].append(self.quality.sum())
+
+        # never stop before min_ticks, or before the scenario has happened
+        if self.tick + 1 < max(
+            self.stopping_dict.get("min_ticks", 0), self.scen_tick + 1
+        ):
+            return
+        if self.stopping_dict.get("no_live_firms", False) and self.F_alive.sum() == 0:
+            self.stop_reason = "no live firms"
+            return
+        concentration_tol = self.stopping_dict.get("concentration_tol")
+        if (
+            concentration_tol is not None
+            and len(self.history["concentration"]) >= window
+        ):
+            recent = self.history["concentration"][-window:]
+            if max(recent) - min(recent) <= concentration_tol:
+                self.stop_reason = "market concentration converged"
+                return
+        quality_tol = self.stopping_dict.get("quality_tol")
+        if quality_tol is not None and len(self.history["quality"]) >= window:
+            recent = self.history["quality"][-window:]
+            if max(recent) - min(recent) <= quality_tol * max(abs(recent[-1]), 1e-12):
+                self.stop_reason = "quality converged"
+
+    def results(self, outputs=None):
+        """
+        the outputs of the simulation (see SimTracker.gather_output), over the ticks
+        that have been run, and the profile of the phases if it is profiled (see
+        profiling.py)
+        """
+        if self.tick < self.n_ticks:
+            results = self.tracker.truncated(self.tick).gather_output(outputs)
+        else:
+            results = self.tracker.gather_output(outputs)
+        if not isinstance(self.profiler, LotsOfTimers):
+            return results
+        # the profile of a profiled run comes with any outputs
+        report = self.profiler.report()
+        return results.with_outputs(
+            {
+                "profile": lambda: report,
+                "profile_summary": lambda: summarise_profile(report),
+            }
+        )
+
+
+# thread pools for the consumer phases, shared by all simulations in a process
+_thread_pools = {}
+
+
+def thread_pool(n_threads):
+    if n_threads not in _thread_pools:
+        _thread_pools[n_threads] = ThreadPoolExecutor(max_workers=n_threads)
+    return _thread_pools[n_threads]
+
+
+def early_stopping_enabled(stopping_dict):
+    """
+    True if any of the stopping rules in stopping_dict is switched on
+    """
+    return bool(stopping_dict) and (
+        bool(stopping_dict.get("no_live_firms", False))
+        or stopping_dict.get("concentration_tol") is not None
+        or stopping_dict.get("quality_tol") is not None
+    )
+
+
+def create_simulation(cohort_dict={}, **params):
+    """
+    a Simulation of the parameters params, a CohortSimulation if cohort_dict sets
+    n_archetypes (see cohorts.py), or a ShardedSimulation if general_dict sets n_shards
+    above 1 (see sharded.py). Before anything is allocated, the memory the run needs is
+    checked as set by general_dict["preflight"] (see estimate.py)
+    """
+    params = preflight(cohort_dict=cohort_dict, **params)
+    cohort_dict = params.pop("cohort_dict")
+    n_shards = params.get("general_dict", {}).get("n_shards", 1)
+    if cohort_dict and cohort_dict.get("n_archetypes"):
+        from .cohorts import CohortSimulation
+
+        assert n_shards == 1, "the cohort mode can't be sharded"
+        return CohortSimulation(cohort_dict=cohort_dict, **params)
+    if n_shards > 1:
+        from .sharded import ShardedSimulation
+
+        return ShardedSimulation(cohort_dict=cohort_dict, **params)
+    return Simulation(cohort_dict=cohort_dict, **params)
+
+
+def run(
+    general_dict={},
+    seed_dict={},
+    util_weight_dict={},
+    innovation_dict={},
+    capital_dict={},
+    needs_dict={},
+    data_dict={},
+    category_dict={},
+    usage_dict={},
+    port_dict={},
+    privacy_dict={},
+    scenario_dict={},
+    openness_dict={},
+    output_dict={},
+    stopping_dict={},
+    cohort_dict={},
+):
+    sim = create_simulation(
+        general_dict=general_dict,
+        seed_dict=seed_dict,
+        util_weight_dict=util_weight_dict,
+        innovation_dict=innovation_dict,
+        capital_dict=capital_dict,
+        needs_dict=needs_dict,
+        data_dict=data_dict,
+        category_dict=category_dict,
+        usage_dict=usage_dict,
+        port_dict=port_dict,
+        privacy_dict=privacy_dict,
+        scenario_dict=scenario_dict,
+        openness_dict=openness_dict,
+        output_dict=output_dict,
+        stopping_dict=stopping_dict,
+        cohort_dict=cohort_dict,
+    )
+    sim.run_until()
+    return sim.results(output_dict.get("outputs"))
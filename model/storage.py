@@ -0,0 +1,139 @@
+"""
+Storing the outputs of a simulation on disk in a binary, columnar format, so that runs
+can be re-plotted or re-analysed without re-simulating them.
+
+Every array is written to its own .npy file. Tables are stored column by column, except for
+wide tables with a single dtype (e.g. one column per consumer), which are stored as one
+2-d array. A manifest.json describes how to put the outputs back together. It is written
+last, so a directory without a manifest is an incomplete write.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from .tracking import SimResults
+
+MANIFEST = "manifest.json"
+FORMAT_VERSION = 1
+
+
+def _to_json_label(x):
+    """
+    column/index labels are numpy scalars most of the time
+    """
+    return x.item() if isinstance(x, np.generic) else x
+
+
+def _to_array(values):
+    values = np.asarray(values)
+    if values.dtype == object:
+        values = values.astype(str)
+    return values
+
+
+def _save_array(directory, filename, values):
+    np.save(os.path.join(directory, filename), _to_array(values), allow_pickle=False)
+    return filename
+
+
+def save_results(results, directory, outputs=None):
+    """
+    Writes the outputs in results (a SimResults or any dict of arrays, Series and DataFrames)
+    to directory. If outputs (a list of names) is given, only those are written.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    manifest_path = os.path.join(directory, MANIFEST)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    entries = {}
+    for name in outputs if outputs is not None else list(results.keys()):
+        value = results[name]
+        if isinstance(value, pd.DataFrame):
+            entry = {
+                "kind": "frame",
+                "index": _save_array(directory, name + ".index.npy", value.index),
+                "columns": [_to_json_label(c) for c in value.columns],
+            }
+            if value.shape[1] > 1 and len(set(value.dtypes)) == 1:
+                entry["layout"] = "matrix"
+                entry["file"] = _save_array(directory, name + ".npy", value.values)
+            else:
+                entry["layout"] = "columns"
+                entry["files"] = [
+                    _save_array(
+                        directory, "{}.{}.npy".format(name, i), value.iloc[:, i]
+                    )
+                    for i in range(value.shape[1])
+                ]
+        elif isinstance(value, pd.Series):
+            entry = {
+                "kind": "series",
+                "name": _to_json_label(value.name),
+                "index": _save_array(directory, name + ".index.npy", value.index),
+                "file": _save_array(directory, name + ".npy", value.values),
+            }
+        else:
+            entry = {
+                "kind": "array",
+                "file": _save_array(directory, name + ".npy", value),
+            }
+        entries[name] = entry
+    with open(manifest_path, "w") as f:
+        json.dump({"format_version": FORMAT_VERSION, "outputs": entries}, f, indent=1)
+
+
+def _load_entry(directory, entry, mmap_mode):
+    def load(filename):
+        return np.load(os.path.join(directory, filename), mmap_mode=mmap_mode)
+
+    if entry["kind"] == "array":
+        return load(entry["file"])
+    index = load(entry["index"])
+    if entry["kind"] == "series":
+        return pd.Series(load(entry["file"]), index=index, name=entry["name"])
+    if entry["layout"] == "matrix":
+        return pd.DataFrame(load(entry["file"]), index=index, columns=entry["columns"])
+    frame = pd.DataFrame(
+        {i: load(filename) for i, filename in enumerate(entry["files"])}, index=index
+    )
+    frame.columns = entry["columns"]
+    return frame
+
+
+def load_results(directory, mmap=True, outputs=None):
+    """
+    Opens the outputs stored in directory. Returns a SimResults object: outputs are only read when
+    accessed, and arrays are memory-mapped (unless mmap is False), so only the parts that
+    are used are loaded into memory. If outputs (a list of names) is given, only those are
+    made available
+    """
+    with open(os.path.join(directory, MANIFEST), "r") as f:
+        manifest = json.load(f)
+    assert (
+        manifest["format_version"] == FORMAT_VERSION
+    ), "unsupported results format " + str(manifest["format_version"])
+    mmap_mode = "r" if mmap else None
+    builders = {
+        name: (lambda entry=entry: _load_entry(directory, entry, mmap_mode))
+        for name, entry in manifest["outputs"].items()
+    }
+    return SimResults(builders, outputs)
+
+
+def stored_outputs(directory):
+    """
+    the names of the outputs stored in directory
+    """
+    with open(os.path.join(directory, MANIFEST), "r") as f:
+        return list(json.load(f)["outputs"].keys())
+
+
+def has_results(directory):
+    """
+    True if directory contains a complete set of stored outputs
+    """
+    return os.path.exists(os.path.join(directory, MANIFEST))
@@ -0,0 +1,556 @@
+"""
+Parameter sweeps and multi-seed ensembles: many runs of the simulation, on a process pool.
+
+A sweep spec (yaml) names the parameters to vary with dotted keys into the parameter yaml,
+e.g. openness_dict.cartel, and how to vary them:
+    method: grid, random or lhs (latin hypercube)
+    n_samples: number of points for random and lhs
+    seed: seed for drawing the points for random and lhs
+    parameters: for every key either a list of values or a range {low, high}, with optionally
+        integer: true, log: true and (for grid only) num: the number of points in the range
+    replicates: {n: replicates per point, seed_keys: keys in seed_dict to vary, seed: ...,
+        batched: run the replicates of a point together, see batched.py}
+    outputs: the outputs to store for every run (default all)
+    adaptive: successive halving instead of running every point in full, see
+        run_adaptive_sweep: {metric: a name in METRICS, goal: max or min, keep: fraction
+        of points kept after every round, rounds: [{n_ticks: ..., replicates: ...}, ...]}
+
+Every run gets its own directory <output_dir>/<point_id>/rep_<replicate> with the parameters
+it was run with and its stored outputs. Runs with stored outputs are skipped, so an
+interrupted sweep can be restarted with the same command; a sweep with other parameters
+(e.g. a changed base yaml) in the same output directory is refused.
+"""
+
+import copy
+import csv
+import hashlib
+import itertools
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import yaml
+
+from .simulation import create_simulation, run
+from .batched import run_batched
+from .checkpoint import assert_checkpointable, save_checkpoint, load_checkpoint
+from .storage import save_results, load_results, has_results
+from .results_db import ResultsDB
+from .utils import set_parameter
+from .world import (
+    get_world,
+    use_world_store,
+    world_parameters,
+    world_store,
+    world_store_dir,
+)
+from .cache import canonical_params, run_key
+
+
+def _plain(x):
+    """
+    numpy scalars to python types, so that parameters can be written to yaml/json
+    """
+    return x.item() if isinstance(x, np.generic) else x
+
+
+def _from_unit(spec, u):
+    """
+    maps u in [0, 1) to a value of the parameter spec (a list of values or a range)
+    """
+    if isinstance(spec, list):
+        return spec[min(int(u * len(spec)), len(spec) - 1)]
+    low, high = spec["low"], spec["high"]
+    if spec.get("integer", False):
+        return int(min(low + np.floor(u * (high - low + 1)), high))
+    if spec.get("log", False):
+        return float(np.exp(np.log(low) + u * (np.log(high) - np.log(low))))
+    return float(low + u * (high - low))
+
+
+def _grid_values(spec):
+    if isinstance(spec, list):
+        return spec
+    assert "num" in spec, "a range in a grid sweep needs num"
+    if spec.get("log", False):
+        values = np.exp(
+            np.linspace(np.log(spec["low"]), np.log(spec["high"]), spec["num"])
+        )
+    else:
+        values = np.linspace(spec["low"], spec["high"], spec["num"])
+    if spec.get("integer", False):
+        return sorted(set(int(np.round(v)) for v in values))
+    return [float(v) for v in values]
+
+
+def sweep_points(sweep_spec):
+    """
+    list of dictionaries {dotted key: value}, one for every point in the sweep
+    """
+    parameters = sweep_spec.get("parameters", {})
+    keys = list(parameters.keys())
+    method = sweep_spec.get("method", "grid")
+    if method == "grid":
+        return [
+            dict(zip(keys, values))
+            for values in itertools.product(
+                *[_grid_values(parameters[k]) for k in keys]
+            )
+        ]
+    n = sweep_spec["n_samples"]
+    if not keys:
+        return [{} for _ in range(n)]
+    rng = np.random.RandomState(sweep_spec.get("seed", 0))
+    if method == "random":
+        units = rng.uniform(size=(n, len(keys)))
+    elif method == "lhs":
+        # one sample in every one of the n strata of every parameter
+        units = np.stack(
+            [(rng.permutation(n) + rng.uniform(size=n)) / n for _ in keys], axis=1
+        )
+    else:
+        raise ValueError("unknown sweep method: " + str(method))
+    return [
+        {k: _plain(_from_unit(parameters[k], u)) for k, u in zip(keys, row)}
+        for row in units
+    ]
+
+
+def replicate_seeds(sweep_spec):
+    """
+    list of dictionaries {seed_dict key: seed}, one for every replicate
+    """
+    replicates = sweep_spec.get("replicates", {})
+    n = replicates.get("n", 1)
+    seed_keys = replicates.get("seed_keys", ["overall_seed"])
+    if n == 1 and "seed" not in replicates:
+        # a single replicate keeps the seeds of the base parameters
+        return [{}]
+    seeds = np.random.RandomState(replicates.get("seed", 0)).randint(
+        2**31 - 1, size=(n, len(seed_keys))
+    )
+    return [{k: int(s) for k, s in zip(seed_keys, row)} for row in seeds]
+
+
+def point_id(point):
+    """
+    short, stable identifier for a point in parameter space
+    """
+    canonical = json.dumps(point, sort_keys=True, default=_plain)
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()[:12]
+
+
+def make_jobs(base_config, sweep_spec, output_dir):
+    """
+    list of (run directory, full parameters, point, replicate) for every run in the sweep
+    """
+    outputs = sweep_spec.get("outputs", None)
+    jobs = []
+    for point in sweep_points(sweep_spec):
+        pid = point_id(point)
+        for replicate, seeds in enumerate(replicate_seeds(sweep_spec)):
+            config = copy.deepcopy(base_config)
+            for key, value in point.items():
+                set_parameter(config, key, value)
+            for key, seed in seeds.items():
+                set_parameter(config, "seed_dict." + key, seed)
+            if outputs is not None:
+                config.setdefault("output_dict", {})["outputs"] = outputs
+            run_dir = os.path.join(output_dir, pid, "rep_{}".format(replicate))
+            jobs.append((run_dir, config, point, replicate))
+    return jobs
+
+
+def run_job(run_dirs, configs, cache=None, db_path=None):
+    """
+    runs the simulation for one job and stores the outputs in <run dir>/results
+    a job with more than one run is a batch of replicates that only differ in their
+    overall seed, which are run together with batched.run_batched
+    runs in cache (a ResultCache, see cache.py) are taken from it, the others are added
+    the runs are added to the ResultsDB in db_path, if given, with their METRICS
+    returns (run_dir, run time or None, error message or None) for every run
+    """
+    start = time.time()
+    try:
+        outs = [None if cache is None else cache.get(config) for config in configs]
+        todo = [i for i, out in enumerate(outs) if out is None]
+        if len(todo) == 1:
+            outs[todo[0]] = run(**copy.deepcopy(configs[todo[0]]))
+        elif todo:
+            seeds = [configs[i]["seed_dict"]["overall_seed"] for i in todo]
+            batch = run_batched(overall_seeds=seeds, **copy.deepcopy(configs[todo[0]]))
+            for i, out in zip(todo, batch):
+                outs[i] = out
+        if cache is not None:
+            for i in todo:
+                cache.put(configs[i], outs[i])
+        for run_dir, out in zip(run_dirs, outs):
+            save_results(out, os.path.join(run_dir, "results"))
+        run_time = (time.time() - start) / len(run_dirs)
+        if db_path is not None:
+            db = ResultsDB(db_path)
+            for run_dir, config, out in zip(run_dirs, configs, outs):
+                db.add_run(run_dir, config, out, METRICS, run_time)
+            db.close()
+    except Exception:
+        error = traceback.format_exc()
+        for run_dir in run_dirs:
+            with open(os.path.join(run_dir, "error.txt"), "w") as f:
+                f.write(error)
+        return [(run_dir, None, error) for run_dir in run_dirs]
+    for run_dir in run_dirs:
+        if os.path.exists(os.path.join(run_dir, "error.txt")):
+            os.remove(os.path.join(run_dir, "error.txt"))
+    return [(run_dir, run_time, None) for run_dir in run_dirs]
+
+
+def batch_jobs(todo, batched):
+    """
+    groups the runs to do into jobs: one run per job, or all replicates of a point in
+    one job if batched
+    """
+    if not batched:
+        return [([run_dir], [config]) for run_dir, config, _ in todo]
+    points = {}
+    for run_dir, config, point in todo:
+        run_dirs, configs = points.setdefault(point_id(point), ([], []))
+        run_dirs.append(run_dir)
+        configs.append(config)
+    return list(points.values())
+
+
+def stored_config(run_dir):
+    """
+    the parameters a run in run_dir was started with, or None if it hasn't been
+    """
+    path = os.path.join(run_dir, "params.yaml")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return yaml.safe_load(f)
+
+
+def check_stored_configs(jobs):
+    """
+    raises a ValueError if a run of jobs was started before with other parameters
+    (settings that don't change the outputs aside, see cache.py)
+    """
+    changed = []
+    for run_dir, config, _, _ in jobs:
+        stored = stored_config(run_dir)
+        config = yaml.safe_load(yaml.safe_dump(config))
+        if stored is not None and canonical_params(stored) != canonical_params(config):
+            changed.append(run_dir)
+    if changed:
+        raise ValueError(
+            "{} runs in the output directory were run with other parameters, e.g. "
+            "{}; use another output directory".format(len(changed), changed[0])
+        )
+
+
+def index_done(jobs, db):
+    """
+    adds the runs of jobs that have stored outputs but are not in db, e.g. of a sweep
+    from before it had one, with the parameters they were run with
+    """
+    for run_dir, _, _, _ in jobs:
+        results = os.path.join(run_dir, "results")
+        config = stored_config(run_dir)
+        if config is not None and has_results(results) and not db.has_run(run_dir):
+            db.add_run(run_dir, config, load_results(results), METRICS)
+
+
+def write_index(jobs, output_dir):
+    """
+    jobs.csv: the directory, point, replicate and parameter values of every run
+    """
+    keys = sorted(set(k for _, _, point, _ in jobs for k in point))
+    with open(os.path.join(output_dir, "jobs.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["run_dir", "point_id", "replicate"] + keys)
+        for run_dir, _, point, replicate in jobs:
+            writer.writerow(
+                [os.path.relpath(run_dir, output_dir), point_id(point), replicate]
+                + [point.get(k) for k in keys]
+            )
+
+
+def build_worlds(configs):
+    """
+    stores the worlds (see world.py) that more than one of configs share on disk
+    """
+    if world_store() is None:
+        return
+    counts = {}
+    for config in configs:
+        # a cohort run has the world of its cohorts, set up by the worker
+        if config.get("cohort_dict", {}).get("n_archetypes"):
+            continue
+        key = run_key(world_parameters(**config))
+        counts[key] = counts.get(key, 0) + 1
+        if counts[key] == 2:
+            get_world(**config)
+
+
+def run_sweep(
+    base_config, sweep_spec, output_dir, n_workers=None, verbose=True, cache=None
+):
+    """
+    Runs all jobs of a sweep that don't have stored outputs yet, at most n_workers
+    (default: one per core) at a time, taking the runs in cache (a ResultCache) from
+    it. Returns the directories of the runs that failed.
+    """
+    if "adaptive" in sweep_spec:
+        return run_adaptive_sweep(
+            base_config, sweep_spec, output_dir, n_workers, verbose
+        )
+    jobs = make_jobs(base_config, sweep_spec, output_dir)
+    check_stored_configs(jobs)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(os.path.join(output_dir, "sweep.yaml"), "w") as f:
+        yaml.safe_dump({"base": base_config, "sweep": sweep_spec}, f)
+    write_index(jobs, output_dir)
+    db = ResultsDB(output_dir)
+    index_done(jobs, db)
+    db.close()
+
+    todo = []
+    for run_dir, config, point, _ in jobs:
+        if has_results(os.path.join(run_dir, "results")):
+            continue
+        if not os.path.exists(run_dir):
+            os.makedirs(run_dir)
+        with open(os.path.join(run_dir, "params.yaml"), "w") as f:
+            yaml.safe_dump(config, f)
+        todo.append((run_dir, config, point))
+    if verbose:
+        print(
+            "{} runs in sweep, {} already done, {} to run".format(
+                len(jobs), len(jobs) - len(todo), len(todo)
+            )
+        )
+
+    batched = sweep_spec.get("replicates", {}).get("batched", False)
+    if batched:
+        assert sweep_spec["replicates"].get("seed_keys", ["overall_seed"]) == [
+            "overall_seed"
+        ], "batched replicates can only differ in their overall_seed"
+    n_workers = n_workers or os.cpu_count() or 1
+    if n_workers > 1:
+        # the workers memory-map the worlds of the runs instead of each drawing them
+        build_worlds([config for _, config, _ in todo])
+    failed = []
+    done = 0
+    # the workers store worlds where this process does
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        initializer=use_world_store,
+        initargs=(world_store_dir(),),
+    ) as pool:
+        pending = set()
+        queue = iter(batch_jobs(todo, batched))
+        while True:
+            # keep a bounded number of jobs in flight, so that memory use stays bounded
+            n_new = 2 * n_workers - len(pending)
+            for run_dirs, configs in itertools.islice(queue, n_new):
+                pending.add(pool.submit(run_job, run_dirs, configs, cache, db.path))
+            if not pending:
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for run_dir, run_time, error in (
+                x for future in finished for x in future.result()
+            ):
+                done += 1
+                if error is not None:
+                    failed.append(run_dir)
+                if verbose:
+                    print(
+                        "[{}/{}] {} {}".format(
+                            done,
+                            len(todo),
+                            os.path.relpath(run_dir, output_dir),
+                            "FAILED" if error else "{:.1f}s".format(run_time),
+                        )
+                    )
+    return failed
+
+
+# metrics of a run, stored in the results database of a sweep (see results_db.py) and
+# scored on by adaptive sweeps: functions of the outputs of a run
+METRICS = {
+    # mean share (in %) of the top 3 firms in a category over the last 12 ticks
+    "concentration": lambda out: np.nanmean(out["market_share_df"]["consumer"]),
+    # number of firms with any usage in the last tick
+    "active_firms": lambda out: (out["firm_usage_df"].iloc[-1] > 0).sum(),
+    # mean quality of the categories that have firms
+    "quality": lambda out: np.nanmean(
+        out["welfare_df"]["quality"][out["welfare_df"]["num_firms"] > 0]
+    ),
+    # number of new products, in existing and new categories
+    "new_products": lambda out: out["innovation_df"].values.sum(),
+}
+
+
+def advance_job(run_dir, config, n_ticks, metric, final, db_path=None):
+    """
+    runs one replicate of a point up to n_ticks, continuing from the checkpoint in
+    <run_dir> if there is one, and scores it with metric (a name in METRICS or a
+    function of the outputs). The run is checkpointed again, or if final, its outputs
+    are stored in <run_dir>/results and added to the ResultsDB in db_path, if given
+    returns (run_dir, first tick run, ticks reached, score, error message or None)
+    """
+    checkpoint = os.path.join(run_dir, "checkpoint.pkl")
+    start_tick = 0
+    try:
+        if os.path.exists(checkpoint):
+            sim = load_checkpoint(checkpoint)
+            start_tick = sim.tick
+        else:
+            sim = create_simulation(**copy.deepcopy(config))
+        sim.run_until(n_ticks)
+        score = METRICS[metric] if isinstance(metric, str) else metric
+        score = float(score(sim.results()))
+        if final:
+            outputs = config.get("output_dict", {}).get("outputs")
+            save_results(sim.results(outputs), os.path.join(run_dir, "results"))
+            if db_path is not None:
+                db = ResultsDB(db_path)
+                db.add_run(run_dir, config, sim.results(outputs), METRICS)
+                db.close()
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
+        else:
+            save_checkpoint(sim, checkpoint)
+    except Exception:
+        error = traceback.format_exc()
+        with open(os.path.join(run_dir, "error.txt"), "w") as f:
+            f.write(error)
+        return run_dir, start_tick, start_tick, float("nan"), error
+    return run_dir, start_tick, sim.tick, score, None
+
+
+def select_points(scores, keep, goal):
+    """
+    the ids of the best fraction keep of the points in scores ({point id: score});
+    points without a score (nan) are dropped first
+    """
+    sign = -1 if goal == "max" else 1
+    ranked = sorted(
+        scores,
+        key=lambda pid: (np.isnan(scores[pid]), sign * np.nan_to_num(scores[pid])),
+    )
+    return ranked[: max(1, int(np.ceil(len(ranked) * keep)))]
+
+
+def run_adaptive_sweep(
+    base_config, sweep_spec, output_dir, n_workers=None, verbose=True
+):
+    """
+    Successive halving: every point of the sweep is run for the horizon and number of
+    replicates of the first round in sweep_spec["adaptive"]["rounds"], and scored on a
+    metric. Only the best fraction keep of the points is run in the next round, with a
+    longer horizon and/or more replicates; runs continue from their checkpoint, so
+    no tick is simulated twice. Only the survivors of the last round have their outputs
+    stored. Finished rounds are recorded in round_<i>.json and skipped on a restart.
+    Returns the directories of the runs that failed.
+    """
+    adaptive = sweep_spec["adaptive"]
+    rounds = adaptive["rounds"]
+    metric = adaptive.get("metric", "concentration")
+    assert callable(metric) or metric in METRICS, "unknown metric: " + str(metric)
+    goal = adaptive.get("goal", "max")
+    assert goal in ("max", "min"), "goal must be max or min"
+    keep = adaptive.get("keep", 0.5)
+    n_ticks = base_config["general_dict"]["n_ticks"]
+
+    # as many replicate seeds as the last round needs
+    max_replicates = max(r.get("replicates", 1) for r in rounds)
+    spec = dict(sweep_spec)
+    spec["replicates"] = dict(sweep_spec.get("replicates", {}), n=max_replicates)
+    jobs = make_jobs(base_config, spec, output_dir)
+    check_stored_configs(jobs)
+    # the runs continue from their checkpoints in every round
+    for _, config, _, _ in jobs:
+        assert_checkpointable(config["general_dict"])
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(os.path.join(output_dir, "sweep.yaml"), "w") as f:
+        yaml.safe_dump({"base": base_config, "sweep": sweep_spec}, f)
+    write_index(jobs, output_dir)
+    db = ResultsDB(output_dir)
+    db.close()
+    by_point = {}
+    for run_dir, config, point, replicate in jobs:
+        by_point.setdefault(point_id(point), []).append((run_dir, config))
+
+    n_workers = n_workers or os.cpu_count() or 1
+    survivors = list(by_point.keys())
+    failed = []
+    ticks_run = 0
+    for i, rnd in enumerate(rounds):
+        final = i == len(rounds) - 1
+        horizon = min(rnd.get("n_ticks", n_ticks), n_ticks)
+        n_replicates = rnd.get("replicates", 1)
+        round_file = os.path.join(output_dir, "round_{}.json".format(i))
+        if os.path.exists(round_file):
+            with open(round_file, "r") as f:
+                scores = json.load(f)["scores"]
+        else:
+            todo = []
+            for pid in survivors:
+                for run_dir, config in by_point[pid][:n_replicates]:
+                    if not os.path.exists(run_dir):
+                        os.makedirs(run_dir)
+                        with open(os.path.join(run_dir, "params.yaml"), "w") as f:
+                            yaml.safe_dump(config, f)
+                    todo.append((run_dir, config, horizon, metric, final, db.path))
+            run_scores = {}
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                initializer=use_world_store,
+                initargs=(world_store_dir(),),
+            ) as pool:
+                for run_dir, start, end, score, error in pool.map(
+                    advance_job, *zip(*todo)
+                ):
+                    ticks_run += end - start
+                    run_scores[run_dir] = score
+                    if error is not None:
+                        failed.append(run_dir)
+            scores = {
+                pid: float(
+                    np.mean([run_scores[d] for d, _ in by_point[pid][:n_replicates]])
+                )
+                for pid in survivors
+            }
+            with open(round_file, "w") as f:
+                json.dump({"n_ticks": horizon, "scores": scores}, f, indent=1)
+        if verbose:
+            best = select_points(scores, 0, goal)[0]
+            print(
+                "round {}: {} points, {} ticks, {} replicates, best {} {}".format(
+                    i, len(scores), horizon, n_replicates, best, scores[best]
+                )
+            )
+        if final:
+            break
+        survivors = select_points(scores, keep, goal)
+        # pruned points will not be run again
+        for pid in set(scores) - set(survivors):
+            for run_dir, _ in by_point[pid]:
+                checkpoint = os.path.join(run_dir, "checkpoint.pkl")
+                if os.path.exists(checkpoint):
+                    os.remove(checkpoint)
+
+    if verbose:
+        exhaustive = len(by_point) * max_replicates * n_ticks
+        print(
+            "simulated {} ticks, an exhaustive sweep would simulate {}".format(
+                ticks_run, exhaustive
+            )
+        )
+    return failed
@@ -0,0 +1,38 @@
+import copy
+import os
+
+import numpy as np
+import yaml
+
+from model.checkpoint import fork_scenarios
+from model.simulation import run
+from model.storage import load_results
+
+PARAMETERS = os.path.join(
+    os.path.dirname(__file__), os.pardir, os.pardir, "model_parameters.yaml"
+)
+
+
+def small_config():
+    with open(PARAMETERS, "r") as f:
+        config = yaml.safe_load(f)
+    config["general_dict"].update(n_ticks=25, n_consumers=100, preflight="off")
+    config["category_dict"].update(n_total_categories=10)
+    config["scenario_dict"]["scen_tick"] = 15
+    # converges as soon as the window is full, so only the scenario tick holds it back
+    config["stopping_dict"].update(concentration_tol=100, window=3)
+    return config
+
+
+def test_fork_with_early_stopping_equals_unforked_run(tmp_path):
+    config = small_config()
+    unforked = run(**copy.deepcopy(config))
+    fork_scenarios(config, {"baseline": {}}, str(tmp_path), n_workers=1, verbose=False)
+    forked = load_results(str(tmp_path / "baseline" / "results"))
+
+    # the run stops after the scenario tick, and the branch applies the scenario
+    assert len(unforked["concern_evo"]) == 16
+    for name in ["capital", "concern_evo", "ps_score_evo"]:
+        np.testing.assert_array_equal(
+            np.asarray(forked[name]), np.asarray(unforked[name])
+        )
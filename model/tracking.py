@@ -1,9 +1,29 @@
+import copy
+from collections.abc import Mapping
+
 import numpy as np
 import pandas as pd
-from scipy.stats import rankdata
 
 
 class SimTracker(object):
+    # the arrays with one entry per tick
+    _PER_TICK = [
+        "_quality",
+        "_capital",
+        "_usage",
+        "_usage_consumer",
+        "_new_firms",
+        "_dead_firms",
+        "_live_firms",
+        "_new_products_existing_cat",
+        "_new_products_new_cat",
+        "_investment_choices",
+        "_investment_success",
+        "_concern",
+        "_privacy_score",
+        "_success_prob",
+    ]
+
     def __init__(
         self, n_ticks, n_firms, n_categories, n_consumers, quality, small_start_capital
     ):
@@ -33,8 +53,14 @@ class SimTracker(object):
         F_qual_tick, F_cap_tick, F_usage_tick, num_new_firms, num_dead_firms, F_alive, \
             investment, success, concern, ps, r_ct_g, success_prob = data
 
-        self._usage[tick] = F_usage_tick.sum(axis=0).T
-        self._usage_consumer[tick] = (F_usage_tick.sum(axis=1) > 0).astype(int)
+        if isinstance(F_usage_tick, tuple):
+            # already added up: (category, firm) totals, (consumer, firm) used or not
+            usage_total, firms_used = F_usage_tick
+        else:
+            usage_total = F_usage_tick.sum(axis=0)
+            firms_used = F_usage_tick.sum(axis=1) > 0
+        self._usage[tick] = usage_total.T
+        self._usage_consumer[tick] = firms_used.astype(int)
         self._quality[tick] = F_qual_tick
         self._capital[tick] = F_cap_tick
         self._live_firms[tick] = F_alive
@@ -96,19 +122,68 @@ class SimTracker(object):
     def add_needs(self, need_matrix):
         self._need_matrix = need_matrix
 
-    def gather_output(self):
-        n_ticks, n_firms, n_categories = self._quality.shape
+    def truncated(self, n_ticks):
+        """
+        a copy of the tracker with only the first n_ticks ticks, for the outputs of
+        a simulation that stopped early
+        """
+        tracker = copy.copy(self)
+        for name in self._PER_TICK:
+            setattr(tracker, name, getattr(self, name)[:n_ticks])
+        return tracker
+
+    def gather_output(self, outputs=None):
+        """
+        Returns a SimResults object with the outputs of the simulation. Outputs are only
+        computed when they are accessed; if outputs (a list of names) is given, only those
+        outputs will be available
+        """
+        builders = {
+            "quality": self._build_quality_df,
+            "capital": self._build_capital_df,
+            "usage": lambda: self._usage,
+            "new_firms": lambda: self._new_firms,
+            "dead_firms": lambda: self._dead_firms,
+            "ps_score_evo": self._build_ps_score_evo,
+            "concern_evo": self._build_concern_evo,
+            "firm_usage_df": self._build_firm_usage_df,
+            "new_prod_success": self._build_new_prod_success,
+            "invest_df": self._build_invest_df,
+            "success_prob_df": self._build_success_prob_df,
+            "welfare_df_all_products": self._build_welfare_df_all_products,
+            "cat_new_firms": lambda: self._cat_new_firms,
+            "cat_dead_firms": lambda: self._cat_dead_firms,
+            "year_growth_df": self._build_year_growth_df,
+            "new_products_existing_cat": lambda: pd.Series(
+                self._new_products_existing_cat
+            ),
+            "new_products_new_cat": lambda: pd.Series(self._new_products_new_cat),
+            "market_share_timeline_df": self._build_market_share_timeline_df,
+            "welfare_df": self._build_welfare_df,
+            "innovation_df": self._build_innovation_df,
+            "complimentarity_df": self._build_complimentarity_df,
+            "firm_specialisation_df": self._build_firm_specialisation_df,
+            "market_share_df": self._build_market_share_df,
+            "cat_entry_and_exit_df": lambda: pd.DataFrame(
+                {"entry": self._cat_new_firms, "exit": self._cat_dead_firms}
+            ),
+            "data_request_plot_df": self._build_data_request_plot_df,
+        }
+        return SimResults(builders, outputs)
 
+    def _build_firm_specialisation_df(self):
         # data for firm specialisation plot - only on firms that have ever existed
         active = self._quality[:, self._quality.sum(axis=(0, 2)) > 0, :]
         active = (active[-12:].sum(axis=0) > 0).astype(int)
         bins = np.bincount(active.sum(axis=-1))
         total = bins.sum()
-        self._firm_specialisation_df = pd.DataFrame(
+        return pd.DataFrame(
             {"bins": np.arange(len(bins)), "perc": np.round(bins / total * 100, 1)}
         )
 
+    def _build_market_share_df(self):
         # data for market concentration
+        n_categories = self._quality.shape[2]
         # (firm, category)
         cons_count_mat = self._usage[-12:].sum(axis=0)
         # (category)
@@ -127,10 +202,11 @@ class SimTracker(object):
                 "firms_active": still_active_last_ticks,
             }
         )
-        res_df = pd.merge(res_df, sa_df, on="category")
-        self._market_share_df = res_df
+        return pd.merge(res_df, sa_df, on="category")
 
+    def _build_market_share_timeline_df(self):
         # data for market concentration over time
+        n_ticks, _, n_categories = self._quality.shape
         # (tick, firm, category)
         cons_count_mat = self._usage
         # (tick, category)
@@ -158,40 +234,49 @@ class SimTracker(object):
                 columns={"level_0": "tick", "level_1": "category", 0: "firms_active"}
             )
         )
-        res_df = pd.merge(res_df, sa_df, on=["category", "tick"])
-        self._market_share_timeline_df = res_df
+        return pd.merge(res_df, sa_df, on=["category", "tick"])
 
+    def _build_complimentarity_df(self):
         # data for complimentarity
         firm_count = np.bincount(
             (self._usage_consumer[-12:].sum(axis=0) > 0).astype(int).sum(axis=-1)
         )
-        self._complimentarity_df = pd.DataFrame(
+        return pd.DataFrame(
             {
                 "bins": np.arange(len(firm_count)),
                 "perc": np.round(firm_count / firm_count.sum() * 100, 1),
             }
         )
 
+    def _mean_num_firms(self):
+        # (category) mean number of firms active in the last year
+        return (self._quality[-12:] > 0).astype(int).sum(axis=(0, 1)) / 12
+
+    def _build_welfare_df(self):
         # data for consumer welfare
+        n_categories = self._quality.shape[2]
         max_qual_category = np.max(self._quality, axis=(0, 1))
-        median_needs = np.median(self._need_matrix, axis=0)
-        cat_ranking = rankdata(median_needs)
-        mean_num_firms = (self._quality[-12:] > 0).astype(int).sum(axis=(0, 1)) / 12
+        mean_num_firms = self._mean_num_firms()
         # (category) overall usage over time and firms
         usage_count = self._usage.sum(axis=(0, 1))
         # (category) how many ticks was category available?
         tick_count = (self._quality.sum(axis=1) > 0).astype(int).sum(axis=0)
         mean_usage_per_tick = usage_count / tick_count
-        self._welfare_df = pd.DataFrame(
-            {  #'rank_': cat_ranking, 'median_': np.round(median_needs, 4),
+        return pd.DataFrame(
+            {
                 "quality": np.round(max_qual_category, 2),
                 "num_firms": np.round(mean_num_firms, 1),
                 "category": np.arange(n_categories),
                 "mean_usage_per_tick": np.round(mean_usage_per_tick, 0),
             }
         )
+
+    def _build_welfare_df_all_products(self):
         # data for consumer welfare all companies
-        self._welfare_df_all_products = pd.DataFrame(
+        _, n_firms, n_categories = self._quality.shape
+        median_needs = np.median(self._need_matrix, axis=0)
+        mean_num_firms = self._mean_num_firms()
+        welfare_df_all_products = pd.DataFrame(
             {
                 "median_": (
                     median_needs[None, :] * np.ones((n_firms, n_categories))
@@ -205,74 +290,86 @@ class SimTracker(object):
                 ).flatten(),
             }
         )
-        self._welfare_df_all_products = self._welfare_df_all_products.loc[
-            self._welfare_df_all_products.quality > 0
-        ]
+        return welfare_df_all_products.loc[welfare_df_all_products.quality > 0]
 
+    def _build_invest_df(self):
         # gathering the investment choices
-        self._invest_df = pd.DataFrame(
+        return pd.DataFrame(
             self._investment_choices.sum(axis=1),
-            index=range(n_ticks),
+            index=range(self._quality.shape[0]),
             columns=["Existing prod", "New prod", "New cat"],
         )
 
+    def _build_new_prod_success(self):
         # gathering the innovation success
-        self._new_prod_success = pd.DataFrame(
+        return pd.DataFrame(
             (self._investment_choices * self._investment_success[:, :, None]).sum(
                 axis=1
             ),
-            index=range(n_ticks),
+            index=range(self._quality.shape[0]),
             columns=["Existing prod", "New prod", "New cat"],
         )
 
+    def _build_capital_df(self):
+        n_ticks, n_firms, _ = self._quality.shape
+        return pd.DataFrame(
+            self._capital, index=np.arange(n_ticks), columns=np.arange(n_firms)
+        )
+
+    def _build_firm_usage_df(self):
         # gather overall usage of all products a firm offers
-        self._firm_usage_df = pd.DataFrame(
+        n_ticks, n_firms, _ = self._quality.shape
+        return pd.DataFrame(
             self._usage.sum(axis=-1), columns=np.arange(n_firms), index=range(n_ticks)
         )
 
+    def _build_ps_score_evo(self):
         # gather the evolution of the privacy score of firms
-        self._ps_score_evo = pd.DataFrame(
+        n_ticks, n_firms, _ = self._quality.shape
+        return pd.DataFrame(
             self._privacy_score, columns=np.arange(n_firms), index=range(n_ticks)
         )
 
+    def _build_concern_evo(self):
         # gathering the evolution of privacy concern over time
-        n_consumers = self._concern.shape[1]
-        self._concern_evo = pd.DataFrame(
+        n_ticks, n_consumers = self._concern.shape
+        return pd.DataFrame(
             self._concern, columns=np.arange(n_consumers), index=range(n_ticks)
         )
 
-        # evolution of quality over time
-        mi = pd.MultiIndex.from_product(
-            [np.arange(n_ticks), np.arange(n_firms), np.arange(n_categories)],
-            names=["tick", "firm", "category"],
-        )
-        quality_series = pd.Series(index=mi, data=self._quality.flatten())
-        quality_series = quality_series[quality_series > 0]
-        self._quality_df = (
-            quality_series.to_frame().reset_index().rename(columns={0: "quality"})
+    def _build_quality_df(self):
+        # evolution of quality over time, only for products that exist
+        tick_, firm_, cat_ = np.nonzero(self._quality > 0)
+        return pd.DataFrame(
+            {
+                "tick": tick_,
+                "firm": firm_,
+                "category": cat_,
+                "quality": self._quality[tick_, firm_, cat_],
+            }
         )
 
-        # growth of firms during the first year (only for firms > 12mo)
-        growth_mask_firms = (self._start_tick_new_firms > 0) & (
+    def _growth_mask_firms(self):
+        # firms that were born during the simulation and have existed for more than 12mo
+        n_ticks = self._quality.shape[0]
+        return (self._start_tick_new_firms > 0) & (
             self._start_tick_new_firms + 12 < n_ticks
         )
-        self._year_growth_df = pd.DataFrame(
-            self._capital[
-                self._start_tick_new_firms[growth_mask_firms] + 12,
-                np.arange(n_firms, dtype=int)[growth_mask_firms],
-            ]
-            - self._small_start_capital,
-            index=np.arange(n_firms)[growth_mask_firms],
-            columns=["Growth"],
-        )
-        self._year_growth_df_2 = pd.DataFrame(
+
+    def _build_year_growth_df(self):
+        # growth of firms during the first year (only for firms > 12mo)
+        growth_mask_firms = self._growth_mask_firms()
+        n_firms = growth_mask_firms.shape[0]
+        return pd.DataFrame(
             self._first_year_usage[growth_mask_firms],
             index=np.arange(n_firms, dtype=int)[growth_mask_firms],
             columns=["Growth"],
         )
 
+    def _build_data_request_plot_df(self):
         # data for data request plot
-        self._data_plot_df = pd.DataFrame(
+        growth_mask_firms = self._growth_mask_firms()
+        return pd.DataFrame(
             {
                 "requests": self._first_year_requests_granted[growth_mask_firms],
                 "num_cat": self._quality[
@@ -282,10 +379,11 @@ class SimTracker(object):
             }
         )
 
+    def _build_success_prob_df(self):
         # succesful innovations
         # type 0 = new product in existing cat; 1 = new product in new cat
         tick_, firm_, type_ = np.where(self._success_prob > 0)
-        self._success_prob_df = pd.DataFrame(
+        return pd.DataFrame(
             {
                 "tick": tick_,
                 "firm": firm_,
@@ -294,46 +392,58 @@ class SimTracker(object):
             }
         )
 
-        return {
-            'quality': self._quality_df,
-            'capital': pd.DataFrame(self._capital, index=np.arange(n_ticks), columns=np.arange(n_firms)),
-            'usage': self._usage,
-            'new_firms': self._new_firms,
-            'dead_firms': self._dead_firms,
-            'ps_score_evo': self._ps_score_evo,
-            'concern_evo': self._concern_evo,
-            'firm_usage_df': self._firm_usage_df,
-            'new_prod_success': self._new_prod_success,
-            'invest_df': self._invest_df,
-            'success_prob_df': self._success_prob_df,
-            'welfare_df_all_products': self._welfare_df_all_products,
-            'cat_new_firms': self._cat_new_firms,
-            'cat_dead_firms': self._cat_dead_firms,
-            'year_growth_df': self._year_growth_df_2,
-            'new_products_existing_cat': pd.Series(self._new_products_existing_cat),
-            'new_products_new_cat': pd.Series(self._new_products_new_cat),
-            'market_share_timeline_df': self._market_share_timeline_df,
-            "welfare_df": self._welfare_df,
-            "innovation_df": pd.concat(
-                [
-                    pd.DataFrame(
-                        self._new_products_new_cat,
-                        index=np.arange(self._new_products_new_cat.shape[0]),
-                        columns=["new"],
-                    ),
-                    pd.DataFrame(
-                        self._new_products_existing_cat,
-                        index=np.arange(self._new_products_existing_cat.shape[0]),
-                        columns=["existing"],
-                    ),
-                ],
-                axis=1,
-            ),
-            "complimentarity_df": self._complimentarity_df,
-            "firm_specialisation_df": self._firm_specialisation_df,
-            "market_share_df": self._market_share_df,
-            "cat_entry_and_exit_df": pd.DataFrame(
-                {"entry": self._cat_new_firms, "exit": self._cat_dead_firms}
-            ),
-            "data_request_plot_df": self._data_plot_df,
-        }
+    def _build_innovation_df(self):
+        return pd.concat(
+            [
+                pd.DataFrame(
+                    self._new_products_new_cat,
+                    index=np.arange(self._new_products_new_cat.shape[0]),
+                    columns=["new"],
+                ),
+                pd.DataFrame(
+                    self._new_products_existing_cat,
+                    index=np.arange(self._new_products_existing_cat.shape[0]),
+                    columns=["existing"],
+                ),
+            ],
+            axis=1,
+        )
+
+
+class SimResults(Mapping):
+    """
+    Read-only dictionary of the outputs of a simulation. An output is only computed the first
+    time it is accessed, after which it is cached
+    """
+
+    def __init__(self, builders, outputs=None):
+        if outputs is None or outputs == "all":
+            outputs = list(builders.keys())
+        unknown = [x for x in outputs if x not in builders]
+        assert not unknown, "unknown outputs requested: " + ", ".join(unknown)
+        self._builders = builders
+        self._names = list(outputs)
+        self._cache = {}
+
+    def __getitem__(self, name):
+        if name not in self._names:
+            raise KeyError(name)
+        if name not in self._cache:
+            self._cache[name] = self._builders[name]()
+        return self._cache[name]
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def with_outputs(self, builders):
+        """
+        a SimResults with the outputs of builders (name: function computing it) added
+        """
+        results = SimResults(
+            dict(self._builders, **builders), self._names + list(builders)
+        )
+        results._cache = dict(self._cache)
+        return results
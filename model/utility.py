@@ -36,6 +36,16 @@ def utility_for_consumers(
     )
 
 
+def choice_probabilities(U, quality, w_logit, privacy_mask):
+    """
+    input: as choose_firms
+    output: (consumer, category, firm) probability of choosing each firm
+    """
+    market_matrix = (quality > 0).astype(int).T
+    U_exp = np.exp(w_logit * U) * market_matrix[None, :, :] * privacy_mask[:, None, :]
+    return np.nan_to_num(U_exp / np.nansum(U_exp, axis=-1, keepdims=True))
+
+
 def choose_firms(U, quality, w_logit, privacy_mask, rng):
     """
     input:
@@ -45,8 +55,6 @@ def choose_firms(U, quality, w_logit, privacy_mask, rng):
      - privacy_mask:
     output: (consumer, category, firm) one hot matrix of choice
     """
-    market_matrix = (quality > 0).astype(int).T
-    U_exp = np.exp(w_logit * U) * market_matrix[None, :, :] * privacy_mask[:, None, :]
-    prob = np.nan_to_num(U_exp / np.nansum(U_exp, axis=-1, keepdims=True))
+    prob = choice_probabilities(U, quality, w_logit, privacy_mask)
     choice = multinomial(prob, rng)
     return choice
@@ -28,3 +28,16 @@ def multinomial(M, rng):
     smaller = (np.expand_dims(rands, axis=-1) < cumulative).astype(int)
     choice = smaller.cumsum(axis=-1) == 1
     return choice
+
+
+def set_parameter(config, key, value):
+    """
+    sets a dotted key (e.g. openness_dict.cartel) in a nested parameter dictionary
+    """
+    *sections, name = key.split(".")
+    d = config
+    for section in sections:
+        assert section in d, "unknown parameter section: " + key
+        d = d[section]
+    assert name in d, "unknown parameter: " + key
+    d[name] = value
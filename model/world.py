@@ -0,0 +1,275 @@
+"""
+The world of a simulation: the parts of its initial state that only depend on the seeds
+and the parameters in WORLD_PARAMETERS, not on the dynamics (weights, openness, porting,
+the scenario, ...). These are the needs of the consumers, the datatypes of the
+categories, the privacy scores and concerns and the data combination skills of the
+firms, and drawing the needs is most of the time setup_simulation takes.
+
+make_world draws a world, and get_world memoises it in memory and on disk (in the
+worlds directory of the result cache, see cache.py and use_world_store), so runs that
+share a world, like most runs of a sweep, draw it once. A world on disk is
+memory-mapped read-only, so the processes of a sweep share one copy of it in the page
+cache; setup_simulation copies the arrays a run changes.
+"""
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from .needs import draw_from_one_need_distribution
+from .cache import ResultCache, run_key
+
+# the parameters a world depends on, per section (None: the whole section)
+WORLD_PARAMETERS = {
+    "general_dict": [
+        "n_ticks",
+        "n_consumers",
+        "n_init_firms",
+        "n_init_big_firms",
+        "birth_lambda",
+    ],
+    "seed_dict": ["need_seed", "data_seed", "privacy_seed"],
+    "needs_dict": None,
+    "data_dict": [
+        "n_data_types_init",
+        "n_data_types_total",
+        "growth_factor",
+        "data_skill_distr",
+        "data_skill_range_low",
+        "data_skill_range_high",
+    ],
+    "category_dict": None,
+    "privacy_dict": None,
+}
+WORLD_STORE_GB = 2
+# worlds kept in memory (memory-mapped, if they are on disk)
+MEMORY_WORLDS = 4
+
+_worlds = OrderedDict()
+# the result cache directory the worlds on disk are in, None for none; set by the
+# command line scripts, so library runs don't write to disk
+_store_dir = None
+_store = None
+
+
+def world_parameters(**params):
+    """
+    the parameters of params the world depends on
+    """
+    return {
+        section: {k: v for k, v in params[section].items() if keys is None or k in keys}
+        for section, keys in WORLD_PARAMETERS.items()
+    }
+
+
+def use_world_store(cache_dir):
+    """
+    stores the worlds on disk in the worlds directory of cache_dir, the directory of a
+    result cache, or not at all if cache_dir is None (the default)
+    """
+    global _store_dir, _store
+    if cache_dir != _store_dir:
+        _store_dir, _store = cache_dir, None
+
+
+def world_store_dir():
+    """
+    the cache directory the worlds are stored in (see use_world_store)
+    """
+    return _store_dir
+
+
+def world_store():
+    """
+    the ResultCache of the worlds on disk, or None if there is none or it can't be used
+    """
+    global _store
+    if _store is None:
+        _store = False
+        if _store_dir is not None:
+            try:
+                _store = ResultCache(os.path.join(_store_dir, "worlds"), WORLD_STORE_GB)
+            except OSError:
+                pass
+    return _store or None
+
+
+def get_world(**params):
+    """
+    the world of params (see make_world), memoised in memory and on disk. Its arrays
+    are read-only
+    """
+    world_params = world_parameters(**params)
+    key = run_key(world_params)
+    if key in _worlds:
+        _worlds.move_to_end(key)
+        return _worlds[key]
+    store = world_store()
+    stored = store.get(world_params) if store is not None else None
+    if stored is None:
+        world = make_world(**world_params)
+        if store is not None:
+            store.put(world_params, world)
+            stored = store.get(world_params)
+    if stored is not None:
+        world = {name: stored[name] for name in stored}
+    for array in world.values():
+        array.flags.writeable = False
+    _worlds[key] = world
+    if len(_worlds) > MEMORY_WORLDS:
+        _worlds.popitem(last=False)
+    return world
+
+
+def make_world(
+    general_dict, seed_dict, needs_dict, data_dict, category_dict, privacy_dict
+):
+    """
+    draws the world of a simulation: need_matrix (consumer, category),
+    category_datatype (category, datatype), firm_privacy_score (firm),
+    consumer_privacy_concern (consumer) and data_combination_skill (firm), with every
+    draw from the stream of its own seed
+    """
+    n_init_firms = general_dict["n_init_firms"]
+    n_init_big_firms = general_dict["n_init_big_firms"]
+    n_consumers = general_dict["n_consumers"]
+    n_total_categories = category_dict["n_total_categories"]
+    n_init_categories = category_dict["n_init_categories"]
+    n_total_firms = n_init_firms + max_firm_births(general_dict)
+
+    # privacy score setup
+    privacy_rng = np.random.RandomState(seed=seed_dict["privacy_seed"])
+    firm_privacy_score = np.maximum(
+        np.minimum(
+            privacy_rng.normal(
+                privacy_dict["mean_firm_score"],
+                privacy_dict["var_firm_score"],
+                size=n_total_firms,
+            ),
+            1,
+        ),
+        0,
+    )
+
+    # consumer characteristics
+    consumer_privacy_concern = np.maximum(
+        np.minimum(
+            privacy_rng.normal(
+                privacy_dict["mean_cons_concern"],
+                privacy_dict["var_cons_concern"],
+                size=n_consumers,
+            ),
+            1,
+        ),
+        0,
+    )
+
+    # Assign needs for categories
+    need_matrix = np.zeros(shape=(n_consumers, n_total_categories))
+    need_rng = np.random.RandomState(seed=seed_dict["need_seed"])
+    n_modes_probs = needs_dict["n_modes_probs"]
+    for i in range(np.minimum(n_init_big_firms, n_total_categories)):
+        # assure the big firms are in high-need categories
+        modality = need_rng.choice(np.arange(len(n_modes_probs)), p=n_modes_probs)
+        if needs_dict["hyper_mode"] == "uniform":
+            modes = need_rng.uniform(
+                np.maximum(needs_dict["needs_range_mode_low"], 0.5),
+                needs_dict["needs_range_mode_high"],
+                modality,
+            )
+        if needs_dict["hyper_var"] == "uniform":
+            vars = need_rng.uniform(
+                needs_dict["needs_range_var_low"],
+                needs_dict["needs_range_var_high"],
+                modality,
+            )
+        need_matrix[:, i] = draw_from_one_need_distribution(
+            modes, vars, n_consumers, need_rng
+        )
+    for i in range(
+        np.minimum(n_init_big_firms, n_total_categories), n_total_categories
+    ):
+        modality = need_rng.choice(np.arange(len(n_modes_probs)), p=n_modes_probs)
+        if needs_dict["hyper_mode"] == "uniform":
+            modes = need_rng.uniform(
+                needs_dict["needs_range_mode_low"],
+                needs_dict["needs_range_mode_high"],
+                modality,
+            )
+        if needs_dict["hyper_var"] == "uniform":
+            vars = need_rng.uniform(
+                needs_dict["needs_range_var_low"],
+                needs_dict["needs_range_var_high"],
+                modality,
+            )
+        need_matrix[:, i] = draw_from_one_need_distribution(
+            modes, vars, n_consumers, need_rng
+        )
+
+    # datatypes for categories
+    data_rng = np.random.RandomState(seed=seed_dict["data_seed"])
+    category_datatype = draw_category_datatype(
+        data_dict, n_init_categories, n_total_categories, data_rng
+    )
+
+    # Data combination skills
+    if data_dict["data_skill_distr"] == "uniform":
+        low, hi = data_dict["data_skill_range_low"], data_dict["data_skill_range_high"]
+        data_combination_skill = data_rng.choice(
+            np.arange(low, hi), size=n_total_firms, replace=True
+        )
+
+    return {
+        "need_matrix": need_matrix,
+        "category_datatype": category_datatype,
+        "firm_privacy_score": firm_privacy_score,
+        "consumer_privacy_concern": consumer_privacy_concern,
+        "data_combination_skill": data_combination_skill,
+    }
+
+
+def max_firm_births(general_dict):
+    """
+    how many firms can enter the simulation: a high upper bound on the number of births,
+    which sizes every array with a firm axis
+    """
+    mean_new_firms = general_dict["birth_lambda"] * general_dict["n_ticks"]
+    var_new_firms = mean_new_firms
+    return np.floor(mean_new_firms + 1 * np.sqrt(var_new_firms)).astype(int)
+
+
+def draw_category_datatype(data_dict, n_init_categories, n_total_categories, data_rng):
+    """
+    (category, datatype) the datatypes collected by the products of every category,
+    without the datatypes no category uses
+    """
+    n_data_types_init = data_dict["n_data_types_init"]
+    n_data_types_total = data_dict["n_data_types_total"]
+    category_datatype = np.zeros(
+        (n_total_categories, n_data_types_total), dtype=np.int8
+    )
+    for j in range(n_init_categories):
+        num_types = data_rng.choice(np.arange(np.minimum(n_data_types_init, 3))) + 1
+        choice_types = data_rng.choice(
+            np.arange(n_data_types_init), size=num_types, replace=False
+        )
+        category_datatype[j, choice_types] = 1
+    for e, i in enumerate(range(n_init_categories, n_total_categories)):
+        shift_num_types = np.floor(e / data_dict["growth_factor"]).astype(int)
+        num_types = (
+            data_rng.choice(
+                np.arange(np.minimum(n_data_types_total, 3 + shift_num_types))
+            )
+            + 1
+        )
+        choice_types = data_rng.choice(
+            np.arange(
+                np.minimum(n_data_types_total, n_data_types_init + 3 * shift_num_types)
+            ),
+            size=num_types,
+            replace=False,
+        )
+        category_datatype[i, choice_types] = 1
+    # remove datatypes that are not used at all
+    return category_datatype[:, category_datatype.sum(axis=0) > 0]
@@ -0,0 +1,69 @@
+from model.ensemble import Ensemble, run_ensemble
+from model.report import render_ensemble_report, ENSEMBLE_FIGURES
+from model.storage import load_results, has_results
+
+import glob
+import os
+
+import click
+import yaml
+
+
+def read_yaml(filename):
+    with open(filename, "r") as stream:
+        return yaml.safe_load(stream)
+
+
+@click.command()
+@click.option(
+    "--sweep_dir",
+    "-s",
+    default=None,
+    help="Output directory of a sweep: a report per point, over its replicates",
+)
+@click.option(
+    "--input_yaml",
+    "-i",
+    default="model_parameters.yaml",
+    help="Path to yaml with parameters, to run n_runs seeds of (without --sweep_dir)",
+)
+@click.option("--n_runs", "-n", type=int, default=10, help="Number of seeds to run")
+@click.option(
+    "--output_dir",
+    "-o",
+    default="./ensemble",
+    help="Output directory of the report (with --sweep_dir: <point>/ensemble)",
+)
+@click.option(
+    "--plots",
+    default=None,
+    help="Comma separated figures to make (default: all), from: "
+    + ", ".join(ENSEMBLE_FIGURES),
+)
+def ensemble(sweep_dir, input_yaml, n_runs, output_dir, plots):
+    """
+    figures of the mean, confidence interval and quantiles over many runs of the
+    outputs, folded in one run at a time (see model/ensemble.py)
+    """
+    if plots is not None:
+        plots = [x.strip() for x in plots.split(",") if x.strip()]
+    if sweep_dir is None:
+        result = run_ensemble(n_runs, **read_yaml(input_yaml))
+        render_ensemble_report(result, output_dir, plots)
+        print("{} runs, report in {}".format(result.n_runs, output_dir))
+        return
+    for point_dir in sorted(glob.glob(os.path.join(sweep_dir, "*", ""))):
+        result = Ensemble()
+        for run_dir in sorted(glob.glob(os.path.join(point_dir, "rep_*"))):
+            results = os.path.join(run_dir, "results")
+            if has_results(results):
+                result.add(load_results(results))
+        if result.n_runs == 0:
+            continue
+        report_dir = os.path.join(point_dir, "ensemble")
+        render_ensemble_report(result, report_dir, plots)
+        print("{} runs, report in {}".format(result.n_runs, report_dir))
+
+
+if __name__ == "__main__":
+    ensemble()
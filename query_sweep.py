@@ -0,0 +1,62 @@
+from model.results_db import ResultsDB
+
+import click
+import pandas as pd
+import yaml
+
+
+@click.command()
+@click.option(
+    "--output_dir", "-o", help="Output directory of the sweep", default="./sweep"
+)
+@click.option(
+    "--where",
+    "-w",
+    multiple=True,
+    help="Only the runs with a parameter value, e.g. openness_dict.cartel=false "
+    "(repeat for more)",
+)
+@click.option(
+    "--group_by",
+    "-g",
+    multiple=True,
+    help="Summarise the metrics per value of a parameter (repeat for more)",
+)
+@click.option(
+    "--metric",
+    "-m",
+    multiple=True,
+    help="The metrics to show (default: all)",
+)
+@click.option(
+    "--stat",
+    default="median",
+    help="How to summarise the metrics of a group (median, mean, min, max, ...)",
+)
+@click.option("--csv", "csv_file", default=None, help="Write the table to a csv")
+def query(output_dir, where, group_by, metric, stat, csv_file):
+    """
+    the runs of a sweep matching the --where filters and their metrics, from the
+    results database of the sweep, summarised per group with --group_by
+    """
+    filters = {}
+    for condition in where:
+        name, value = condition.split("=", 1)
+        filters[name] = yaml.safe_load(value)
+    db = ResultsDB(output_dir)
+    table = db.query(
+        filters,
+        parameters=list(group_by) or None,
+        metrics=list(metric) or None,
+    )
+    if group_by:
+        grouped = table.drop(columns="run_time").groupby(list(group_by))
+        table = grouped.agg(stat).join(grouped.size().rename("runs"))
+    if csv_file is not None:
+        table.to_csv(csv_file)
+    with pd.option_context("display.max_rows", None, "display.width", 120):
+        print(table)
+
+
+if __name__ == "__main__":
+    query()
@@ -0,0 +1,40 @@
+from model.checkpoint import fork_scenarios
+
+import click
+import yaml
+
+
+def read_yaml(filename):
+    with open(filename, "r") as stream:
+        return yaml.safe_load(stream)
+
+
+@click.command()
+@click.option(
+    "--input_yaml",
+    "-i",
+    help="Path to yaml with the base parameters",
+    default="model_parameters.yaml",
+)
+@click.option(
+    "--branches_yaml",
+    "-b",
+    help="Path to yaml with the scenario branches",
+    default="scenario_branches.yaml",
+)
+@click.option("--output_dir", "-o", help="Output directory", default="./scenarios")
+@click.option(
+    "--n_workers",
+    "-n",
+    type=int,
+    default=None,
+    help="Number of branches run at the same time (default: one per core)",
+)
+def scenarios(input_yaml, branches_yaml, output_dir, n_workers):
+    base_config = read_yaml(input_yaml)
+    branches = read_yaml(branches_yaml)["branches"]
+    fork_scenarios(base_config, branches, output_dir, n_workers)
+
+
+if __name__ == "__main__":
+    scenarios()
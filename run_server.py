@@ -0,0 +1,57 @@
+from model.server import serve, DEFAULT_PORT
+from model.cache import ResultCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_GB
+
+import os
+
+import click
+import yaml
+
+
+def read_yaml(filename):
+    with open(filename, "r") as stream:
+        return yaml.safe_load(stream)
+
+
+@click.command()
+@click.option(
+    "--input_yaml",
+    "-i",
+    help="Path to yaml with the base parameters of the runs",
+    default="model_parameters.yaml",
+)
+@click.option("--host", default="127.0.0.1", help="Address to listen on")
+@click.option("--port", "-p", type=int, default=DEFAULT_PORT, help="Port to listen on")
+@click.option(
+    "--n_workers",
+    "-n",
+    type=int,
+    default=None,
+    help="Number of warm worker processes (default: one per core)",
+)
+@click.option(
+    "--cache_dir",
+    help="Directory of the cache the outputs are stored in",
+    default=DEFAULT_CACHE_DIR,
+)
+@click.option(
+    "--cache_size",
+    type=float,
+    default=DEFAULT_MAX_GB,
+    help="GB the cache may use, the least recently used runs are removed beyond that",
+)
+def server(input_yaml, host, port, n_workers, cache_dir, cache_size):
+    """
+    a daemon with warm workers that runs simulations requested over HTTP, see
+    model/server.py
+    """
+    serve(
+        read_yaml(input_yaml),
+        host,
+        port,
+        n_workers or os.cpu_count() or 1,
+        ResultCache(cache_dir, cache_size),
+    )
+
+
+if __name__ == "__main__":
+    server()
@@ -1,7 +1,14 @@
-from model.simulation import run
-from model.figures import *
+from model.simulation import create_simulation
+from model.checkpoint import (
+    assert_checkpointable,
+    load_checkpoint,
+    run_with_checkpoints,
+)
+from model.storage import save_results as store_results, load_results
+from model.report import render_report, FIGURES
+from model.cache import ResultCache, cached_run, DEFAULT_CACHE_DIR, DEFAULT_MAX_GB
+from model.world import use_world_store
 
-import plotly.offline as py
 import os
 import click
 import yaml
@@ -14,11 +21,7 @@ def make_directory_if_doesnt_exist(dir_name):
 
 def read_yaml(filename):
     with open(filename, "r") as stream:
-        return yaml.load(stream)
-
-
-def save_plot(plot, directory, filename):
-    py.plot(plot, filename=os.path.join(directory, filename))
+        return yaml.safe_load(stream)
 
 
 @click.command()
@@ -29,76 +32,114 @@ def save_plot(plot, directory, filename):
     default="model_parameters.yaml",
 )
 @click.option("--output_dir", "-o", help="Output directory", default="./tests")
-def create_outputs(input_yaml, output_dir):
+@click.option(
+    "--save_results",
+    is_flag=True,
+    help="Also store the raw outputs in <output_dir>/results",
+)
+@click.option(
+    "--from_results",
+    help="Directory with stored outputs to plot, instead of running the simulation",
+    default=None,
+)
+@click.option(
+    "--checkpoint_at",
+    help="Comma separated list of ticks to checkpoint the simulation before, in "
+    "<output_dir>/checkpoints",
+    default=None,
+)
+@click.option(
+    "--resume_from",
+    help="Checkpoint to continue the simulation from, instead of starting a new one",
+    default=None,
+)
+@click.option(
+    "--plot_mode",
+    type=click.Choice(["auto", "full", "sample", "bands"]),
+    default="auto",
+    help="How to plot one line per consumer/firm: all lines, a sample, or quantile "
+    "bands. auto uses bands when there are many consumers/firms",
+)
+@click.option(
+    "--plots",
+    help="Comma separated list of figures to make (default all): "
+    + ", ".join(FIGURES.keys()),
+    default=None,
+)
+@click.option("--no-plots", "no_plots", is_flag=True, help="Don't make any figures")
+@click.option(
+    "--n_workers",
+    type=int,
+    default=None,
+    help="Number of processes rendering figures (default: one per core)",
+)
+@click.option(
+    "--cache_dir",
+    help="Directory of the cache of outputs of earlier runs",
+    default=DEFAULT_CACHE_DIR,
+)
+@click.option(
+    "--cache_size",
+    type=float,
+    default=DEFAULT_MAX_GB,
+    help="GB the cache may use, the least recently used runs are removed beyond that",
+)
+@click.option("--no_cache", is_flag=True, help="Don't use the cache of outputs")
+@click.option(
+    "--refresh_cache",
+    is_flag=True,
+    help="Run the simulation even if its outputs are cached, and replace them",
+)
+def create_outputs(
+    input_yaml,
+    output_dir,
+    save_results,
+    from_results,
+    checkpoint_at,
+    resume_from,
+    plot_mode,
+    plots,
+    no_plots,
+    n_workers,
+    cache_dir,
+    cache_size,
+    no_cache,
+    refresh_cache,
+):
     make_directory_if_doesnt_exist(output_dir)
-    yam = read_yaml(input_yaml)
-    out = run(**yam)
-
-    quality = out["quality"]
-    save_plot(plot_quality_by_category(quality), output_dir, "quality_by_category.html")
-    save_plot(plot_quality_by_firm(quality), output_dir, "quality_by_firm.html")
-
-    cat_entry_and_exit_df = out["cat_entry_and_exit_df"]
-    save_plot(plot_market_entry(cat_entry_and_exit_df), output_dir, "market_entry.html")
-
-    market_share_df = out["market_share_df"]
-    save_plot(
-        plot_market_concentration(market_share_df),
-        output_dir,
-        "market_concentration.html",
-    )
-
-    firm_specialisation_df = out["firm_specialisation_df"]
-    save_plot(
-        plot_firm_specialisation(firm_specialisation_df),
-        output_dir,
-        "firm_specialisation.html",
-    )
-
-    complimentarity_df = out["complimentarity_df"]
-    save_plot(
-        plot_complimentarity(complimentarity_df), output_dir, "complimentarity.html"
-    )
-
-    new_products_new_cat = out["new_products_new_cat"]
-    new_products_existing_cat = out["new_products_existing_cat"]
-    save_plot(
-        plot_new_products(new_products_new_cat, new=True),
-        output_dir,
-        "new_products.html",
-    )
-    save_plot(
-        plot_new_products(new_products_existing_cat),
-        output_dir,
-        "existing_products.html",
-    )
-
-    welfare_df = out["welfare_df"]
-    save_plot(plot_welfare(welfare_df), output_dir, "welfare.html")
-
-    market_share_timeline_df = out["market_share_timeline_df"]
-    save_plot(
-        plot_market_share_timeline(market_share_timeline_df),
-        output_dir,
-        "market_share.html",
-    )
-
-    firm_usage_df = out["firm_usage_df"]
-    save_plot(plot_firm_engagement(firm_usage_df), output_dir, "firm_usage.html")
-
-    concern_evo = out["concern_evo"]
-    save_plot(plot_concern(concern_evo), output_dir, "concern_evo.html")
-
-    privacy_score_evo = out["ps_score_evo"]
-    save_plot(plot_privacy_score(privacy_score_evo), output_dir, "privacy_score.html")
-
-    capital = out["capital"]
-    save_plot(plot_capital(capital), output_dir, "capital.html")
-
-    data_request_plot_df = out["data_request_plot_df"]
-    save_plot(
-        plot_data_requests(data_request_plot_df), output_dir, "data_requests.html"
-    )
+    use_world_store(None if no_cache else cache_dir)
+    if from_results:
+        out = load_results(from_results)
+    elif not (no_cache or resume_from or checkpoint_at):
+        cache = ResultCache(cache_dir, cache_size)
+        config = read_yaml(input_yaml)
+        out = cache.get(config) if not refresh_cache else None
+        if out is not None:
+            print("outputs from the cache: " + cache.path(config))
+        else:
+            out = cached_run(cache, refresh=True, **config)
+    else:
+        if resume_from:
+            sim = load_checkpoint(resume_from)
+        else:
+            config = read_yaml(input_yaml)
+            if checkpoint_at is not None:
+                assert_checkpointable(config["general_dict"])
+            sim = create_simulation(**config)
+        ticks = []
+        if checkpoint_at is not None:
+            ticks = [int(x) for x in checkpoint_at.split(",") if x.strip()]
+        out = run_with_checkpoints(sim, ticks, os.path.join(output_dir, "checkpoints"))
+    if save_results:
+        store_results(out, os.path.join(output_dir, "results"))
+    if "profile_summary" in out:
+        print(out["profile_summary"].to_string())
+
+    if no_plots:
+        return
+    if plots is not None:
+        plots = [x.strip() for x in plots.split(",") if x.strip()]
+    render_report(out, output_dir, plots, plot_mode, n_workers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+from model.sweep import run_sweep, make_jobs
+from model.cache import ResultCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_GB
+from model.world import use_world_store
+
+import click
+import yaml
+
+
+def read_yaml(filename):
+    with open(filename, "r") as stream:
+        return yaml.safe_load(stream)
+
+
+@click.command()
+@click.option(
+    "--input_yaml",
+    "-i",
+    help="Path to yaml with the base parameters",
+    default="model_parameters.yaml",
+)
+@click.option(
+    "--sweep_yaml",
+    "-s",
+    help="Path to yaml describing the sweep",
+    default="sweep_parameters.yaml",
+)
+@click.option("--output_dir", "-o", help="Output directory", default="./sweep")
+@click.option(
+    "--n_workers",
+    "-n",
+    type=int,
+    default=None,
+    help="Number of runs at the same time (default: one per core)",
+)
+@click.option("--dry_run", is_flag=True, help="Only list the runs in the sweep")
+@click.option(
+    "--cache_dir",
+    help="Directory of the cache of outputs of earlier runs",
+    default=DEFAULT_CACHE_DIR,
+)
+@click.option(
+    "--cache_size",
+    type=float,
+    default=DEFAULT_MAX_GB,
+    help="GB the cache may use, the least recently used runs are removed beyond that",
+)
+@click.option("--no_cache", is_flag=True, help="Don't use the cache of outputs")
+def sweep(
+    input_yaml,
+    sweep_yaml,
+    output_dir,
+    n_workers,
+    dry_run,
+    cache_dir,
+    cache_size,
+    no_cache,
+):
+    base_config = read_yaml(input_yaml)
+    sweep_spec = read_yaml(sweep_yaml)
+    if dry_run:
+        for run_dir, _, point, _ in make_jobs(base_config, sweep_spec, output_dir):
+            print(run_dir, point)
+        return
+    cache = None if no_cache else ResultCache(cache_dir, cache_size)
+    use_world_store(None if no_cache else cache_dir)
+    failed = run_sweep(base_config, sweep_spec, output_dir, n_workers, cache=cache)
+    if failed:
+        print("{} runs failed, see error.txt in:".format(len(failed)))
+        for run_dir in failed:
+            print("  " + run_dir)
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    sweep()